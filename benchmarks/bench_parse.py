@@ -0,0 +1,148 @@
+# Compares the original dataclass response parser with parse_batch on
+# synthetic search payloads where about one node in ten has an email, and
+# reports parse time and the memory still held by the parsed result.
+#
+#   python benchmarks/bench_parse.py [--nodes 100 1000 10000] [--repeat 20]
+import argparse
+import datetime
+import json
+import random
+import string
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+
+from stalkerbot.utils import parse_batch
+
+
+@dataclass
+class LegacyParsedData:
+    name: str
+    login: str
+    email: str
+    createdAt: datetime.datetime
+
+    def __post_init__(self):
+        if isinstance(self.createdAt, str):
+            self.createdAt = datetime.datetime.fromisoformat(self.createdAt[:-1])
+
+
+@dataclass
+class LegacyRateLimit:
+    cost: int
+    used: int
+    remaining: int
+    resetAt: datetime
+    limit: int = None
+
+    def __post_init__(self):
+        if isinstance(self.resetAt, str):
+            offset = datetime.timedelta(hours=+4)
+            self.resetAt = datetime.datetime.fromisoformat(self.resetAt[:-1]) + offset
+
+
+@dataclass
+class LegacyPageInfo:
+    hasNextPage: bool
+    hasPreviousPage: bool
+    endCursor: str
+    startCursor: str = None
+
+
+@dataclass
+class LegacyQueryResponse:
+    _raw: str
+    rateLimit: LegacyRateLimit = field(init=False)
+    pageInfo: LegacyPageInfo = field(init=False)
+    users: list = field(init=False)
+    userCount: int = field(init=False)
+
+    def __post_init__(self):
+        data = json.loads(self._raw)["data"]
+        self.rateLimit = LegacyRateLimit(**data["rateLimit"])
+        self.pageInfo = LegacyPageInfo(**data["search"]["pageInfo"])
+        self.users = [LegacyParsedData(**d) for d in data["search"]["nodes"] if d]
+        self.userCount = data["search"]["userCount"]
+
+
+def legacy(raw: str):
+    # What Stalker._search used to do with every page
+    resp = LegacyQueryResponse(raw)
+    return resp, [u for u in resp.users if u.email is not None and len(u.email) > 0]
+
+
+def current(raw: str):
+    _, (resp,) = parse_batch(raw, 1, emails_only=True)
+    return resp, resp.users
+
+
+def payload(nodes: int, email_rate: float = 0.1) -> str:
+    rng = random.Random(nodes)
+
+    def word(n):
+        return "".join(rng.choices(string.ascii_lowercase, k=n))
+
+    search = {
+        "pageInfo": {
+            "hasNextPage": False,
+            "hasPreviousPage": True,
+            "startCursor": "Y3Vyc29yOjE=",
+            "endCursor": "Y3Vyc29yOjEwMA==",
+        },
+        "userCount": nodes,
+        "nodes": [
+            {
+                "name": f"{word(6).title()} {word(8).title()}",
+                "login": word(10),
+                "email": f"{word(8)}@{word(6)}.com" if rng.random() < email_rate else "",
+                "createdAt": "2021-03-04T05:06:07Z",
+            }
+            for _ in range(nodes)
+        ],
+    }
+    rate_limit = {
+        "limit": 5000,
+        "cost": 1,
+        "used": 1,
+        "remaining": 4999,
+        "resetAt": "2021-03-04T06:00:00Z",
+    }
+    return json.dumps({"data": {"rateLimit": rate_limit, "s0": search, "search": search}})
+
+
+def measure(parse, raw: str, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse(raw)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    resp, users = parse(raw)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if getattr(resp, "_raw", None) is raw:
+        # The body was allocated before tracing started but is kept alive
+        retained += sys.getsizeof(raw)
+    return elapsed, retained, peak, len(users)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'nodes':>7} {'parser':>8} {'ms':>9} {'retained KiB':>13} {'peak KiB':>9} users")
+    for nodes in args.nodes:
+        raw = payload(nodes)
+        for name, parse in (("legacy", legacy), ("current", current)):
+            elapsed, retained, peak, users = measure(parse, raw, args.repeat)
+            print(
+                f"{nodes:>7} {name:>8} {elapsed * 1000:>9.2f}"
+                f" {retained / 1024:>13.1f} {peak / 1024:>9.1f} {users}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# Runs the whole Stalker.start pipeline against benchmarks/fake_github.py on a
+# local port, so no network or API points are needed, and reports pages/s,
+# emails/s, points per email and peak memory.
+#
+#   python benchmarks/bench_pipeline.py [--days 30] [--shards 4] [--batch-size 10]
+#       [--parser process] [--latency 0.05] [--save result.json]
+#       [--baseline result.json --tolerance 0.2]
+#
+# With --baseline the run fails when any metric is more than --tolerance
+# worse than the saved one, which is how CI catches regressions.
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timedelta
+
+from stalkerbot.stalker import Stalker
+
+import fake_github
+
+# Metric name -> True if higher is better
+METRICS = {
+    "pages_per_second": True,
+    "emails_per_second": True,
+    "points_per_email": False,
+    "peak_rss_mib": False,
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port: int, args: argparse.Namespace) -> subprocess.Popen:
+    server_args = [
+        f"--users={args.users}",
+        f"--email-rate={args.email_rate}",
+        f"--limit={args.limit}",
+        f"--window={args.window}",
+        f"--latency={args.latency}",
+        f"--error-rate={args.error_rate}",
+        f"--throttle-rate={args.throttle_rate}",
+        f"--retry-after={args.retry_after}",
+        f"--graphql-error-rate={args.graphql_error_rate}",
+        f"--seed={args.seed}",
+    ]
+    server = subprocess.Popen(
+        [sys.executable, fake_github.__file__, f"--port={port}", *server_args]
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("fake server did not start")
+
+
+def run(args: argparse.Namespace) -> dict:
+    port = free_port()
+    server = start_server(port, args)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            until = datetime.utcnow()
+            stalker = Stalker(
+                query="language:python",
+                token="bench",
+                continue_from=until,
+                since=until - timedelta(days=args.days),
+                output_path=os.path.join(tmp, "users.csv"),
+                silent=True,
+                shards=args.shards,
+                density_index=os.path.join(tmp, ".density"),
+                batch_size=args.batch_size,
+                parser=args.parser,
+                endpoint=f"http://127.0.0.1:{port}/graphql",
+            )
+            start = time.perf_counter()
+            stalker.start()
+            elapsed = time.perf_counter() - start
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as resp:
+            served = json.load(resp)
+    finally:
+        server.terminate()
+        server.wait()
+
+    emails = stalker.writer.total
+    request_seconds = stalker.metrics.histograms[("stalkerbot_request_seconds", ())]
+    budget_wait = stalker.metrics.histograms.get(("stalkerbot_budget_wait_seconds", ()))
+    return {
+        "seconds": round(elapsed, 3),
+        "requests": served["requests"],
+        "pages": served["pages"],
+        "probes": served["probes"],
+        "emails": emails,
+        "points": stalker.budget.spent,
+        "pages_per_second": round(served["pages"] / elapsed, 2),
+        "emails_per_second": round(emails / elapsed, 2),
+        "points_per_email": round(stalker.budget.spent / max(emails, 1), 4),
+        "request_p95_seconds": request_seconds.quantile(0.95),
+        "budget_wait_seconds": round(budget_wait.sum, 3) if budget_wait else 0,
+        "final_concurrency": stalker.limiter.current,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "parser_peak_rss_mib": round(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1
+        ),
+    }
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    failed = []
+    for name, higher_is_better in METRICS.items():
+        old, new = baseline.get(name), result[name]
+        if not old:
+            continue
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > tolerance:
+            failed.append(f"{name} {old} -> {new} ({change:+.0%})")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=float, default=30, help="signup range crawled")
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--parser", choices=["process", "thread", "inline"], default="process")
+    parser.add_argument("--save", help="write the result to this file")
+    parser.add_argument("--baseline", help="compare against a saved result")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    fake_github.add_arguments(parser)
+    args = parser.parse_args()
+
+    result = run(args)
+    for name, value in result.items():
+        print(f"{name:>20} {value}")
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump(result, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            failed = regressions(result, json.load(fp), args.tolerance)
+        for line in failed:
+            print(f"regression: {line}")
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
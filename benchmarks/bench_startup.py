@@ -0,0 +1,120 @@
+# Measures how long a fresh interpreter takes to import stalkerbot, to load
+# the CLI and to get a crawl ready, and lists the imports that cost the most
+# (python -X importtime), so short scheduled runs and programs embedding
+# stalkerbot do not pay for what they do not use.
+#
+#   python benchmarks/bench_startup.py [--repeat 10] [--top 10]
+#       [--save result.json] [--baseline result.json --tolerance 0.2]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Name -> code run in a fresh interpreter
+CASES = {
+    "import": "import stalkerbot",
+    "cli": "import stalkerbot.cli",
+    "help": "from stalkerbot.cli import cli; cli(['--help'], standalone_mode=False)",
+    "crawl": "import stalkerbot; stalkerbot.crawl",
+}
+
+
+def environment() -> dict:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+
+def measure(code: str, repeat: int, cwd: str) -> float:
+    # Median wall time of a whole interpreter run, startup included
+    env = environment()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=cwd,
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def slowest(code: str, top: int, cwd: str) -> list[tuple[float, str]]:
+    # Cumulative import time per module, slowest first
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=cwd,
+        env=environment(),
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if not name.startswith("  "):
+            # Only imports made directly by the code, nested ones are in them
+            modules.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--save", help="write the result to this JSON file")
+    parser.add_argument("--baseline", help="compare against a saved result")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    # An empty working directory, so nothing there is picked up
+    with tempfile.TemporaryDirectory() as cwd:
+        baseline = measure("pass", args.repeat, cwd)
+        result = {"interpreter_ms": baseline * 1000}
+        print(f"{'case':>12} {'ms':>8} {'over python':>12}")
+        print(f"{'python':>12} {baseline * 1000:>8.1f}")
+        for name, code in CASES.items():
+            elapsed = measure(code, args.repeat, cwd)
+            result[f"{name}_ms"] = elapsed * 1000
+            print(f"{name:>12} {elapsed * 1000:>8.1f} {(elapsed - baseline) * 1000:>12.1f}")
+
+        print(f"\nslowest imports for {CASES['crawl']!r}:")
+        for seconds, module in slowest(CASES["crawl"], args.top, cwd):
+            print(f"{seconds * 1000:>8.1f} ms  {module}")
+        if os.path.exists(os.path.join(cwd, "stalkerbot.log")):
+            print("\nwarning: importing stalkerbot wrote stalkerbot.log")
+            result["writes_log"] = True
+
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump(result, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            saved = json.load(fp)
+        failed = [
+            f"{name} {saved[name]:.1f} -> {value:.1f}"
+            for name, value in result.items()
+            if name.endswith("_ms")
+            and name != "interpreter_ms"
+            and name in saved
+            and value > saved[name] * (1 + args.tolerance)
+        ]
+        if failed:
+            print("regressed: " + ", ".join(failed))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
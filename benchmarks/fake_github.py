@@ -0,0 +1,297 @@
+# Local stand-in for the GitHub GraphQL search API, close enough to drive the
+# whole crawler without spending real points.
+#
+# Signups follow a synthetic density that grows linearly from 2008 to now, so
+# the number of users created before t grows quadratically and user k signed
+# up at EPOCH + span * sqrt(k / users). Searches honour created: ranges,
+# userCount, the 1000 result cap, last/before paging and aliased batches.
+# Every request pays one point per search from a per-token budget that resets
+# every --window seconds. Answers are delayed by --latency, and a share of
+# requests fails with a 502, a 429 carrying Retry-After or a 200 holding only
+# GraphQL errors. Aliased user(login:) lookups are answered too, with
+# --change-rate of users showing a new email since they were crawled.
+#
+#   python benchmarks/fake_github.py [--port 8765] [--users 5000000] [--latency 0.05]
+#
+# GET /stats returns what has been served so far.
+import argparse
+import asyncio
+import base64
+import math
+import random
+import re
+from datetime import datetime, timedelta
+from hashlib import blake2b
+
+from aiohttp import web
+
+EPOCH = datetime(2008, 4, 1)
+RESULT_CAP = 1000
+
+_SEARCH = re.compile(
+    r'(?:(?P<alias>\w+): )?search\(query: "(?P<q>(?:[^"\\]|\\.)*)",\s*'
+    r'(?:before: "(?P<before>[^"]*)",\s*)?(?:last: (?P<last>\d+),\s*)?'
+    r"type: \w+\)\s*\{(?P<selection>userCount\}|pageInfo)"
+)
+_USER = re.compile(r'(?P<alias>\w+): user\(login: "(?P<login>(?:[^"\\]|\\.)*)"\)')
+_CREATED = re.compile(r"created:(\S+)\.\.(\S+)")
+
+
+class Population:
+    def __init__(self, users: int, email_rate: float, now: datetime = None, seed: int = 0):
+        self.users = users
+        self.email_rate = email_rate
+        self.now = now or datetime.utcnow()
+        self.span = (self.now - EPOCH).total_seconds()
+        self.seed = seed
+
+    def before(self, t: datetime) -> int:
+        # Users created strictly before t
+        x = max(0.0, (t - EPOCH).total_seconds() / self.span)
+        return math.ceil(self.users * x * x)
+
+    def created(self, k: int) -> datetime:
+        seconds = self.span * math.sqrt(k / self.users)
+        return (EPOCH + timedelta(seconds=seconds)).replace(microsecond=0)
+
+    def _roll(self, kind: str, k: int) -> float:
+        digest = blake2b(f"{self.seed}:{kind}{k}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little") / 2**64
+
+    def user(self, k: int, change_rate: float = 0.0) -> dict:
+        has_email = self._roll("", k) < self.email_rate
+        domain = "example.com"
+        if change_rate and self._roll("change:", k) < change_rate:
+            has_email, domain = True, "example.org"
+        return {
+            "name": f"User {k}",
+            "login": f"user{k}",
+            "email": f"user{k}@{domain}" if has_email else "",
+            "createdAt": self.created(k).isoformat() + "Z",
+        }
+
+    def lookup(self, login: str, change_rate: float = 0.0) -> dict:
+        m = re.fullmatch(r"user(\d+)", login)
+        if m is None or int(m[1]) >= self.before(datetime.utcnow()):
+            return None
+        return self.user(int(m[1]), change_rate)
+
+    def search(self, q: str) -> range:
+        # created: bounds are inclusive whole seconds
+        m = _CREATED.search(q)
+        if m is None:
+            return range(0, self.before(datetime.utcnow()))
+        start, last = (datetime.fromisoformat(t.rstrip("Z")) for t in m.groups())
+        return range(self.before(start), self.before(last + timedelta(seconds=1)))
+
+
+def _cursor(i: int) -> str:
+    return base64.b64encode(f"cursor:{i}".encode()).decode()
+
+
+def _index(cursor: str) -> int:
+    return int(base64.b64decode(cursor).decode().split(":")[1])
+
+
+class FakeGitHub:
+    def __init__(
+        self,
+        population: Population,
+        limit: int = 5000,
+        window: float = 3600,
+        latency: float = 0.05,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: int = 1,
+        graphql_error_rate: float = 0.0,
+        change_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.population = population
+        self.limit = limit
+        self.window = window
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.graphql_error_rate = graphql_error_rate
+        self.change_rate = change_rate
+        self.random = random.Random(seed)
+        self.budgets = {}
+        self.stats = {
+            "requests": 0,
+            "searches": 0,
+            "pages": 0,
+            "probes": 0,
+            "lookups": 0,
+            "nodes": 0,
+            "points": 0,
+            "502": 0,
+            "429": 0,
+            "graphql_errors": 0,
+            "rate_limited": 0,
+        }
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/graphql", self.graphql)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def _budget(self, token: str) -> dict:
+        now = datetime.utcnow()
+        budget = self.budgets.get(token)
+        if budget is None or now >= budget["reset_at"]:
+            budget = {"used": 0, "reset_at": now + timedelta(seconds=self.window)}
+            self.budgets[token] = budget
+        return budget
+
+    async def graphql(self, request: web.Request) -> web.Response:
+        self.stats["requests"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * (0.5 + self.random.random()))
+        roll = self.random.random()
+        if roll < self.error_rate:
+            self.stats["502"] += 1
+            return web.Response(status=502, text="<html>Bad Gateway</html>")
+        if roll < self.error_rate + self.throttle_rate:
+            self.stats["429"] += 1
+            return web.json_response(
+                {"message": "You have exceeded a secondary rate limit."},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        if roll < self.error_rate + self.throttle_rate + self.graphql_error_rate:
+            self.stats["graphql_errors"] += 1
+            return web.json_response(
+                {
+                    "errors": [
+                        {
+                            "message": "Something went wrong while executing your query."
+                        }
+                    ]
+                }
+            )
+
+        doc = (await request.json())["query"]
+        searches = list(_SEARCH.finditer(doc))
+        cost = max(1, len(searches))
+        budget = self._budget(request.headers.get("Authorization", ""))
+        if budget["used"] + cost > self.limit:
+            self.stats["rate_limited"] += 1
+            return web.json_response(
+                {
+                    "errors": [
+                        {
+                            "type": "RATE_LIMITED",
+                            "message": "API rate limit exceeded",
+                        }
+                    ]
+                },
+                headers={
+                    "X-RateLimit-Remaining": "0",
+                    "X-RateLimit-Reset": str(int(budget["reset_at"].timestamp())),
+                },
+            )
+        budget["used"] += cost
+        self.stats["points"] += cost
+        data = {
+            "rateLimit": {
+                "limit": self.limit,
+                "cost": cost,
+                "used": budget["used"],
+                "remaining": self.limit - budget["used"],
+                "resetAt": budget["reset_at"].replace(microsecond=0).isoformat() + "Z",
+            }
+        }
+        for m in searches:
+            data[m["alias"] or "search"] = self._search(m)
+        errors = []
+        for m in _USER.finditer(doc):
+            self.stats["lookups"] += 1
+            user = self.population.lookup(m["login"].replace('\\"', '"'), self.change_rate)
+            data[m["alias"]] = user
+            if user is None:
+                errors.append(
+                    {
+                        "type": "NOT_FOUND",
+                        "path": [m["alias"]],
+                        "message": f"Could not resolve to a User with the login of '{m['login']}'.",
+                    }
+                )
+        body = {"data": data}
+        if errors:
+            body["errors"] = errors
+        return web.json_response(body)
+
+    def _search(self, m: re.Match) -> dict:
+        self.stats["searches"] += 1
+        matches = self.population.search(m["q"].replace('\\"', '"'))
+        result = {"userCount": len(matches)}
+        if m["selection"] == "userCount}":
+            self.stats["probes"] += 1
+            return result
+        self.stats["pages"] += 1
+        # Only the newest RESULT_CAP matches can be paged through
+        reachable = matches[-RESULT_CAP:]
+        end = len(reachable) if m["before"] is None else _index(m["before"])
+        start = max(0, end - int(m["last"] or 100))
+        nodes = [self.population.user(k) for k in reachable[start:end]]
+        self.stats["nodes"] += len(nodes)
+        result["pageInfo"] = {
+            "hasNextPage": end < len(reachable),
+            "hasPreviousPage": start > 0,
+            "startCursor": _cursor(start) if nodes else None,
+            "endCursor": _cursor(end - 1) if nodes else None,
+        }
+        result["nodes"] = nodes
+        return result
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--users", type=int, default=5_000_000, help="signups by now")
+    parser.add_argument("--email-rate", type=float, default=0.3)
+    parser.add_argument("--limit", type=int, default=5000, help="points per window")
+    parser.add_argument("--window", type=float, default=3600, help="seconds")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 502s")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of 429s")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument(
+        "--change-rate", type=float, default=0.0, help="share of users whose lookup differs"
+    )
+    parser.add_argument(
+        "--graphql-error-rate", type=float, default=0.0, help="share of error-only 200s"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def from_arguments(args: argparse.Namespace) -> FakeGitHub:
+    return FakeGitHub(
+        Population(args.users, args.email_rate, seed=args.seed),
+        limit=args.limit,
+        window=args.window,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        graphql_error_rate=args.graphql_error_rate,
+        change_rate=args.change_rate,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(from_arguments(args).app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
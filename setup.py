@@ -4,6 +4,7 @@ setup(
     name="github-stalkerbot",
     version="1.1.0",
     packages=find_packages(),
-    install_requires=["requests", "beautifulsoup4", "browser-cookie3", "click", "tqdm"],
-    entry_points={"console_scripts": ["stalkerbot=stalkerbot.cli:start"]},
+    install_requires=["aiohttp", "click", "tqdm"],
+    extras_require={"zstd": ["zstandard"], "parquet": ["pyarrow"]},
+    entry_points={"console_scripts": ["stalkerbot=stalkerbot.cli:cli"]},
 )
@@ -1,30 +1,19 @@
-import logging
-import logging
-from logging.config import dictConfig
-import keyring
-import os
+# The library API is imported on first use, so `import stalkerbot` and the
+# CLI start without loading aiohttp and the crawl machinery they may not need
+_API = {
+    "crawl": "stalkerbot.api",
+    "refresh": "stalkerbot.lookup",
+    "compact": "stalkerbot.compaction",
+}
 
-logging.getLogger().config = dictConfig(
-    {
-        "version": 1,
-        "formatters": {
-            "default": {
-                "fmt": "%(asctime)s %(levelname)-8s %(name)-15s %(message)s",
-                "datefmt": "%Y-%m-%d %H:%M:%S",
-            }
-        },
-    }
-)
+__all__ = list(_API)
 
-root = logging.getLogger()
-root.setLevel(10)
-file_handler = logging.handlers.RotatingFileHandler("stalkerbot.log")
-root.addHandler(file_handler)
 
-try:
-    with open("token") as fp:
-        token = fp.read().strip()
-        if len(token) > 0:
-            os.environ["GITHUB_TOKEN"] = token
-except Exception:
-    pass
+def __getattr__(name: str):
+    if name not in _API:
+        raise AttributeError(f"module 'stalkerbot' has no attribute {name!r}")
+    from importlib import import_module
+
+    value = getattr(import_module(_API[name]), name)
+    globals()[name] = value
+    return value
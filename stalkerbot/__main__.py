@@ -1,3 +1,3 @@
-from stalkerbot.cli import cli, start
+from stalkerbot.cli import cli
 
-start()
+cli()
@@ -0,0 +1,65 @@
+import asyncio
+from asyncio.queues import QueueEmpty
+from datetime import datetime
+from typing import AsyncIterator, Union
+
+from stalkerbot.stalker import Stalker
+from stalkerbot.utils import ParsedData, State
+
+
+async def crawl(
+    query: Union[str, list, dict],
+    token: str,
+    since: datetime = None,
+    until: datetime = None,
+    limit: int = None,
+    queue_size: int = 1000,
+    seen_index: str = None,
+    **options,
+) -> AsyncIterator[ParsedData]:
+    # Yields users with an email as the crawl finds them, in the caller's
+    # loop. At most `queue_size` users wait to be taken; past that the
+    # searches wait too, so a slow consumer slows the crawl down rather than
+    # filling memory. Leaving the loop, hitting `limit` or cancelling stops
+    # the crawl after the requests in flight come back. Wrap the call in
+    # contextlib.aclosing to have that happen straight away on break.
+    # `seen_index` skips users already yielded by this or an earlier crawl,
+    # the other options are Stalker's.
+    stalker = Stalker(
+        query,
+        token,
+        continue_from=until,
+        since=since,
+        output_path=None,
+        silent=True,
+        queue_size=queue_size,
+        seen_index=seen_index,
+        **options,
+    )
+    queue = stalker.output_queue
+    run = asyncio.get_running_loop().create_task(stalker.run(), name="stalker")
+    yielded = 0
+    try:
+        while limit is None or yielded < limit:
+            try:
+                user = queue.get_nowait()
+            except QueueEmpty:
+                if run.done():
+                    break
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait({getter, run}, return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    continue
+                user = getter.result()
+            if isinstance(user, State):
+                continue
+            if stalker.seen is not None and stalker.seen.seen(user.login, user.email):
+                continue
+            yield user
+            yielded += 1
+    finally:
+        stalker.stop()
+        await asyncio.wait({run})
+    if not run.cancelled() and run.exception() is not None:
+        raise run.exception()
@@ -1,51 +1,288 @@
-import webbrowser
-from datetime import datetime
-from http.cookiejar import CookieJar
+from datetime import datetime, timedelta
 
 import click
-import requests
-from tqdm.asyncio import tqdm
-import os
-from stalkerbot.stalker import Stalker
-import pickle
+from stalkerbot.filters import ORDERS, SORTS, Filters
+from stalkerbot.logs import LEVELS, setup_logging
 
 
-@click.Group
-def cli():
-    pass
+def _token(token: str) -> str:
+    # Falls back to a token file in the working directory, only read once a
+    # command needs a token
+    if token:
+        return token
+    try:
+        with open("token") as fp:
+            return fp.read().strip() or None
+    except OSError:
+        return None
+
+
+@click.group()
+@click.option(
+    "--log-level",
+    type=click.Choice(LEVELS, case_sensitive=False),
+    default="INFO",
+    envvar="STALKERBOT_LOG_LEVEL",
+    help="Least severe messages written to the log",
+)
+@click.option(
+    "--log-file",
+    default="stalkerbot.log",
+    envvar="STALKERBOT_LOG_FILE",
+    help="Where the log is written, empty to not write one",
+)
+def cli(log_level, log_file):
+    setup_logging(log_level, log_file)
 
 
 @cli.command()
 @click.option("--silent", is_flag=True, default=False)
 @click.option("--no-auth", is_flag=True, default=False)
-@click.option("-q", "--query", default="language:python3")
-@click.option("-z", "--page-size", default=250)
-@click.option("-c", "--continue-from", default=None)
+@click.option(
+    "-q",
+    "--query",
+    multiple=True,
+    default=["language:python3"],
+    help="Search query, repeat to crawl several in one run",
+)
+@click.option(
+    "--queries",
+    "queries_file",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="File of queries, one per line, optionally WEIGHT<TAB>QUERY",
+)
+@click.option(
+    "-z",
+    "--page-size",
+    type=click.IntRange(1, 100),
+    default=100,
+    help="Users per page, the largest size tried when autotuning",
+)
+@click.option(
+    "-c",
+    "--continue-from",
+    type=click.DateTime(),
+    default=None,
+    help="Only crawl users created before this UTC time, e.g. 2020-01-31",
+)
 @click.option("-e", "--early-stop", default=0)
-@click.option("-s", "--sort", default="followers")
-@click.option("-o", "--order", default="desc")
+@click.option(
+    "-s",
+    "--sort",
+    type=click.Choice(SORTS),
+    default=None,
+    help="Sort order for a query with its own created: range, others are crawled in signup order",
+)
+@click.option("--order", type=click.Choice(ORDERS), default="desc")
+@click.option("--followers", default=None, help="Followers, e.g. 100, >100, <=5 or 10..50")
+@click.option("--repos", default=None, help="Public repositories, e.g. >10 or 1..5")
+@click.option("--location", default=None, help="Location given on the profile")
+@click.option("--language", default=None, help="Language of the user's repositories")
+@click.option(
+    "--email-regex",
+    default=None,
+    help="Only write users whose email matches, applied while parsing",
+)
 @click.option("-o", "--output", default="data/users.csv")
-@click.option("-w", "--workers", default=4)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=25,
+    help="Most requests in flight at once, concurrency adapts below this",
+)
+@click.option(
+    "--min-workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Fewest requests in flight at once however badly GitHub copes",
+)
+@click.option(
+    "--density-index",
+    default=".density",
+    help="Signup density index used to plan search windows",
+)
+@click.option(
+    "--seen-index",
+    default="",
+    help="Seen logins and emails used to skip duplicates (default OUTPUT.seen)",
+)
+@click.option("--no-dedup", is_flag=True, default=False)
+@click.option(
+    "--window-index",
+    default="",
+    help="Fingerprints of windows already crawled, used to skip unchanged ones (default OUTPUT.windows)",
+)
+@click.option(
+    "--recheck",
+    is_flag=True,
+    default=False,
+    help="Crawl every window in full even if its fingerprint is unchanged",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["csv", "jsonl", "sqlite", "parquet"]),
+    default=None,
+    help="Output format, guessed from the output's extension by default",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["gzip", "zstd"]),
+    default=None,
+    help="Compress the output, guessed from a .gz or .zst extension by default",
+)
+@click.option(
+    "--rotate-size",
+    default=0,
+    help="Start a new numbered output file every this many MiB (0 never)",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Only crawl users created since the last complete crawl into this output",
+)
+@click.option(
+    "--overlap",
+    default=60,
+    help="Minutes an incremental crawl goes back before the last one ended",
+)
+@click.option(
+    "--journal",
+    default="",
+    help="Checkpoint journal used to resume (default OUTPUT.journal)",
+)
+@click.option(
+    "--flush-rows",
+    default=100,
+    help="Flush the output once this many rows are buffered",
+)
+@click.option(
+    "--flush-interval",
+    default=2.0,
+    help="Flush buffered rows after at most this many seconds",
+)
+@click.option(
+    "--fsync",
+    type=click.Choice(["never", "flush", "interval"]),
+    default="never",
+    help="When the output is synced to disk",
+)
+@click.option(
+    "--parser",
+    type=click.Choice(["process", "thread", "inline"]),
+    default="process",
+    help="Where responses are parsed, off the event loop unless inline",
+)
+@click.option(
+    "--batch-size",
+    default=10,
+    help="Most searches sent together in one GraphQL request",
+)
+@click.option(
+    "--shards",
+    default=1,
+    help="Split the date range into this many shards crawled concurrently",
+)
+@click.option(
+    "--metrics",
+    "metrics_path",
+    default=None,
+    help="Rewrite crawl metrics to this file, JSON if it ends in .json else Prometheus text",
+)
+@click.option("--metrics-port", default=None, type=int, help="Serve Prometheus /metrics")
+@click.option("--metrics-interval", default=10.0, help="Seconds between metrics exports")
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help="Log event loop stalls with their stack and profile the crawl",
+)
+@click.option(
+    "--profile-mode",
+    type=click.Choice(["sample", "cprofile"]),
+    default="sample",
+    help="Sample every thread by pipeline stage, or cProfile the event loop",
+)
+@click.option("--profile-output", default="stalkerbot.profile")
+@click.option(
+    "--stall-threshold",
+    default=100.0,
+    help="Milliseconds the event loop may be blocked before it is logged",
+)
+@click.option(
+    "--autotune/--no-autotune",
+    default=True,
+    help="Adjust the page size to rate limit cost and latency as the crawl goes",
+)
+@click.option(
+    "--endpoint",
+    default=None,
+    envvar="GITHUB_GRAPHQL_URL",
+    help="GraphQL endpoint, e.g. a local stand-in server (default GitHub's)",
+)
 @click.option("-t", "--token", default=None, envvar="GITHUB_TOKEN", help="Github token")
 @click.option("-u", "--username", default=None, envvar="GITHUB_USERNAME",help="Github username")
-@click.option("-o", "--org", default=False, is_flag=True,help="Turn this flag on if you want to email to orgs")
+@click.option("--org", default=False, is_flag=True,help="Turn this flag on if you want to email to orgs")
 def start(
     query,
+    queries_file,
     page_size,
     continue_from,
     early_stop,
     sort,
     order,
+    followers,
+    repos,
+    location,
+    language,
+    email_regex,
     output,
     workers,
+    min_workers,
     token,
     username,
     silent,
     no_auth,
     org,
+    shards,
+    density_index,
+    batch_size,
+    parser,
+    seen_index,
+    no_dedup,
+    window_index,
+    recheck,
+    flush_rows,
+    flush_interval,
+    fsync,
+    journal,
+    output_format,
+    compression,
+    rotate_size,
+    incremental,
+    overlap,
+    autotune,
+    endpoint,
+    metrics_path,
+    metrics_port,
+    metrics_interval,
+    profile,
+    profile_mode,
+    profile_output,
+    stall_threshold,
 ):
+    from stalkerbot.journal import Journal
+    from stalkerbot.scheduler import load_queries
+    from stalkerbot.stalker import Stalker
+    from stalkerbot.utils import GRAPHQL_URL
+    from stalkerbot.watermark import Watermarks
+
     click.clear()
 
+    token = _token(token)
     if not token:
         click.echo("(You can set the GITHUB_TOKEN environment variable to skip this)")
         token = click.prompt("GitHub Personal Access Token")
@@ -57,23 +294,33 @@ def start(
 
     state = None
 
-    if os.path.exists(".state"):
+    checkpoint = Journal.replay(journal or output + ".journal")
+    if checkpoint is not None and checkpoint.pending:
         if click.confirm("Continue from last saved state? (Y/n)"):
-            with open(".state", "rb") as fp:
-                state = pickle.load(fp)
-                continue_from = state.continue_from
-                query = state.query
+            state = checkpoint.states
+            continue_from = max(s.continue_from for s in checkpoint.pending)
+    # Query -> weight, the points each query gets relative to the others
+    queries = {q: 1.0 for q in query}
+    if queries_file:
+        try:
+            queries = load_queries(queries_file)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        if not queries:
+            raise click.ClickException(f"no queries in {queries_file}")
+    if state:
+        queries = {s.query: queries.get(s.query, 1.0) for s in state}
     if not silent:
         if not state:
-            click.echo(f"current query is {query}")
+            click.echo(f"current queries are {', '.join(queries)}")
             if click.confirm("enter new query? (y/N)"):
-                query = click.prompt("query")
+                queries = {click.prompt("query"): 1.0}
 
             click.echo(f"continue from {continue_from}")
             if click.confirm(
                 "change? (y/N)",
             ):
-                continue_from = int(click.prompt("page number"))
+                continue_from = click.prompt("created before (UTC)", type=click.DateTime())
 
         click.echo(f"stopping after adding {early_stop}? (0 runs until completion)")
         if click.confirm(
@@ -86,34 +333,260 @@ def start(
             "change? (y/N)",
         ):
             output = str(click.prompt("filepath"))
-    if org:
-        query = "type:org " + query
+    try:
+        filters = Filters(
+            followers=followers,
+            repos=repos,
+            location=location,
+            language=language,
+            sort=sort,
+            order=order,
+            email=email_regex,
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if org and not state:
+        queries = {"type:org " + q: w for q, w in queries.items()}
+    if not state:
+        queries = {filters.apply(q): w for q, w in queries.items()}
+    since = None
+    if incremental and not state:
+        since = {}
+        marks = Watermarks(output + ".watermarks")
+        for q in queries:
+            mark = marks.get(q)
+            if mark is not None:
+                # Overlap the last run in case recent signups were not indexed yet
+                since[q] = mark - timedelta(minutes=overlap)
+            elif not silent:
+                click.echo(f"no earlier complete crawl of {q}, crawling everything")
     if not silent:
         click.clear()
         click.echo(f"started at:  {datetime.now().isoformat()}")
         click.echo(f"user:  {username}")
-        click.echo(f"query: {query}\n")
-        click.echo(f"starting from: {continue_from}\n")
+        for q, weight in queries.items():
+            click.echo(f"query: {q}" + (f" (weight {weight:g})" if weight != 1 else ""))
+            if since and q in since:
+                click.echo(f"  users created since: {since[q].isoformat()}")
+        click.echo(f"\nstarting from: {continue_from}\n")
         click.echo(
             f"ending early: {f'minimum {early_stop} entries' if early_stop else 'no'}\n"
         )
-    stalker = Stalker(
-        query=query,
-        token=token,
-        continue_from=continue_from,
-        output_path=output,
-        silent=silent,
-        state=state,
-        early_stop=early_stop,
-        org_flag=org,
-    )
+    try:
+        stalker = Stalker(
+            query=queries,
+            token=token,
+            continue_from=continue_from,
+            output_path=output,
+            silent=silent,
+            state=state,
+            early_stop=early_stop,
+            org_flag=org,
+            shards=shards,
+            density_index=density_index,
+            batch_size=batch_size,
+            parser=parser,
+            seen_index=None if no_dedup else seen_index,
+            window_index=window_index,
+            recheck=recheck,
+            filters=filters,
+            flush_rows=flush_rows,
+            flush_interval=flush_interval,
+            fsync=fsync,
+            journal=journal,
+            output_format=output_format,
+            compression=compression,
+            rotate_bytes=rotate_size << 20 if rotate_size else None,
+            since=since,
+            endpoint=endpoint or GRAPHQL_URL,
+            metrics_path=metrics_path,
+            metrics_port=metrics_port,
+            metrics_interval=metrics_interval,
+            profile=profile_output if profile else None,
+            profile_mode=profile_mode,
+            stall_threshold=stall_threshold / 1000,
+            page_size=page_size,
+            autotune=autotune,
+            min_concurrency=min_workers,
+            max_concurrency=workers,
+        )
+    except (ImportError, ValueError) as e:
+        raise click.ClickException(str(e))
     try:
         stalker.start()
     except click.exceptions.Abort:
         click.echo("exiting...")
         stalker.stop()
     if not silent:
+        from tqdm.asyncio import tqdm
+
         tq = tqdm()
-        tq.write(f"saved state to .state")
+        tq.write(f"saved state to {stalker.journal.path}")
     else:
-        print(f"saved state to .state")
+        print(f"saved state to {stalker.journal.path}")
+
+
+# Re-checks the name and email of every login already crawled into PATH
+@cli.command("refresh")
+@click.argument("path", type=click.Path(exists=True))
+@click.option(
+    "-o",
+    "--output",
+    default=None,
+    help="Where changed users are appended (default PATH with .refresh before the extension)",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["csv", "jsonl", "sqlite", "parquet"]),
+    default=None,
+    help="Output format, guessed from the output's extension by default",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["gzip", "zstd"]),
+    default=None,
+    help="Compress the output, guessed from a .gz or .zst extension by default",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(1, 100),
+    default=100,
+    help="Logins looked up together in one GraphQL request",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=25,
+    help="Most requests in flight at once, concurrency adapts below this",
+)
+@click.option(
+    "--endpoint",
+    default=None,
+    envvar="GITHUB_GRAPHQL_URL",
+    help="GraphQL endpoint, e.g. a local stand-in server (default GitHub's)",
+)
+@click.option("-t", "--token", default=None, envvar="GITHUB_TOKEN", help="Github token")
+@click.option("--silent", is_flag=True, default=False)
+def refresh_command(
+    path, output, output_format, compression, batch_size, workers, endpoint, token, silent
+):
+    import asyncio
+
+    from stalkerbot.lookup import refresh
+    from stalkerbot.utils import GRAPHQL_URL
+
+    token = _token(token)
+    if not token:
+        click.echo("(You can set the GITHUB_TOKEN environment variable to skip this)")
+        token = click.prompt("GitHub Personal Access Token")
+    if not token:
+        click.echo("Token is invalid")
+        raise click.exceptions.Exit(1)
+    try:
+        stats = asyncio.run(
+            refresh(
+                path,
+                token,
+                output=output,
+                output_format=output_format,
+                compression=compression,
+                batch_size=batch_size,
+                endpoint=endpoint or GRAPHQL_URL,
+                max_concurrency=workers,
+                silent=silent,
+            )
+        )
+    except (ImportError, ValueError) as e:
+        raise click.ClickException(str(e))
+    click.echo(
+        f"checked {stats.checked} users: {stats.changed} changed, "
+        f"{stats.missing} gone, {stats.failed} failed, {stats.points} points spent"
+    )
+
+
+# Merges outputs into one sorted by login, keeping each login's latest row
+@cli.command("compact")
+@click.argument("paths", nargs=-1, required=True)
+@click.option(
+    "-o",
+    "--output",
+    default=None,
+    help="Where the merged output goes (default the first PATH with .compact before the extension)",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["csv", "jsonl", "sqlite", "parquet"]),
+    default=None,
+    help="Output format, guessed from the output's extension by default",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["gzip", "zstd"]),
+    default=None,
+    help="Compress the output, guessed from a .gz or .zst extension by default",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Processes sorting chunks (default one per CPU)",
+)
+@click.option(
+    "--chunk-rows",
+    type=click.IntRange(min=1000),
+    default=None,
+    help="Rows each process sorts in memory at once (default 500000)",
+)
+def compact_command(paths, output, output_format, compression, workers, chunk_rows):
+    from stalkerbot.compaction import CHUNK_ROWS, compact
+
+    try:
+        stats = compact(
+            list(paths),
+            output=output,
+            output_format=output_format,
+            compression=compression,
+            workers=workers,
+            chunk_rows=chunk_rows or CHUNK_ROWS,
+        )
+    except (ImportError, ValueError) as e:
+        raise click.ClickException(str(e))
+    click.echo(
+        f"read {stats.read} rows, wrote {stats.written} "
+        f"and dropped {stats.duplicates} older duplicates"
+    )
+
+
+@cli.group()
+def density():
+    pass
+
+
+@density.command("show")
+@click.option("-q", "--query", default=None)
+@click.option("--by", type=click.Choice(["year", "month", "day"]), default="month")
+@click.option("-i", "--index", default=".density")
+def density_show(query, by, index):
+    from stalkerbot.density import DensityIndex
+
+    index = DensityIndex(index)
+    if query is None:
+        for q, days, observations in index.queries():
+            click.echo(f"{q}: {days} days from {observations} observations")
+        return
+    for period, count, days in index.summary(query, by=by):
+        click.echo(f"{period}  {count:>10.0f}  ({days} days)")
+
+
+@density.command("rebuild")
+@click.option("-i", "--index", default=".density")
+def density_rebuild(index):
+    from stalkerbot.density import DensityIndex
+
+    index = DensityIndex(index)
+    rebuilt = index.rebuild()
+    click.echo(f"rebuilt density from {rebuilt} observations")
@@ -0,0 +1,187 @@
+import csv
+import heapq
+import os
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from itertools import count, groupby
+from logging import getLogger
+from operator import itemgetter
+from typing import Iterator
+
+from stalkerbot.dedup import normalize_login
+from stalkerbot.sinks import Sink, open_sink, sibling
+
+logger = getLogger("compaction")
+
+# Rows one process sorts in memory at once
+CHUNK_ROWS = 500_000
+
+# Most runs merged in one pass, more take several passes
+FAN_IN = 64
+
+# Rows handed to the output at a time
+WRITE_ROWS = 10_000
+
+
+@dataclass
+class CompactStats:
+    read: int = 0
+    written: int = 0
+    duplicates: int = 0
+    runs: int = 0
+
+
+def _source(path: str) -> Sink:
+    # Any output stalkerbot writes, including one rotated into numbered parts
+    sink = open_sink(path) if os.path.exists(path) else None
+    if sink is None or sink.empty:
+        try:
+            sink = open_sink(path, rotate_bytes=1 << 20)
+        except ValueError:
+            # SQLite, which is never rotated
+            pass
+    if sink is None or sink.empty:
+        raise ValueError(f"nothing to compact in {path}")
+    return sink
+
+
+def _latest(rows: Iterator[tuple]) -> Iterator[tuple]:
+    # Rows sorted by normalized login and then position, so the last row of
+    # every login is the one written most recently
+    for _, group in groupby(rows, key=itemgetter(0)):
+        for row in group:
+            pass
+        yield row
+
+
+def _write_run(rows: Iterator[tuple], path: str) -> int:
+    written = 0
+    with open(path, "w", encoding="utf-8", newline="") as fp:
+        writer = csv.writer(fp)
+        for row in rows:
+            writer.writerow(row)
+            written += 1
+    return written
+
+
+def _read_run(path: str) -> Iterator[tuple]:
+    with open(path, encoding="utf-8", newline="") as fp:
+        yield from map(tuple, csv.reader(fp))
+
+
+def _sort_run(rows: list, path: str) -> tuple[str, int]:
+    # Runs in a pool process. Rows are (key, position, name, email, login),
+    # the key being the normalized login and the position zero-padded, so
+    # plain tuple order is the order wanted.
+    rows.sort()
+    return path, _write_run(_latest(rows), path)
+
+
+def _merge_runs(paths: list, path: str) -> tuple[str, int]:
+    merged = heapq.merge(*(_read_run(p) for p in paths))
+    written = _write_run(_latest(merged), path)
+    for p in paths:
+        os.remove(p)
+    return path, written
+
+
+def compact(
+    paths: list,
+    output: str = None,
+    output_format: str = None,
+    compression: str = None,
+    workers: int = None,
+    chunk_rows: int = CHUNK_ROWS,
+) -> CompactStats:
+    # Merges outputs into one sorted by login with only the latest row of
+    # every login, compared case-insensitively like the seen index, later
+    # paths and later rows winning, so a .refresh output listed after the one
+    # it refreshed takes precedence. An external merge
+    # sort: chunks of `chunk_rows` are sorted into runs on disk by a process
+    # pool and the runs merged, holding about (workers + 1) * chunk_rows
+    # rows in memory however large the inputs are.
+    if not paths:
+        raise ValueError("nothing to compact")
+    output = output or sibling(paths[0], "compact")
+    if any(os.path.abspath(output) == os.path.abspath(p) for p in paths):
+        raise ValueError("the compacted output cannot be one of the inputs")
+    sources = [_source(path) for path in paths]
+    sink = open_sink(output, format=output_format, compression=compression)
+    if not sink.empty:
+        raise ValueError(f"{output} already has rows")
+    workers = workers or os.cpu_count() or 1
+    stats = CompactStats()
+    # Temporary runs go next to the output, where there is room for it
+    tmp_dir = os.path.dirname(os.path.abspath(output))
+    names = count()
+    with tempfile.TemporaryDirectory(prefix=".compact-", dir=tmp_dir) as tmp:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            runs = []
+            pending = set()
+
+            def submit(fn, *args):
+                nonlocal pending
+                if len(pending) >= workers:
+                    # Keeps chunks waiting for a process from piling up
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    runs.extend(f.result()[0] for f in done)
+                path = os.path.join(tmp, f"{next(names):06d}.run")
+                pending.add(pool.submit(fn, *args, path))
+
+            chunk = []
+            position = count()
+            for source, path in zip(sources, paths):
+                logger.info("reading %s", path)
+                for name, login, email in source.rows():
+                    if not login:
+                        continue
+                    stats.read += 1
+                    chunk.append(
+                        (
+                            normalize_login(login),
+                            f"{next(position):015d}",
+                            name or "",
+                            email or "",
+                            login,
+                        )
+                    )
+                    if len(chunk) >= chunk_rows:
+                        submit(_sort_run, chunk)
+                        chunk = []
+            if chunk:
+                submit(_sort_run, chunk)
+            runs.extend(f.result()[0] for f in wait(pending).done)
+            pending = set()
+            stats.runs = len(runs)
+            logger.info("sorted %i rows into %i runs", stats.read, stats.runs)
+
+            while len(runs) > FAN_IN:
+                groups = [runs[i : i + FAN_IN] for i in range(0, len(runs), FAN_IN)]
+                runs = []
+                for group in groups:
+                    submit(_merge_runs, group)
+                runs.extend(f.result()[0] for f in wait(pending).done)
+                pending = set()
+
+        sink.open()
+        try:
+            batch = []
+            for _, _, name, email, login in _latest(
+                heapq.merge(*(_read_run(run) for run in runs))
+            ):
+                batch.append((name, login, email))
+                if len(batch) >= WRITE_ROWS:
+                    sink.write(batch)
+                    stats.written += len(batch)
+                    batch = []
+            sink.write(batch)
+            stats.written += len(batch)
+            sink.flush(final=True)
+        finally:
+            sink.close()
+    stats.duplicates = stats.read - stats.written
+    logger.info(
+        "compacted %i rows into %i in %s", stats.read, stats.written, output
+    )
+    return stats
@@ -0,0 +1,89 @@
+import asyncio
+import time
+from logging import getLogger
+
+from stalkerbot.retry import OK, RETRYABLE
+
+logger = getLogger("concurrency")
+
+
+# Limits how many requests are in flight and moves the limit AIMD style, like
+# TCP congestion control. Every response that comes back fine and quickly
+# adds `increase / limit`, so about `increase` per round trip, as long as the
+# limit is what holds requests back. A 5xx, secondary limit, timeout or
+# latency (a moving average, so one slow response is not enough) over
+# `tolerance` times the best seen lately multiplies the limit by
+# `decrease`, at most once per round trip so one burst of failures counts
+# once. The limit stays between `floor` and `ceiling`.
+class AIMDLimiter:
+    def __init__(
+        self,
+        floor: int = 1,
+        ceiling: int = 25,
+        initial: int = None,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        tolerance: float = 2.0,
+    ):
+        if not 1 <= floor <= ceiling:
+            raise ValueError("concurrency floor must be at least 1 and at most the ceiling")
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limit = float(min(ceiling, max(floor, initial or 4)))
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.latency: float = None
+        self.baseline: float = None
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._changed: asyncio.Event = None
+
+    def _event(self) -> asyncio.Event:
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    @property
+    def current(self) -> int:
+        return max(self.floor, int(self.limit))
+
+    async def acquire(self):
+        while self.in_flight >= self.current:
+            event = self._event()
+            event.clear()
+            await event.wait()
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._event().set()
+
+    def record(self, outcome: str, latency: float):
+        now = time.monotonic()
+        if outcome == OK:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += 0.2 * (latency - self.latency)
+            if self.baseline is None or self.latency < self.baseline:
+                self.baseline = self.latency
+            else:
+                # Let the baseline drift up slowly so it follows the server
+                self.baseline += 0.01 * (self.latency - self.baseline)
+        if outcome in RETRYABLE or (
+            outcome == OK and self.latency > self.baseline * self.tolerance
+        ):
+            if now - self._last_decrease < (self.latency or latency):
+                return
+            self._last_decrease = now
+            self.decreases += 1
+            limit = max(self.floor, self.limit * self.decrease)
+            if int(limit) != int(self.limit):
+                reason = "slow responses" if outcome == OK else outcome
+                logger.info("%s, concurrency %i -> %i", reason, self.limit, limit)
+            self.limit = limit
+        elif outcome == OK and self.in_flight + 1 >= self.current:
+            self.limit = min(self.ceiling, self.limit + self.increase / self.limit)
+            self._event().set()
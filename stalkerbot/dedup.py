@@ -0,0 +1,160 @@
+import mmap
+import os
+import struct
+import threading
+from hashlib import blake2b
+from logging import getLogger
+
+logger = getLogger("dedup")
+
+_MAGIC = b"SBSEEN01"
+_HEADER = struct.Struct("<8sQQ")
+_SLOT = 8
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def normalize_login(login: str) -> str:
+    # GitHub logins are case-insensitive
+    return login.lower()
+
+
+def fingerprint(kind: str, value: str) -> int:
+    digest = blake2b(f"{kind}:{value}".encode(), digest_size=8).digest()
+    # 0 marks an empty slot
+    return int.from_bytes(digest, "little") or 1
+
+
+# Persistent seen-set of 64 bit fingerprints in a memory-mapped, open
+# addressing hash table. Lookups and inserts touch a handful of slots, and
+# the OS keeps only the pages in use resident, so memory stays bounded as the
+# file grows to hundreds of millions of keys. Collisions between 64 bit
+# fingerprints are negligible at that size. The writer flushes it from its
+# own thread while rows are checked on the event loop, so a lock keeps a
+# flush off a map that is being grown and replaced.
+class SeenIndex:
+    def __init__(self, path: str, capacity: int = 1 << 20, load: float = 0.7):
+        self.path = path
+        self.load = load
+        self._lock = threading.RLock()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            self._create(path, _power_of_two(capacity))
+        self._open()
+
+    def _create(self, path: str, capacity: int):
+        head, _ = os.path.split(path)
+        if head:
+            os.makedirs(head, exist_ok=True)
+        with open(path, "wb") as fp:
+            fp.write(_HEADER.pack(_MAGIC, capacity, 0))
+            fp.truncate(_HEADER.size + capacity * _SLOT)
+
+    def _open(self):
+        self._fp = open(self.path, "r+b")
+        self._mm = mmap.mmap(self._fp.fileno(), 0)
+        magic, self.capacity, self.count = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{self.path} is not a seen index")
+        self._slots = memoryview(self._mm)[_HEADER.size :].cast("Q")
+        self._mask = self.capacity - 1
+
+    def _close(self):
+        self._slots.release()
+        self._mm.close()
+        self._fp.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, key: int) -> bool:
+        slots, mask = self._slots, self._mask
+        i = key & mask
+        while True:
+            slot = slots[i]
+            if slot == key:
+                return True
+            if slot == 0:
+                return False
+            i = (i + 1) & mask
+
+    def add(self, key: int) -> bool:
+        # True if the key was not there before
+        slots, mask = self._slots, self._mask
+        i = key & mask
+        while True:
+            slot = slots[i]
+            if slot == key:
+                return False
+            if slot == 0:
+                slots[i] = key
+                self.count += 1
+                if self.count > self.capacity * self.load:
+                    self._grow()
+                return True
+            i = (i + 1) & mask
+
+    def seen(self, login: str, email: str = None) -> bool:
+        # True if this login or email was written before, otherwise both are
+        # recorded and False is returned
+        keys = [fingerprint("login", normalize_login(login))]
+        if email:
+            keys.append(fingerprint("email", normalize_email(email)))
+        with self._lock:
+            if any(key in self for key in keys):
+                return True
+            for key in keys:
+                self.add(key)
+        return False
+
+    def _grow(self):
+        capacity = self.capacity * 2
+        logger.debug("growing %s to %i slots", self.path, capacity)
+        tmp = self.path + ".tmp"
+        self._create(tmp, capacity)
+        with open(tmp, "r+b") as fp:
+            mm = mmap.mmap(fp.fileno(), 0)
+            slots = memoryview(mm)[_HEADER.size :].cast("Q")
+            mask = capacity - 1
+            for key in self._slots:
+                if key == 0:
+                    continue
+                i = key & mask
+                while slots[i] != 0:
+                    i = (i + 1) & mask
+                slots[i] = key
+            slots.release()
+            _HEADER.pack_into(mm, 0, _MAGIC, capacity, self.count)
+            mm.flush()
+            mm.close()
+        self._close()
+        os.replace(tmp, self.path)
+        self._open()
+
+    def flush(self):
+        with self._lock:
+            _HEADER.pack_into(self._mm, 0, _MAGIC, self.capacity, self.count)
+            self._mm.flush()
+
+    def clear(self):
+        with self._lock:
+            self._close()
+            self._create(self.path, self.capacity)
+            self._open()
+
+    def rebuild(self, rows):
+        # rows of (login, email)
+        self.clear()
+        for login, email in rows:
+            self.seen(login, email)
+        self.flush()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._close()
+
+
+def _power_of_two(n: int) -> int:
+    return 1 << max(n - 1, 1).bit_length()
@@ -0,0 +1,170 @@
+import sqlite3
+from datetime import datetime, timedelta
+from logging import getLogger
+
+logger = getLogger("density")
+
+DAY = timedelta(days=1)
+
+# GitHub never returns more than this many results for one search
+RESULT_CAP = 1000
+
+# Share of the cap the planner aims for, leaving room for estimation error
+PLAN_FILL = 0.9
+
+
+def _day(t: datetime) -> datetime:
+    return datetime(t.year, t.month, t.day)
+
+
+# On-disk index of observed userCount per day per query. Every window a search
+# returns is stored as an observation and spread evenly over the days it
+# covers. A day keeps the estimate from the observation that lies most within
+# it (newer wins ties), since that one says the most about that day alone.
+# The planner walks this back from a window's end to find the start that
+# lands just under the result cap.
+class DensityIndex:
+    def __init__(self, path: str = ".density"):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS observations (
+                query TEXT, start TEXT, end TEXT, count INTEGER, observed_at TEXT,
+                PRIMARY KEY (query, start, end)
+            );
+            CREATE TABLE IF NOT EXISTS density (
+                query TEXT, day TEXT, count REAL, weight REAL,
+                PRIMARY KEY (query, day)
+            );
+            """
+        )
+        self._days: dict[str, dict[datetime, tuple[float, float]]] = {}
+
+    def _load(self, query: str) -> dict:
+        if query not in self._days:
+            rows = self.conn.execute(
+                "SELECT day, count, weight FROM density WHERE query = ?", (query,)
+            )
+            self._days[query] = {
+                datetime.fromisoformat(day): (count, weight)
+                for day, count, weight in rows
+            }
+        return self._days[query]
+
+    def observe(self, query: str, start: datetime, end: datetime, count: int):
+        if end <= start:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO observations VALUES (?, ?, ?, ?, ?)",
+            (
+                query,
+                start.isoformat(),
+                end.isoformat(),
+                count,
+                datetime.utcnow().isoformat(),
+            ),
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO density VALUES (?, ?, ?, ?)",
+            [
+                (query, day.isoformat(), per_day, weight)
+                for day, per_day, weight in self._spread(query, start, end, count)
+            ],
+        )
+        self.conn.commit()
+
+    def _spread(self, query: str, start: datetime, end: datetime, count: int):
+        days = self._load(query)
+        span = end - start
+        rate = count / (span / DAY)
+        day = _day(start)
+        while day < end:
+            # Share of the observation that falls on this day
+            weight = (min(end, day + DAY) - max(start, day)) / span
+            known = days.get(day)
+            if known is None or weight >= known[1]:
+                days[day] = (rate, weight)
+                yield day, rate, weight
+            day += DAY
+
+    def estimate(self, query: str, start: datetime, end: datetime) -> float:
+        days = self._load(query)
+        total = 0.0
+        day = _day(start)
+        while day < end:
+            known = days.get(day)
+            if known is None:
+                return None
+            overlap = min(end, day + DAY) - max(start, day)
+            total += known[0] * (overlap / DAY)
+            day += DAY
+        return total
+
+    def plan(
+        self,
+        query: str,
+        end: datetime,
+        since: datetime,
+        cap: int = RESULT_CAP,
+        fill: float = PLAN_FILL,
+        min_window: timedelta = timedelta(minutes=1),
+    ) -> datetime:
+        # Start of the widest window ending at `end` that is expected to hold
+        # at most fill * cap users, or None when the index has nothing to go on.
+        days = self._load(query)
+        target = cap * fill
+        total = 0.0
+        t = end
+        while t > since:
+            day = _day(t - timedelta(microseconds=1))
+            known = days.get(day)
+            if known is None:
+                if total == 0:
+                    return None
+                break
+            lower = max(day, since)
+            expected = known[0] * ((t - lower) / DAY)
+            if total + expected > target:
+                t -= DAY * ((target - total) / known[0])
+                break
+            total += expected
+            t = lower
+        return min(max(t, since), end - min_window)
+
+    def rebuild(self):
+        self.conn.execute("DELETE FROM density")
+        self._days = {}
+        rows = self.conn.execute(
+            "SELECT query, start, end, count FROM observations ORDER BY observed_at"
+        ).fetchall()
+        for query, start, end, count in rows:
+            start, end = datetime.fromisoformat(start), datetime.fromisoformat(end)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO density VALUES (?, ?, ?, ?)",
+                [
+                    (query, day.isoformat(), per_day, weight)
+                    for day, per_day, weight in self._spread(query, start, end, count)
+                ],
+            )
+        self.conn.commit()
+        return len(rows)
+
+    def queries(self) -> list[tuple[str, int, int]]:
+        return self.conn.execute(
+            "SELECT d.query, COUNT(*), (SELECT COUNT(*) FROM observations o"
+            " WHERE o.query = d.query) FROM density d GROUP BY d.query ORDER BY d.query"
+        ).fetchall()
+
+    def summary(self, query: str, by: str = "month") -> list[tuple[str, float, int]]:
+        width = {"year": 4, "month": 7, "day": 10}[by]
+        return self.conn.execute(
+            "SELECT substr(day, 1, ?) AS period, SUM(count), COUNT(*) FROM density"
+            " WHERE query = ? GROUP BY period ORDER BY period",
+            (width, query),
+        ).fetchall()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,78 @@
+import re
+from dataclasses import dataclass
+
+SORTS = ("followers", "repositories", "joined")
+ORDERS = ("asc", "desc")
+
+# A count, a comparison like >100 or <=5, or a range like 10..50 or 10..*
+_RANGE = re.compile(r"(?:[<>]=?)?\d+|(?:\d+|\*)\.\.(?:\d+|\*)")
+
+
+def _range(name: str, value: str) -> str:
+    value = str(value).replace(" ", "")
+    if not _RANGE.fullmatch(value):
+        raise ValueError(
+            f"{name} must be a number, a comparison like >100 or a range like 10..50"
+        )
+    return f"{name}:{value}"
+
+
+def _text(name: str, value: str) -> str:
+    value = value.strip()
+    if '"' in value:
+        raise ValueError(f"{name} cannot contain quotes")
+    return f'{name}:"{value}"' if " " in value else f"{name}:{value}"
+
+
+# What users to crawl beyond the query itself. Everything GitHub search can
+# evaluate is compiled into qualifiers, so users that do not match never
+# cost a page. The email pattern is not something search can do and is
+# applied by the parser, before any user is built.
+@dataclass
+class Filters:
+    followers: str = None
+    repos: str = None
+    location: str = None
+    language: str = None
+    sort: str = None
+    order: str = "desc"
+    email: str = None
+
+    def __post_init__(self):
+        if self.sort is not None and self.sort not in SORTS:
+            raise ValueError(f"sort must be one of {', '.join(SORTS)}")
+        if self.order not in ORDERS:
+            raise ValueError(f"order must be one of {', '.join(ORDERS)}")
+        if self.email is not None:
+            try:
+                re.compile(self.email)
+            except re.error as e:
+                raise ValueError(f"bad email pattern {self.email!r}: {e}")
+        # Fail on a bad value now rather than at the first search
+        self.qualifiers()
+
+    def qualifiers(self) -> list[str]:
+        qualifiers = []
+        if self.followers is not None:
+            qualifiers.append(_range("followers", self.followers))
+        if self.repos is not None:
+            qualifiers.append(_range("repos", self.repos))
+        if self.location:
+            qualifiers.append(_text("location", self.location))
+        if self.language:
+            qualifiers.append(_text("language", self.language))
+        return qualifiers
+
+    def apply(self, query: str) -> str:
+        # Leaves qualifiers the query already has alone, so applying the
+        # filters to a resumed query changes nothing
+        for qualifier in self.qualifiers():
+            if not re.search(rf"(?<!\S){re.escape(qualifier)}(?!\S)", query):
+                query = f"{query} {qualifier}"
+        return query
+
+    @property
+    def sort_qualifier(self) -> str:
+        if self.sort is None:
+            return None
+        return f"sort:{self.sort}-{self.order}"
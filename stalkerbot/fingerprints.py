@@ -0,0 +1,143 @@
+import sqlite3
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from hashlib import blake2b
+from logging import getLogger
+from typing import NamedTuple
+
+from stalkerbot.utils import QueryResponse
+
+logger = getLogger("fingerprints")
+
+# Windows ending later than this before now are not recorded, signups that
+# recent may not all be searchable yet
+SETTLE = timedelta(days=1)
+
+
+class Fingerprint(NamedTuple):
+    count: int
+    digest: str
+    page_size: int
+
+
+# Put in the output after the rows of the windows recorded so far, see
+# WindowFingerprints.commit
+class Recorded(NamedTuple):
+    upto: int
+
+
+def window_fingerprint(response: QueryResponse, page_size: int) -> Fingerprint:
+    # userCount and the users with an email on the first page. A page of
+    # `last: page_size` always holds the newest signups in the window, so
+    # asking for the same size again gives the same page unless something
+    # in the window changed.
+    digest = blake2b(digest_size=8)
+    for user in response.users:
+        digest.update(f"{user.login}\0{user.email or ''}\n".encode())
+    return Fingerprint(response.userCount, digest.hexdigest(), page_size)
+
+
+# On-disk record of the historical created: windows already crawled into an
+# output, with the fingerprint of each one's first page. A re-crawl cuts its
+# ranges along the recorded windows and fetches just the first page of each;
+# when the fingerprint still matches, the rest of the window is skipped.
+# New fingerprints are held back until commit(), called once the rows they
+# cover are journaled (or at the end of a crawl with no output), and
+# replace any recorded window they overlap so the windows of one query never
+# overlap. With `recheck` nothing is skipped but fingerprints are still
+# recorded.
+class WindowFingerprints:
+    def __init__(self, path: str = ".windows", recheck: bool = False):
+        self.path = path
+        self.recheck = recheck
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS windows (
+                query TEXT, start TEXT, end TEXT, count INTEGER, digest TEXT,
+                page_size INTEGER, crawled_at TEXT,
+                PRIMARY KEY (query, start, end)
+            )
+            """
+        )
+        self._windows: dict[str, dict[tuple[datetime, datetime], Fingerprint]] = {}
+        self._starts: dict[str, list[tuple[datetime, datetime]]] = {}
+        self.pending: list[tuple[str, datetime, datetime, Fingerprint]] = []
+        # Windows recorded so far, pending or committed
+        self.recorded = 0
+
+    def _load(self, query: str) -> dict:
+        if query not in self._windows:
+            rows = self.conn.execute(
+                "SELECT start, end, count, digest, page_size FROM windows"
+                " WHERE query = ?",
+                (query,),
+            )
+            self._windows[query] = {
+                (datetime.fromisoformat(start), datetime.fromisoformat(end)): Fingerprint(
+                    count, digest, page_size
+                )
+                for start, end, count, digest, page_size in rows
+            }
+            self._starts[query] = sorted(self._windows[query])
+        return self._windows[query]
+
+    def get(self, query: str, start: datetime, end: datetime) -> Fingerprint:
+        if self.recheck:
+            return None
+        return self._load(query).get((start, end))
+
+    def within(
+        self, query: str, start: datetime, end: datetime
+    ) -> list[tuple[datetime, datetime]]:
+        # Recorded windows that lie inside start..end, oldest first
+        if self.recheck:
+            return []
+        self._load(query)
+        starts = self._starts[query]
+        windows = []
+        for window in starts[bisect_left(starts, (start, start)) :]:
+            if window[0] >= end:
+                break
+            if window[1] <= end:
+                windows.append(window)
+        return windows
+
+    def record(self, query: str, start: datetime, end: datetime, fingerprint: Fingerprint):
+        if end > datetime.utcnow() - SETTLE:
+            return
+        self.pending.append((query, start, end, fingerprint))
+        self.recorded += 1
+
+    def commit(self, upto: int = None):
+        # Commits the windows among the first `upto` recorded, or all of them
+        count = len(self.pending)
+        if upto is not None:
+            count = min(count, upto - (self.recorded - len(self.pending)))
+        if count <= 0:
+            return
+        now = datetime.utcnow().isoformat()
+        for query, start, end, fingerprint in self.pending[:count]:
+            self.conn.execute(
+                "DELETE FROM windows WHERE query = ? AND start < ? AND end > ?",
+                (query, end.isoformat(), start.isoformat()),
+            )
+            self.conn.execute(
+                "INSERT INTO windows VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (query, start.isoformat(), end.isoformat(), *fingerprint, now),
+            )
+            self._windows.pop(query, None)
+        self.conn.commit()
+        logger.debug("recorded %i window fingerprints", count)
+        self.pending = self.pending[count:]
+
+    def clear(self):
+        self.conn.execute("DELETE FROM windows")
+        self.conn.commit()
+        self._windows = {}
+        self.pending = []
+
+    def close(self):
+        self.conn.close()
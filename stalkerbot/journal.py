@@ -0,0 +1,161 @@
+import json
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from logging import getLogger
+
+from stalkerbot.dedup import SeenIndex
+from stalkerbot.sinks import Sink
+from stalkerbot.utils import State
+
+logger = getLogger("journal")
+
+
+def _time(t: datetime) -> str:
+    return t.isoformat() if t is not None else None
+
+
+def _parse_time(t: str) -> datetime:
+    return datetime.fromisoformat(t) if t is not None else None
+
+
+def dump_state(state: State) -> dict:
+    return {
+        "continue_from": _time(state.continue_from),
+        "query": state.query,
+        "cursor": state.cursor,
+        "since": _time(state.since),
+        "window_start": _time(state.window_start),
+    }
+
+
+def load_state(data: dict) -> State:
+    return State(
+        continue_from=_parse_time(data["continue_from"]),
+        query=data["query"],
+        cursor=data["cursor"],
+        since=_parse_time(data["since"]),
+        window_start=_parse_time(data["window_start"]),
+    )
+
+
+@dataclass
+class Checkpoint:
+    # Output is durable up to the sink's `position` and every shard's state
+    # covers exactly the rows before it
+    position: object
+    rows: int
+    states: list = field(default_factory=list)
+    clean: bool = False
+
+    @property
+    def pending(self) -> list:
+        # Finished shards are marked with continue_from == since
+        return [s for s in self.states if s.continue_from != s.since]
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {
+                "position": self.position,
+                "rows": self.rows,
+                "states": [dump_state(s) for s in self.states],
+                "clean": self.clean,
+            }
+        )
+
+    @classmethod
+    def loads(cls, line: str) -> "Checkpoint":
+        data = json.loads(line)
+        return cls(
+            position=data["position"],
+            rows=data["rows"],
+            states=[load_state(s) for s in data["states"]],
+            clean=data.get("clean", False),
+        )
+
+
+# Append-only log of checkpoints, one JSON line per durable flush. A record is
+# only appended after the rows it covers were written, so the last complete
+# line always describes output that exists. A torn last line from a crash is
+# ignored. The log is compacted down to its last record every
+# `compact_every` commits and on close.
+class Journal:
+    def __init__(self, path: str, compact_every: int = 1000):
+        self.path = path
+        self.compact_every = compact_every
+        head, _ = os.path.split(path)
+        if head:
+            os.makedirs(head, exist_ok=True)
+        self.last = self.replay(path)
+        self._appended = 0
+        self._fp = None
+        # Drops any torn tail so new records start on a fresh line
+        self.compact()
+
+    @staticmethod
+    def replay(path: str) -> Checkpoint:
+        last = None
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as fp:
+            for line in fp:
+                try:
+                    last = Checkpoint.loads(line)
+                except (ValueError, KeyError, TypeError):
+                    logger.warning("ignoring torn journal record in %s", path)
+                    break
+        return last
+
+    def commit(
+        self,
+        position,
+        rows: int,
+        states: list,
+        sync: bool = False,
+        clean: bool = False,
+    ) -> Checkpoint:
+        total = rows + (self.last.rows if self.last is not None else 0)
+        self.last = Checkpoint(position, total, list(states), clean)
+        self._fp.write(self.last.dumps() + "\n")
+        self._fp.flush()
+        if sync:
+            os.fsync(self._fp.fileno())
+        self._appended += 1
+        if self._appended >= self.compact_every:
+            self.compact()
+        return self.last
+
+    def compact(self):
+        if self._fp is not None:
+            self._fp.close()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fp:
+            if self.last is not None:
+                fp.write(self.last.dumps() + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.path)
+        self._fp = open(self.path, "a", encoding="utf-8")
+        self._appended = 0
+
+    def reset(self):
+        self.last = None
+        self.compact()
+
+    def recover(self, sink: Sink, seen: SeenIndex = None) -> Checkpoint:
+        # Cuts the output back to the last committed position. Rows past it
+        # belong to pages whose state was never recorded and will be fetched
+        # again, so the seen index is rebuilt to forget them.
+        last = self.last
+        if last is None:
+            return None
+        dropped = sink.restore(last.position)
+        if seen is not None and (dropped or not last.clean):
+            logger.info("rebuilding %s from the output", seen.path)
+            seen.rebuild((login, email) for _, login, email in sink.rows())
+        return last
+
+    def close(self):
+        self.compact()
+        self._fp.close()
+
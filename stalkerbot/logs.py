@@ -0,0 +1,40 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+FORMAT = "%(asctime)s %(levelname)-8s %(name)-15s %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_listener: logging.handlers.QueueListener = None
+
+
+# Records are put on a queue by the thread that logs them and written to
+# `path` by a listener thread, so logging never blocks the event loop on
+# the disk. Only the CLI calls this; importing stalkerbot leaves logging
+# to whoever embeds it.
+def setup_logging(
+    level: str = "INFO",
+    path: str = "stalkerbot.log",
+    max_bytes: int = 10 << 20,
+    backups: int = 5,
+):
+    global _listener
+    if _listener is not None:
+        return
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    if not path:
+        return
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+    records = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    # Flushes what is still queued when the process exits
+    atexit.register(_listener.stop)
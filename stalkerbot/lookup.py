@@ -0,0 +1,158 @@
+import asyncio
+from asyncio.queues import Queue
+from dataclasses import dataclass
+from itertools import islice
+from logging import getLogger
+
+from stalkerbot.concurrency import AIMDLimiter
+from stalkerbot.dedup import fingerprint, normalize_login
+from stalkerbot.exc import RateLimitExceededException
+from stalkerbot.metrics import Metrics
+from stalkerbot.ratelimit import RateLimitBudget
+from stalkerbot.retry import Backoff, CircuitBreaker, retryable
+from stalkerbot.scheduler import FairQueue
+from stalkerbot.sinks import Sink, open_sink, sibling
+from stalkerbot.transport import Transport
+from stalkerbot.utils import GRAPHQL_URL, ParsedData, UserRequest
+from stalkerbot.workers import OutputWriter, StalkerWorker
+
+logger = getLogger("lookup")
+
+# Aliased user lookups per request. The whole request costs one point
+# however many there are, 100 keeps responses small.
+LOOKUPS_PER_REQUEST = 100
+
+
+@dataclass
+class RefreshStats:
+    checked: int = 0
+    changed: int = 0
+    missing: int = 0
+    failed: int = 0
+    points: int = 0
+
+
+def _row(name: str, email: str) -> int:
+    return fingerprint("row", f"{name or ''}\0{email or ''}")
+
+
+def _latest(sinks: list[Sink]) -> dict[int, int]:
+    # Login fingerprint -> fingerprint of the last name and email written for
+    # it. Two ints per login, so millions of logins take a few hundred MB.
+    latest = {}
+    for sink in sinks:
+        for name, login, email in sink.rows():
+            if login:
+                latest[fingerprint("login", normalize_login(login))] = _row(name, email)
+    return latest
+
+
+async def refresh(
+    path: str,
+    token: str,
+    output: str = None,
+    output_format: str = None,
+    compression: str = None,
+    batch_size: int = LOOKUPS_PER_REQUEST,
+    endpoint: str = GRAPHQL_URL,
+    max_concurrency: int = 25,
+    max_retries: int = 5,
+    silent: bool = True,
+    metrics: Metrics = None,
+) -> RefreshStats:
+    # Looks up the current name and email of every login in the output at
+    # `path` and appends the users whose row changed to `output`, by default
+    # PATH with .refresh before the extension. Rows already in `output` count
+    # as the latest, so running it again only writes what changed since.
+    # Users that no longer exist are counted and left alone.
+    loop = asyncio.get_running_loop()
+    source = open_sink(path)
+    if source.empty:
+        raise ValueError(f"nothing to refresh in {path}")
+    sink = open_sink(
+        output or sibling(path, "refresh"), format=output_format, compression=compression
+    )
+    known = [source] if sink.empty else [source, sink]
+    latest = await loop.run_in_executor(None, _latest, known)
+    logger.info("refreshing %i logins from %s", len(latest), path)
+
+    metrics = metrics or Metrics()
+    budget = RateLimitBudget()
+    worker = StalkerWorker(
+        Queue(),
+        transport=Transport(max_concurrent=max_concurrency),
+        budget=budget,
+        token=token,
+        batch_size=batch_size,
+        endpoint=endpoint,
+        metrics=metrics,
+        breaker=CircuitBreaker(),
+        limiter=AIMDLimiter(ceiling=max_concurrency),
+    )
+    requests = FairQueue()
+    writer_queue = Queue(maxsize=1000)
+    writer = OutputWriter(writer_queue, sink=sink, silent=silent, metrics=metrics)
+    worker_task = loop.create_task(worker.astart(requests), name="worker")
+    writer_task = loop.create_task(writer.astart(), name="writer")
+    stats = RefreshStats()
+    # Enough lookups waiting to fill every request allowed in flight
+    slots = asyncio.Semaphore(batch_size * max_concurrency)
+    pending = set()
+
+    async def lookup(login: str) -> ParsedData:
+        backoff = Backoff(base=1)
+        for attempt in range(max_retries):
+            try:
+                return await worker.request(requests, UserRequest(login))
+            except Exception as e:
+                if not retryable(e) or attempt + 1 == max_retries:
+                    raise
+                if not isinstance(e, RateLimitExceededException):
+                    await asyncio.sleep(backoff.delay(attempt))
+
+    async def check(login: str, expected: int):
+        try:
+            user = await lookup(login)
+        except Exception as e:
+            stats.failed += 1
+            logger.warning("could not refresh %s: %r", login, e)
+            return
+        finally:
+            slots.release()
+        stats.checked += 1
+        if user is None:
+            stats.missing += 1
+        elif _row(user.name, user.email) != expected:
+            stats.changed += 1
+            await writer_queue.put(user)
+
+    rows = source.rows()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, list, islice(rows, 1000))
+            if not chunk:
+                break
+            for _, login, _ in chunk:
+                if not login:
+                    continue
+                # Popped so a login listed twice is only looked up once
+                key = fingerprint("login", normalize_login(login))
+                expected = latest.pop(key, None)
+                if expected is None:
+                    continue
+                await slots.acquire()
+                task = loop.create_task(check(login, expected))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.wait(pending)
+    finally:
+        for task in pending:
+            task.cancel()
+        worker.stop()
+        requests.put_nowait(None)
+        await worker_task
+        writer.stop()
+        await writer_task
+    stats.points = budget.spent
+    return stats
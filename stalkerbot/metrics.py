@@ -0,0 +1,220 @@
+import asyncio
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from logging import getLogger
+from typing import Callable
+
+logger = getLogger("metrics")
+
+# Upper bounds in seconds, +Inf is implied
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    "stalkerbot_request_seconds": "GraphQL request latency",
+    "stalkerbot_responses_total": "GraphQL responses by HTTP status",
+    "stalkerbot_retries_total": "Retried requests by reason and HTTP status, and re-queued pages",
+    "stalkerbot_budget_wait_seconds": "Time spent waiting for rate limit points",
+    "stalkerbot_parse_seconds": "Time to parse one batched response",
+    "stalkerbot_batch_searches": "Searches sent together in one request",
+    "stalkerbot_searches_total": "Searches sent by kind, probe or page",
+    "stalkerbot_window_splits_total": "Search windows split for holding too many users",
+    "stalkerbot_windows_skipped_total": "Windows crawled before skipped after one page as unchanged",
+    "stalkerbot_write_seconds": "Time to flush one chunk to the output",
+    "stalkerbot_rows_written_total": "Rows written to the output",
+    "stalkerbot_duplicates_total": "Rows skipped as already written",
+    "stalkerbot_queue_depth": "Items waiting in each queue",
+    "stalkerbot_requests_in_flight": "Requests currently in flight",
+    "stalkerbot_points_spent": "Rate limit points spent",
+    "stalkerbot_points_remaining": "Rate limit points left in this window",
+    "stalkerbot_points_per_email": "Rate limit points spent per row written",
+    "stalkerbot_query_searches": "Searches sent for each query, the share of points it got",
+    "stalkerbot_concurrency_limit": "Requests allowed in flight at once right now",
+    "stalkerbot_circuit_open": "1 while requests are held back after repeated failures",
+    "stalkerbot_page_size": "Page size searches currently ask for",
+    "stalkerbot_loop_lag_seconds": "How late the event loop ran a timer, with --profile",
+}
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    # Label values are quoted, queries can hold quotes, backslashes and newlines
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket the quantile falls in
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+# Counters, histograms and gauges for one crawl. Counters and histograms are
+# updated where things happen; gauges are functions sampled at export time, so
+# queue depths and budget figures cost nothing between exports.
+class Metrics:
+    def __init__(self):
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self.gauges: dict[tuple[str, tuple], Callable[[], float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple = DEFAULT_BUCKETS, **labels):
+        key = (name, _labels(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name: str, fn: Callable[[], float], **labels):
+        self.gauges[(name, _labels(labels))] = fn
+
+    def _sample(self) -> dict:
+        values = {}
+        for key, fn in self.gauges.items():
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if value is not None:
+                values[key] = value
+        return values
+
+    def prometheus(self) -> str:
+        lines = []
+        described = set()
+
+        def describe(name: str, kind: str):
+            if name not in described:
+                described.add(name)
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            describe(name, "counter")
+            lines.append(f"{name}{_format(labels)} {value}")
+        for (name, labels), value in sorted(self._sample().items()):
+            describe(name, "gauge")
+            lines.append(f"{name}{_format(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            describe(name, "histogram")
+            total = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                total += count
+                lines.append(f"{name}_bucket{_format(labels, (('le', bound),))} {total}")
+            lines.append(
+                f"{name}_bucket{_format(labels, (('le', '+Inf'),))} {histogram.count}"
+            )
+            lines.append(f"{name}_sum{_format(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_format(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        def key(name: str, labels: tuple) -> str:
+            return name + _format(labels)
+
+        return {
+            "time": time.time(),
+            "counters": {key(*k): v for k, v in sorted(self.counters.items())},
+            "gauges": {key(*k): v for k, v in sorted(self._sample().items())},
+            "histograms": {
+                key(*k): {
+                    "count": h.count,
+                    "sum": h.sum,
+                    "p50": h.quantile(0.5),
+                    "p95": h.quantile(0.95),
+                    "p99": h.quantile(0.99),
+                }
+                for k, h in sorted(self.histograms.items())
+            },
+        }
+
+    def write(self, path: str):
+        if path.endswith(".json"):
+            text = json.dumps(self.snapshot(), indent=2)
+        else:
+            text = self.prometheus()
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fp:
+            fp.write(text)
+        os.replace(tmp, path)
+
+
+# Shared by everything that is not handed its own registry
+default_metrics = Metrics()
+
+
+async def export(
+    metrics: Metrics, path: str = None, port: int = None, interval: float = 10
+):
+    # Rewrites `path` every `interval` seconds, as JSON if it ends in .json
+    # and Prometheus text otherwise, and serves /metrics on `port`. Runs
+    # until cancelled, writing once more on the way out.
+    runner = None
+    if port:
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(
+                text=metrics.prometheus(), content_type="text/plain", charset="utf-8"
+            )
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, port=port).start()
+        logger.info("serving metrics on port %i", port)
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            if path:
+                await loop.run_in_executor(None, metrics.write, path)
+            await asyncio.sleep(interval)
+    finally:
+        if path:
+            metrics.write(path)
+        if runner is not None:
+            await runner.cleanup()
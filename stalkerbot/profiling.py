@@ -0,0 +1,202 @@
+import asyncio
+import cProfile
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from logging import getLogger
+
+from stalkerbot.metrics import Metrics
+
+logger = getLogger("profiling")
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+PROFILE_MODES = ("sample", "cprofile")
+
+# Innermost frames of a thread with nothing to do
+_IDLE = {
+    ("select", "selectors.py"),
+    ("poll", "selectors.py"),
+    ("wait", "threading.py"),
+    ("_worker", "thread.py"),
+    # The logging listener waiting on its queue
+    ("dequeue", "handlers.py"),
+}
+
+
+def _task_name(loop: asyncio.AbstractEventLoop) -> str:
+    # Read from another thread, good enough for attributing samples
+    task = getattr(asyncio.tasks, "_current_tasks", {}).get(loop)
+    if task is None:
+        return "loop"
+    name = task.get_name()
+    # Unnamed helper tasks, e.g. from wait_for, are lumped together
+    return "task" if name.startswith("Task-") else name
+
+
+def _frame(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+# A heartbeat scheduled on the loop every `interval` seconds and a watchdog
+# thread watching it. If the heartbeat is late by more than `threshold` the
+# watchdog logs the loop thread's stack, which is whatever is holding the
+# loop, and once the loop is back the heartbeat records how late it was.
+class StallMonitor:
+    def __init__(
+        self, threshold: float = 0.1, interval: float = 0.02, metrics: Metrics = None
+    ):
+        self.threshold = threshold
+        self.interval = interval
+        self.metrics = metrics
+        self.stalls = 0
+        self.worst = 0.0
+        self._stopped = threading.Event()
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self._last = time.monotonic()
+        self._due = self._last + self.interval
+        self._handle = loop.call_later(self.interval, self._tick)
+        self._thread = threading.Thread(
+            target=self._watch, name="stall-monitor", daemon=True
+        )
+        self._thread.start()
+
+    def _tick(self):
+        now = time.monotonic()
+        lag = max(0.0, now - self._due)
+        if self.metrics is not None:
+            self.metrics.observe("stalkerbot_loop_lag_seconds", lag, buckets=LAG_BUCKETS)
+        if lag > self.threshold:
+            self.stalls += 1
+            self.worst = max(self.worst, lag)
+            logger.warning("event loop was blocked for %.0fms", lag * 1000)
+        self._last = now
+        self._due = now + self.interval
+        self._handle = self.loop.call_later(self.interval, self._tick)
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.interval):
+            last = self._last
+            if time.monotonic() - last < self.threshold + self.interval or reported == last:
+                continue
+            reported = last
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            logger.warning(
+                "event loop blocked for over %.0fms in %s:\n%s",
+                self.threshold * 1000,
+                _task_name(self.loop),
+                "".join(traceback.format_stack(frame)),
+            )
+
+    def stop(self):
+        self._stopped.set()
+        self._handle.cancel()
+        self._thread.join()
+        if self.stalls:
+            logger.info(
+                "event loop stalled %i times, worst %.0fms", self.stalls, self.worst * 1000
+            )
+
+
+# Samples every thread's stack every `interval` seconds. Samples from the loop
+# thread are filed under the task running at the time (worker, writer,
+# search-N, fetch) and samples from other threads under the thread's name, so
+# the output splits time by pipeline stage. Idle threads are only counted.
+# Written as collapsed stacks, one "stage;outer;...;inner count" line per
+# distinct stack, which flame graph tools read directly.
+class Sampler:
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.idle = 0
+        self._stopped = threading.Event()
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or names.get(ident) == "stall-monitor":
+                    continue
+                if ident == self.loop_thread:
+                    stage = _task_name(self.loop)
+                else:
+                    stage = names.get(ident, str(ident))
+                code = frame.f_code
+                if (code.co_name, os.path.basename(code.co_filename)) in _IDLE:
+                    self.idle += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame(frame.f_code))
+                    frame = frame.f_back
+                stack.append(stage)
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def stages(self) -> Counter:
+        stages = Counter()
+        for stack, count in self.samples.items():
+            stages[stack.split(";", 1)[0]] += count
+        return stages
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as fp:
+            for stack, count in self.samples.most_common():
+                fp.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    def __init__(
+        self,
+        output: str = "stalkerbot.profile",
+        mode: str = "sample",
+        threshold: float = 0.1,
+        metrics: Metrics = None,
+    ):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"profile mode must be one of {', '.join(PROFILE_MODES)}")
+        self.output = output
+        self.mode = mode
+        self.monitor = StallMonitor(threshold=threshold, metrics=metrics)
+        self.sampler = Sampler() if mode == "sample" else None
+        self.profile = cProfile.Profile() if mode == "cprofile" else None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.monitor.start(loop)
+        if self.sampler is not None:
+            self.sampler.start(loop)
+        if self.profile is not None:
+            # Only sees the loop thread, sample mode covers the others
+            self.profile.enable()
+
+    def stop(self):
+        self.monitor.stop()
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.output)
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.write(self.output)
+            total = sum(self.sampler.samples.values()) or 1
+            for stage, count in self.sampler.stages().most_common(10):
+                logger.info("%-16s %5.1f%% of samples", stage, 100 * count / total)
+        logger.info("wrote %s profile to %s", self.mode, self.output)
@@ -0,0 +1,130 @@
+import asyncio
+import datetime
+import math
+from logging import getLogger
+
+from stalkerbot.utils import RateLimit
+
+logger = getLogger("ratelimit")
+
+
+# Point budget shared by every request in the process. Requests reserve their
+# expected cost before going out and responses settle it with the rateLimit
+# block GitHub sends back. While plenty of points are left requests go out
+# straight away; once fewer than `burst` remain, the rest are spread evenly
+# over the time left until the reset instead of running down to zero. Once a
+# window gets down to its last `burst` points before the reset the crawl is
+# bound by the budget, and later windows are paced from the start: that
+# spends as many points, and requests then wait for each grant where the
+# FairQueue can share the points out by weight. A window that ends with more
+# than `burst` to spare goes back to bursting.
+class RateLimitBudget:
+    def __init__(self, limit: int = 5000, burst: float = 0.1, margin: float = 1.0):
+        self.limit = limit
+        self.burst = int(limit * burst)
+        self.margin = margin
+        self.remaining: int = None
+        self.reset_at: datetime.datetime = None
+        self.cost = 1
+        self.reserved = 0
+        self.spent = 0
+        self.bound = False
+        self._last_grant: datetime.datetime = None
+        self._changed: asyncio.Event = None
+
+    @property
+    def available(self) -> int:
+        if self.remaining is None:
+            return self.limit - self.reserved
+        return self.remaining - self.reserved
+
+    def _event(self) -> asyncio.Event:
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    def _roll_over(self, now: datetime.datetime):
+        if self.reset_at is not None and now >= self.reset_at:
+            logger.debug("rate limit window reset")
+            if self.remaining is not None and self.remaining > self.burst:
+                self.bound = False
+            self.remaining = None
+            self.reset_at = None
+
+    def _delay(self, cost: int, now: datetime.datetime) -> float:
+        if self.remaining is None:
+            # Nothing heard yet for this window, let a single request find out
+            return 0 if self.reserved == 0 else None
+        available = self.available
+        if available < cost:
+            if self.reserved > 0:
+                # In flight requests may report a fresher window
+                return None
+            self.bound = True
+            return (self.reset_at - now).total_seconds() + self.margin
+        if self._last_grant is None or (not self.bound and available - cost >= self.burst):
+            return 0
+        self.bound = True
+        interval = (self.reset_at - now).total_seconds() / max(available, 1)
+        wait = (self._last_grant - now).total_seconds() + interval
+        return max(0.0, wait)
+
+    async def reserve(self, cost: int = None) -> int:
+        cost = cost or math.ceil(self.cost)
+        while True:
+            now = datetime.datetime.utcnow()
+            self._roll_over(now)
+            delay = self._delay(cost, now)
+            if delay == 0:
+                self.reserved += cost
+                self._last_grant = now
+                return cost
+            event = self._event()
+            event.clear()
+            if delay is None:
+                await event.wait()
+                continue
+            if delay > 60:
+                logger.info(
+                    "rate limit exhausted, sleeping until %s", self.reset_at.isoformat()
+                )
+            try:
+                await asyncio.wait_for(event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, cost: int):
+        # The request never reached GitHub
+        self.reserved = max(0, self.reserved - cost)
+        self._event().set()
+
+    def exhausted(self, reset_in: float = None):
+        # GitHub refused a request for lack of points, which it does not
+        # charge for. Nothing more goes out until the window resets.
+        now = datetime.datetime.utcnow()
+        if reset_in is not None:
+            self.reset_at = now + datetime.timedelta(seconds=reset_in)
+        elif self.reset_at is None or self.reset_at <= now:
+            # No idea when, check again in a minute
+            self.reset_at = now + datetime.timedelta(minutes=1)
+        self.remaining = 0
+        self.bound = True
+        logger.warning("rate limit exhausted until %s", self.reset_at.isoformat())
+        self._event().set()
+
+    def update(self, rate_limit: RateLimit, reserved: int = None, searches: int = 1):
+        # `cost` is kept per search so batches can reserve cost * size. It
+        # can be well under a point, e.g. for batches of user lookups.
+        self.reserved = max(0, self.reserved - (reserved or rate_limit.cost))
+        self.spent += rate_limit.cost
+        self.cost = max(rate_limit.cost, 1) / searches
+        if rate_limit.limit:
+            self.limit = rate_limit.limit
+        if self.reset_at is None or rate_limit.resetAt > self.reset_at:
+            # First response of a new window
+            self.remaining = rate_limit.remaining
+            self.reset_at = rate_limit.resetAt
+        elif rate_limit.resetAt == self.reset_at:
+            # Responses can arrive out of order, the lowest count is newest
+            self.remaining = min(self.remaining, rate_limit.remaining)
+        self._event().set()
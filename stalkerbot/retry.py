@@ -0,0 +1,189 @@
+import asyncio
+import json
+import random
+import time
+from logging import getLogger
+
+from stalkerbot.exc import HTTPException, ParsingError, RateLimitExceededException
+from stalkerbot.transport import Response
+
+logger = getLogger("retry")
+
+# What a response means for the request that got it
+OK = "ok"
+GRAPHQL_ERROR = "graphql_error"
+RATE_LIMITED = "rate_limited"
+SECONDARY_LIMIT = "secondary_limit"
+SERVER_ERROR = "server_error"
+TIMEOUT = "timeout"
+FATAL = "fatal"
+
+RETRYABLE = {GRAPHQL_ERROR, SECONDARY_LIMIT, SERVER_ERROR, TIMEOUT}
+
+
+def _errors(resp: Response) -> list:
+    # Errors of a 200 that failed as a whole: one without any data, or one
+    # that hit the rate limit. Errors next to data are left to the parser,
+    # which sorts them out per search.
+    if b'"errors"' not in resp.content:
+        return []
+    try:
+        body = json.loads(resp.content)
+    except ValueError:
+        return []
+    if not isinstance(body, dict):
+        return []
+    errors = [e for e in body.get("errors") or () if isinstance(e, dict)]
+    if any(e.get("type") == "RATE_LIMITED" for e in errors):
+        return errors
+    data = body.get("data")
+    if isinstance(data, dict) and any(v is not None for v in data.values()):
+        return []
+    return errors
+
+
+def classify(resp: Response) -> str:
+    if resp is None:
+        return TIMEOUT
+    status = resp.status_code
+    if status == 200:
+        errors = _errors(resp)
+        if not errors:
+            return OK
+        if any(e.get("type") == "RATE_LIMITED" for e in errors):
+            return RATE_LIMITED
+        return GRAPHQL_ERROR
+    if status == 429:
+        return SECONDARY_LIMIT
+    if status == 403:
+        if "Retry-After" in resp.headers or b"secondary rate limit" in resp.content.lower():
+            return SECONDARY_LIMIT
+        if resp.headers.get("X-RateLimit-Remaining") == "0":
+            return RATE_LIMITED
+        return FATAL
+    if status >= 500:
+        return SERVER_ERROR
+    return FATAL
+
+
+def retryable(e: Exception) -> bool:
+    # Whether a request that failed with `e` is worth sending again. Fields
+    # GitHub could not resolve are usually timeouts upstream.
+    if isinstance(e, (ParsingError, RateLimitExceededException)):
+        return True
+    if not isinstance(e, HTTPException):
+        return False
+    content = e.message or b""
+    if isinstance(content, str):
+        content = content.encode()
+    return classify(Response(e.status_code, content)) in RETRYABLE
+
+
+def retry_after(resp: Response) -> float:
+    # Seconds the server asked us to hold off, if it said
+    if resp is None:
+        return None
+    value = resp.headers.get("Retry-After")
+    if value is not None:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return None
+    reset = resp.headers.get("X-RateLimit-Reset")
+    if reset is not None and resp.headers.get("X-RateLimit-Remaining") == "0":
+        try:
+            return max(0.0, float(reset) - time.time())
+        except ValueError:
+            return None
+    return None
+
+
+# Capped exponential backoff with full jitter: attempt n waits a random time
+# up to min(cap, base * 2**n), so clients that failed together do not retry
+# together. A Retry-After from the server is honoured as it is.
+class Backoff:
+    def __init__(self, base: float = 0.5, cap: float = 60):
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base)
+        return random.uniform(0, min(self.cap, self.base * 2**attempt))
+
+
+# Shared by every request on one token. After `threshold` failures in a row
+# the circuit opens and nothing is sent for `cooldown` seconds; then a single
+# request goes out and the rest wait to see how it does. Secondary limits
+# pause the circuit for as long as GitHub asks, since they apply to the
+# token rather than to the request that hit them.
+class CircuitBreaker:
+    def __init__(self, threshold: int = 5, cooldown: float = 30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.trips = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._closed: asyncio.Event = None
+
+    def _event(self) -> asyncio.Event:
+        if self._closed is None:
+            self._closed = asyncio.Event()
+        return self._closed
+
+    @property
+    def open(self) -> bool:
+        return time.monotonic() < self._open_until
+
+    @property
+    def half_open(self) -> bool:
+        return self.failures >= self.threshold
+
+    async def wait(self):
+        while True:
+            delay = self._open_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if not self.half_open:
+                return
+            if not self._probing:
+                self._probing = True
+                return
+            event = self._event()
+            event.clear()
+            await event.wait()
+
+    def pause(self, seconds: float):
+        until = time.monotonic() + seconds
+        if until > self._open_until:
+            logger.info("pausing requests for %.1fs", seconds)
+            self._open_until = until
+        # A probe that hit a secondary limit proves nothing either way, so
+        # once the pause is over the next request probes again
+        self._probing = False
+        self._event().set()
+
+    def success(self):
+        if self.half_open:
+            logger.info("requests are going through again, closing circuit")
+        self.failures = 0
+        self._probing = False
+        self._event().set()
+
+    def failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.threshold:
+            self.trips += 1
+            logger.warning(
+                "%i requests failed in a row, holding off for %.0fs",
+                self.failures,
+                self.cooldown,
+            )
+            self._open_until = time.monotonic() + self.cooldown
+            self._event().set()
+
+
+default_breaker = CircuitBreaker()
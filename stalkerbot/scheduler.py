@@ -0,0 +1,117 @@
+import asyncio
+from asyncio.queues import QueueEmpty
+from collections import deque
+from logging import getLogger
+
+logger = getLogger("scheduler")
+
+
+def load_queries(path: str) -> dict[str, float]:
+    # One query per line, optionally after a weight and a tab. Blank lines
+    # and lines starting with # are skipped.
+    queries = {}
+    with open(path, encoding="utf-8") as fp:
+        for number, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            weight, query = 1.0, line
+            if "\t" in line:
+                head, query = line.split("\t", 1)
+                try:
+                    weight = float(head)
+                except ValueError:
+                    raise ValueError(f"{path}:{number}: weight {head!r} is not a number")
+                if weight <= 0:
+                    raise ValueError(f"{path}:{number}: weight must be positive")
+            queries[query.strip()] = weight
+    return queries
+
+
+# The worker's input queue, one lane per key (query) served by weighted fair
+# queuing: every lane has a virtual time that advances by 1 / weight per item
+# served and the lane furthest behind goes next. The worker waits for a
+# request slot and for points before taking anything off, so requests held
+# back by the rate limit budget wait here where they can be ordered. A batch
+# covers one round of virtual time in which every waiting lane gets items in
+# proportion to its weight, and a lane that got ahead waits for a later one.
+# So whenever requests queue up behind the budget each query gets points in
+# proportion to its weight, whatever its number of shards. A lane that went
+# idle rejoins at the current virtual time rather than catching up on what it
+# missed.
+class FairQueue:
+    def __init__(self, weights: dict = None):
+        self.weights = dict(weights or {})
+        self.lanes: dict[str, deque] = {}
+        self.served: dict[str, int] = {}
+        self._finish: dict[str, float] = {}
+        self._now = 0.0
+        self._size = 0
+        self._added: asyncio.Event = None
+
+    def _event(self) -> asyncio.Event:
+        if self._added is None:
+            self._added = asyncio.Event()
+        return self._added
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def put_nowait(self, item, key: str = None):
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = deque()
+        if not lane:
+            self._finish[key] = max(self._finish.get(key, 0.0), self._now)
+        lane.append(item)
+        self._size += 1
+        self._event().set()
+
+    async def put(self, item, key: str = None):
+        self.put_nowait(item, key)
+
+    def _next(self) -> str:
+        return min((k for k, lane in self.lanes.items() if lane), key=self._finish.get)
+
+    def _pop(self, key: str):
+        item = self.lanes[key].popleft()
+        self._size -= 1
+        self._finish[key] += 1 / self.weights.get(key, 1.0)
+        self.served[key] = self.served.get(key, 0) + 1
+        return item
+
+    def get_nowait(self):
+        if self._size == 0:
+            raise QueueEmpty
+        key = self._next()
+        self._now = self._finish[key]
+        return self._pop(key)
+
+    def take(self, limit: int) -> list:
+        # Up to `limit` items for one batch, in fair order. The virtual time
+        # is where the batch starts, lanes it emptied must not rejoin later.
+        if self._size == 0:
+            return []
+        active = sum(self.weights.get(k, 1.0) for k, lane in self.lanes.items() if lane)
+        items = [self.get_nowait()]
+        horizon = self._now + limit / active
+        while len(items) < limit and self._size > 0:
+            key = self._next()
+            if self._finish[key] >= horizon:
+                break
+            items.append(self._pop(key))
+        return items
+
+    async def wait(self):
+        # Until something is queued, without taking it
+        while self._size == 0:
+            event = self._event()
+            event.clear()
+            await event.wait()
+
+    async def get(self):
+        await self.wait()
+        return self.get_nowait()
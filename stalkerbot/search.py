@@ -1,18 +1,37 @@
-import asyncio
 from datetime import datetime, timedelta
-from random import random
-from typing import Union
 import logging
-import requests
 
-from stalkerbot.exc import HTTPException, RateLimitExceededException
-from stalkerbot.utils import requests_future, QueryResponse, create_query, State
-from tqdm.asyncio import tqdm
+from stalkerbot.density import PLAN_FILL, RESULT_CAP, DensityIndex
+from stalkerbot.fingerprints import WindowFingerprints, window_fingerprint
+from stalkerbot.metrics import Metrics, default_metrics
+from stalkerbot.tuning import PageSizeTuner
+from stalkerbot.utils import (
+    GRAPHQL_URL,
+    QueryResponse,
+    SearchRequest,
+    State,
+)
 
-search_uri = "https://api.github.com/graphql"
+search_uri = GRAPHQL_URL
 
 logger = logging.getLogger("search")
 
+# Earliest account creation date on GitHub
+EPOCH = datetime(year=2008, month=4, day=1)
+
+
+def shard_bounds(
+    shards: int, since: datetime = EPOCH, until: datetime = None
+) -> list[tuple[datetime, datetime]]:
+    # Signups grow roughly linearly over time, so the cumulative count grows
+    # quadratically. Spacing boundaries on a square root curve gives shards
+    # of about the same number of users rather than the same length.
+    until = until or datetime.utcnow()
+    span = until - since
+    edges = [since + span * (i / shards) ** 0.5 for i in range(shards + 1)]
+    edges[-1] = until
+    return [(edges[i], edges[i + 1]) for i in reversed(range(shards))]
+
 
 class Search:
     def __init__(
@@ -24,120 +43,211 @@ class Search:
         continue_from: datetime = None,
         silent: bool = False,
         org_flag: bool = False,
+        since: datetime = None,
+        index: DensityIndex = None,
+        metrics: Metrics = None,
+        tuner: PageSizeTuner = None,
+        fingerprints: WindowFingerprints = None,
+        sort: str = None,
     ):
         if state is not None:
             self.query = state.query
             self.continue_from = state.continue_from
             self.cursor = state.cursor
+            self.since = state.since or since or EPOCH
+            self.window_start = state.window_start
         else:
             self.query = query
             self.continue_from = continue_from
             self.cursor = None
+            self.since = since or EPOCH
+            self.window_start = None
 
         self.page_size = page_size
+        self.tuner = tuner
+        self.index = index
+        self.fingerprints = fingerprints
+        # Only for a query searched as it is, windows are always paged
+        # through in signup order
+        self.sort = sort
+        self.metrics = metrics or default_metrics
         self.token = token
         self.silent = silent
-        self.continue_from = continue_from
         if org_flag:
             self.user_type = "Organization"
         else:
             self.user_type = "User"
 
-    async def gen(self) -> dict:
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json",
-        }
-        delta = timedelta(days=1)
-        if self.continue_from is None:
-            start_date = datetime.utcnow() - delta
-            end_date = datetime.utcnow()
-        else:
-            start_date = self.continue_from - delta
-            end_date = self.continue_from
-        query = self.query + " sort:joined"
-
-        if "created" not in self.query:
-            query = (
-                self.query
-                + f" created:{start_date.date().isoformat()}..{end_date.date().isoformat()}"
-            )
-        else:
-            query = self.query
+    def _state(self, start_date: datetime, end_date: datetime) -> State:
+        return State(end_date, self.query, self.cursor, self.since, start_date)
+
+    def _window(self, start_date: datetime, end_date: datetime) -> str:
+        # created: ranges are inclusive, windows here are half open
+        last = end_date - timedelta(seconds=1)
+        return (
+            self.query
+            + f" created:{start_date.isoformat()}..{last.isoformat()} sort:joined"
+        )
 
-        data = {
-            "query": create_query(
-                cursor=self.cursor,
-                q=query,
-                page_size=self.page_size,
+    def _split(self, start_date: datetime, end_date: datetime) -> list:
+        # Sub-ranges oldest first. With a density index the whole range is cut
+        # into windows planned to fit, otherwise it is bisected.
+        edges = [end_date]
+        while self.index is not None and edges[-1] > start_date:
+            edge = self.index.plan(self.query, edges[-1], start_date)
+            if edge is None or edge >= edges[-1]:
+                break
+            edges.append(max(edge.replace(microsecond=0), start_date))
+        if len(edges) == 1:
+            edges.append(start_date + (end_date - start_date) / 2)
+            edges[-1] = edges[-1].replace(microsecond=0)
+        if edges[-1] > start_date:
+            edges.append(start_date)
+        edges.reverse()
+        return [(edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+
+    def _cut(self, start_date: datetime, end_date: datetime) -> list:
+        # start_date..end_date cut along the windows crawled before, with the
+        # gaps between them, oldest first. Empty if no window lies inside.
+        windows = self.fingerprints.within(self.query, start_date, end_date)
+        if not windows:
+            return []
+        pieces = []
+        edge = start_date
+        for start, end in windows:
+            if start > edge:
+                pieces.append((edge, start))
+            pieces.append((start, end))
+            edge = end
+        if edge < end_date:
+            pieces.append((edge, end_date))
+        return pieces
+
+    def _request(
+        self, query: str, count_only: bool = False, page_size: int = None
+    ) -> SearchRequest:
+        if self.tuner is None:
+            return SearchRequest(
+                query,
+                cursor=None if count_only else self.cursor,
+                page_size=page_size or self.page_size,
                 user_type=self.user_type,
+                count_only=count_only,
             )
-        }
-
-        response = yield (
-            {"headers": headers, "json": data},
-            State(end_date, self.query, self.cursor),
+        # Cursors are positions in the result set, so a page of a different
+        # size continues from the same place
+        return SearchRequest(
+            query,
+            cursor=None if count_only else self.cursor,
+            page_size=page_size or self.tuner.page_size(),
+            user_type=self.user_type,
+            count_only=count_only,
+            fields=self.tuner.fields,
         )
-        average = response.userCount
-        if not self.silent:
-            used = tqdm(
-                desc="used",
-                unit="requests",
-                total=5000,
-                initial=response.rateLimit.used,
-            )
-        prev = [average for _ in range(5)]
-        while True:
-            if not response.pageInfo.hasPreviousPage:
-                prev = [*prev[:-1], response.userCount]
-                average = sum(prev) / len(prev)
-                if "created" not in self.query:
-                    if response.userCount > 1000:
-                        end_date -= delta / 2
-                        start_date -= delta / 2
-                        start_date.date().isoformat
-                        query = (
-                            self.query
-                            + f" created:{start_date.isoformat()}..{end_date.isoformat()} sort:joined"
-                        )
-                        self.cursor = None
-                    elif start_date < datetime(year=2008, month=4, day=1):
-                        raise StopAsyncIteration
-                    else:
-                        query = (
-                            self.query
-                            + f" created:{start_date.isoformat()}..{end_date.isoformat()} sort:joined"
-                        )
-                        end_date = datetime.fromisoformat(start_date.isoformat())
-                        start_date -= delta
-                        self.cursor = None
-                else:
-                    break
 
-                if average > 2000:
-                    delta /= 2
-                if average < 200:
-                    delta *= 2
+    async def gen(self) -> SearchRequest:
+        if "created" in self.query:
+            pending = [(None, None)]
+        else:
+            if self.continue_from is None:
+                end_date = datetime.utcnow()
+            else:
+                end_date = self.continue_from
+            end_date = end_date.replace(microsecond=0)
+            since = self.since.replace(microsecond=0)
+            # Ranges still to crawl, newest on top. Everything newer than the
+            # range being worked on is done, so State only needs its bounds.
+            pending = [(since, end_date)]
+            if self.cursor is not None and self.window_start is not None:
+                pending = [(since, self.window_start), (self.window_start, end_date)]
+
+        while pending:
+            start_date, end_date = pending.pop()
+            if start_date is None:
+                query = self.query
+                if self.sort is not None:
+                    query += " " + self.sort
+            elif end_date <= start_date:
+                continue
             else:
-                self.cursor = response.pageInfo.endCursor
-            if not self.silent:
-                used.update(response.rateLimit.cost)
+                query = self._window(start_date, end_date)
 
+            known = None
             if (
-                response.rateLimit.remaining < response.rateLimit.cost
-                or response.rateLimit.remaining == 0
+                start_date is not None
+                and self.cursor is None
+                and self.fingerprints is not None
             ):
-                if not self.silent:
-                    used.write(
-                        f"sleeping until {response.rateLimit.resetAt.isoformat()}"
+                known = self.fingerprints.get(self.query, start_date, end_date)
+                if known is None:
+                    pieces = self._cut(start_date, end_date)
+                    if pieces:
+                        pending.extend(pieces)
+                        continue
+
+            if start_date is not None and self.cursor is None and known is None:
+                expected = None
+                if self.index is not None:
+                    expected = self.index.estimate(self.query, start_date, end_date)
+                if expected is None or expected > RESULT_CAP * PLAN_FILL:
+                    # Not sure it fits, so ask for the count alone first
+                    self.metrics.inc("stalkerbot_searches_total", kind="probe")
+                    response = yield (
+                        self._request(query, count_only=True),
+                        self._state(start_date, end_date),
                     )
-                sleep_time = response.rateLimit.resetAt - datetime.utcnow()
-                await asyncio.sleep(sleep_time.seconds)
-                used.reset()
-
-            data = {"query": create_query(self.cursor, query, user_type=self.user_type)}
-            response = yield (
-                {"headers": headers, "json": data},
-                State(end_date, self.query, self.cursor),
-            )
-        raise StopAsyncIteration
+                    self._observe(start_date, end_date, response)
+                    if response.userCount == 0:
+                        continue
+                    if self._too_big(start_date, end_date, response):
+                        self.metrics.inc("stalkerbot_window_splits_total")
+                        pending.extend(self._split(start_date, end_date))
+                        continue
+
+            first_page = self.cursor is None
+            fingerprint = None
+            while True:
+                self.metrics.inc("stalkerbot_searches_total", kind="page")
+                # A window crawled before is checked with a page of the same
+                # size, so its fingerprint can be compared
+                request = self._request(
+                    query, page_size=known.page_size if first_page and known else None
+                )
+                response = yield (request, self._state(start_date, end_date))
+                if first_page and start_date is not None:
+                    first_page = False
+                    self._observe(start_date, end_date, response)
+                    if self.fingerprints is not None:
+                        fingerprint = window_fingerprint(response, request.page_size)
+                    if known is not None and fingerprint == known:
+                        # Nothing in the window changed since it was crawled
+                        self.metrics.inc("stalkerbot_windows_skipped_total")
+                        self.cursor = None
+                        break
+                    if self._too_big(start_date, end_date, response):
+                        # The estimate was off, split like a probe would have
+                        self.metrics.inc("stalkerbot_window_splits_total")
+                        pending.extend(self._split(start_date, end_date))
+                        self.cursor = None
+                        break
+                if not response.pageInfo.hasPreviousPage:
+                    self.cursor = None
+                    if fingerprint is not None:
+                        self.fingerprints.record(
+                            self.query, start_date, end_date, fingerprint
+                        )
+                    break
+                self.cursor = response.pageInfo.startCursor
+
+    def _too_big(
+        self, start_date: datetime, end_date: datetime, response: QueryResponse
+    ) -> bool:
+        return response.userCount > RESULT_CAP and end_date - start_date > timedelta(
+            seconds=1
+        )
+
+    def _observe(
+        self, start_date: datetime, end_date: datetime, response: QueryResponse
+    ):
+        if self.index is not None:
+            self.index.observe(self.query, start_date, end_date, response.userCount)
@@ -0,0 +1,486 @@
+import csv
+import glob
+import gzip
+import io
+import json
+import os
+import sqlite3
+from logging import getLogger
+from typing import Iterator
+
+logger = getLogger("sinks")
+
+FORMATS = ("csv", "jsonl", "sqlite", "parquet")
+COMPRESSIONS = ("gzip", "zstd")
+COLUMNS = ("name", "username", "email")
+
+_EXTENSIONS = {
+    ".csv": "csv",
+    ".jsonl": "jsonl",
+    ".ndjson": "jsonl",
+    ".db": "sqlite",
+    ".sqlite": "sqlite",
+    ".sqlite3": "sqlite",
+    ".parquet": "parquet",
+}
+_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "zstd compression needs zstandard, pip install github-stalkerbot[zstd]"
+        ) from None
+    return zstandard
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            "parquet output needs pyarrow, pip install github-stalkerbot[parquet]"
+        ) from None
+    return pyarrow
+
+
+def _makedirs(path: str):
+    head, _ = os.path.split(path)
+    if head:
+        os.makedirs(head, exist_ok=True)
+
+
+def _split(path: str) -> tuple[str, str]:
+    # "data/users.csv.gz" -> ("data/users", ".csv.gz")
+    root, ext = os.path.splitext(path)
+    if ext in _SUFFIXES:
+        root, inner = os.path.splitext(root)
+        ext = inner + ext
+    return root, ext
+
+
+def sibling(path: str, tag: str) -> str:
+    # "data/users.csv.gz", "refresh" -> "data/users.refresh.csv.gz"
+    root, ext = _split(path)
+    return f"{root}.{tag}{ext}"
+
+
+def _part(path: str) -> int:
+    root, _ = _split(path)
+    return int(root.rsplit(".", 1)[1])
+
+
+# Where the writer thread puts rows. Rows are (name, login, email) tuples
+# written in batches; position() is a JSON value the journal records after
+# each flush and restore() cuts the output back to it on resume. A sink that
+# cannot make every flush durable reports `pending` until it can, and the
+# journal waits for it.
+class Sink:
+    pending = False
+
+    def open(self):
+        pass
+
+    def write(self, rows: list):
+        raise NotImplementedError
+
+    def flush(self, sync: bool = False, final: bool = False):
+        return self.position()
+
+    def position(self):
+        raise NotImplementedError
+
+    def restore(self, position) -> bool:
+        # True if anything past `position` was dropped
+        raise NotImplementedError
+
+    @property
+    def empty(self) -> bool:
+        raise NotImplementedError
+
+    def rows(self) -> Iterator[tuple]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# Text output appended to one file, or to numbered parts once `rotate_bytes`
+# is set. Compressed output is written as one gzip member or zstd frame per
+# flush; both formats decode concatenated members as a single stream, so
+# every flush ends on a boundary the file can be cut back to.
+class FileSink(Sink):
+    header = ""
+
+    def __init__(self, path: str, compression: str = None, rotate_bytes: int = None):
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"compression must be one of {', '.join(COMPRESSIONS)}")
+        self.path = path
+        self.compression = compression
+        self.rotate_bytes = rotate_bytes
+        self._zstd = _zstandard().ZstdCompressor() if compression == "zstd" else None
+        _makedirs(path)
+        parts = self._parts()
+        self.part = parts[-1] if parts else 0
+        self._size = self._getsize(self.part)
+        self._fp = None
+
+    def _part_path(self, part: int) -> str:
+        if self.rotate_bytes is None:
+            return self.path
+        root, ext = _split(self.path)
+        return f"{root}.{part:05d}{ext}"
+
+    def _parts(self) -> list:
+        if self.rotate_bytes is None:
+            return [0] if os.path.exists(self.path) else []
+        root, ext = _split(self.path)
+        pattern = glob.escape(root) + "." + "[0-9]" * 5 + glob.escape(ext)
+        return sorted(_part(p) for p in glob.glob(pattern))
+
+    def _getsize(self, part: int) -> int:
+        path = self._part_path(part)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def _encode(self, rows: list) -> str:
+        raise NotImplementedError
+
+    def _decode(self, fp) -> Iterator[tuple]:
+        raise NotImplementedError
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == "gzip":
+            return gzip.compress(data, compresslevel=6, mtime=0)
+        if self.compression == "zstd":
+            return self._zstd.compress(data)
+        return data
+
+    def _reader(self, path: str):
+        if self.compression == "gzip":
+            return gzip.open(path, "rt", encoding="utf-8", newline="")
+        if self.compression == "zstd":
+            raw = _zstandard().ZstdDecompressor().stream_reader(
+                open(path, "rb"), read_across_frames=True, closefd=True
+            )
+            return io.TextIOWrapper(raw, encoding="utf-8", newline="")
+        return open(path, encoding="utf-8", newline="")
+
+    def open(self):
+        self._fp = open(self._part_path(self.part), "ab")
+        self._size = self._fp.tell()
+
+    def write(self, rows: list):
+        if not rows:
+            return
+        text = self._encode(rows)
+        if self._size == 0:
+            text = self.header + text
+        data = self._compress(text.encode("utf-8"))
+        self._fp.write(data)
+        self._size += len(data)
+
+    def flush(self, sync: bool = False, final: bool = False):
+        self._fp.flush()
+        if sync:
+            os.fsync(self._fp.fileno())
+        if (
+            not final
+            and self.rotate_bytes is not None
+            and self._size >= self.rotate_bytes
+        ):
+            self._fp.close()
+            self.part += 1
+            self.open()
+        return self.position()
+
+    def position(self):
+        return [self.part, self._size]
+
+    def restore(self, position) -> bool:
+        part, offset = position
+        dropped = False
+        for p in self._parts():
+            if p > part:
+                os.remove(self._part_path(p))
+                dropped = True
+        size = self._getsize(part)
+        if size > offset:
+            logger.info(
+                "dropping %i uncommitted bytes from %s",
+                size - offset,
+                self._part_path(part),
+            )
+            with open(self._part_path(part), "r+b") as fp:
+                fp.truncate(offset)
+            dropped = True
+        elif size < offset:
+            logger.warning(
+                "%s is %i bytes shorter than its journal",
+                self._part_path(part),
+                offset - size,
+            )
+        self.part = part
+        self._size = self._getsize(part)
+        return dropped
+
+    @property
+    def empty(self) -> bool:
+        return self.part == 0 and self._size == 0
+
+    def rows(self) -> Iterator[tuple]:
+        for part in self._parts():
+            with self._reader(self._part_path(part)) as fp:
+                yield from self._decode(fp)
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class CSVSink(FileSink):
+    header = ",".join(COLUMNS) + "\n"
+
+    def _encode(self, rows: list) -> str:
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator="\n").writerows(rows)
+        return buf.getvalue()
+
+    def _decode(self, fp) -> Iterator[tuple]:
+        reader = csv.reader(fp)
+        for row in reader:
+            if len(row) == len(COLUMNS) and row != list(COLUMNS):
+                yield tuple(row)
+
+
+class JSONLSink(FileSink):
+    def _encode(self, rows: list) -> str:
+        return "".join(
+            json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n"
+            for row in rows
+        )
+
+    def _decode(self, fp) -> Iterator[tuple]:
+        for line in fp:
+            if line.strip():
+                data = json.loads(line)
+                yield tuple(data[c] for c in COLUMNS)
+
+
+# One table in a SQLite database, each flush inserted in a single
+# transaction. The position is the last rowid, rows past it are deleted on
+# restore.
+class SQLiteSink(Sink):
+    def __init__(self, path: str, table: str = "users"):
+        self.path = path
+        self.table = table
+        _makedirs(path)
+        self.conn = None
+        conn = self._connect()
+        try:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (name TEXT, username TEXT, email TEXT)"
+            )
+            conn.commit()
+            self._last = self._max_rowid(conn)
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _max_rowid(self, conn: sqlite3.Connection) -> int:
+        return conn.execute(f"SELECT IFNULL(MAX(rowid), 0) FROM {self.table}").fetchone()[0]
+
+    def open(self):
+        self.conn = self._connect()
+
+    def write(self, rows: list):
+        if not rows:
+            return
+        self.conn.executemany(f"INSERT INTO {self.table} VALUES (?, ?, ?)", rows)
+
+    def flush(self, sync: bool = False, final: bool = False):
+        self.conn.commit()
+        if sync:
+            self.conn.execute("PRAGMA wal_checkpoint(FULL)")
+        self._last = self._max_rowid(self.conn)
+        return self.position()
+
+    def position(self):
+        return self._last
+
+    def restore(self, position) -> bool:
+        conn = self._connect()
+        try:
+            dropped = conn.execute(
+                f"DELETE FROM {self.table} WHERE rowid > ?", (position,)
+            ).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        if dropped:
+            logger.info("dropping %i uncommitted rows from %s", dropped, self.path)
+        self._last = position
+        return dropped > 0
+
+    @property
+    def empty(self) -> bool:
+        return self._last == 0
+
+    def rows(self) -> Iterator[tuple]:
+        conn = self._connect()
+        try:
+            yield from conn.execute(
+                f"SELECT name, username, email FROM {self.table} ORDER BY rowid"
+            )
+        finally:
+            conn.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+
+# Numbered Parquet parts written in row groups of `row_group_size`. A part
+# is unreadable until its footer is written, so it is built under a .tmp name
+# and stays pending until it is rotated at `rotate_bytes` or the run ends.
+# The position is the number of finished parts.
+class ParquetSink(Sink):
+    def __init__(
+        self,
+        path: str,
+        compression: str = None,
+        rotate_bytes: int = 64 << 20,
+        row_group_size: int = 10000,
+    ):
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"compression must be one of {', '.join(COMPRESSIONS)}")
+        pa = _pyarrow()
+        self.path = path
+        self.codec = compression or "snappy"
+        self.rotate_bytes = rotate_bytes
+        self.row_group_size = row_group_size
+        self.schema = pa.schema([(c, pa.string()) for c in COLUMNS])
+        _makedirs(path)
+        parts = self._parts()
+        self.part = parts[-1] + 1 if parts else 0
+        self._writer = None
+        self._buffer = []
+
+    def _part_path(self, part: int) -> str:
+        root, ext = os.path.splitext(self.path)
+        return f"{root}.{part:05d}{ext}"
+
+    def _parts(self) -> list:
+        root, ext = os.path.splitext(self.path)
+        pattern = glob.escape(root) + "." + "[0-9]" * 5 + glob.escape(ext)
+        return sorted(_part(p) for p in glob.glob(pattern))
+
+    @property
+    def pending(self) -> bool:
+        return self._writer is not None or len(self._buffer) > 0
+
+    def write(self, rows: list):
+        self._buffer.extend(rows)
+        while len(self._buffer) >= self.row_group_size:
+            self._write_group(self._buffer[: self.row_group_size])
+            del self._buffer[: self.row_group_size]
+
+    def _write_group(self, rows: list):
+        pa = _pyarrow()
+        if self._writer is None:
+            self._writer = pa.parquet.ParquetWriter(
+                self._part_path(self.part) + ".tmp", self.schema, compression=self.codec
+            )
+        columns = list(zip(*rows))
+        self._writer.write_table(
+            pa.table(
+                {c: pa.array(col, pa.string()) for c, col in zip(COLUMNS, columns)},
+                schema=self.schema,
+            )
+        )
+
+    def _finish(self, sync: bool):
+        if self._buffer:
+            self._write_group(self._buffer)
+            self._buffer = []
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        tmp = self._part_path(self.part) + ".tmp"
+        if sync:
+            with open(tmp, "rb") as fp:
+                os.fsync(fp.fileno())
+        os.replace(tmp, self._part_path(self.part))
+        self.part += 1
+
+    def flush(self, sync: bool = False, final: bool = False):
+        tmp = self._part_path(self.part) + ".tmp"
+        if final or (
+            self._writer is not None and os.path.getsize(tmp) >= self.rotate_bytes
+        ):
+            self._finish(sync)
+        return self.position()
+
+    def position(self):
+        return self.part
+
+    def restore(self, position) -> bool:
+        dropped = False
+        for tmp in glob.glob(glob.escape(os.path.splitext(self.path)[0]) + ".*.tmp"):
+            os.remove(tmp)
+            dropped = True
+        for p in self._parts():
+            if p >= position:
+                os.remove(self._part_path(p))
+                dropped = True
+        self.part = position
+        return dropped
+
+    @property
+    def empty(self) -> bool:
+        return self.part == 0
+
+    def rows(self) -> Iterator[tuple]:
+        pa = _pyarrow()
+        for part in self._parts():
+            table = pa.parquet.ParquetFile(self._part_path(part))
+            for batch in table.iter_batches(columns=list(COLUMNS)):
+                yield from zip(*(col.to_pylist() for col in batch.columns))
+
+    def close(self):
+        if self.pending:
+            self._finish(sync=False)
+
+
+def open_sink(
+    path: str, format: str = None, compression: str = None, rotate_bytes: int = None
+) -> Sink:
+    # Format and compression default to what the file name says
+    root, ext = os.path.splitext(path)
+    if compression is None and ext in _SUFFIXES:
+        compression = _SUFFIXES[ext]
+    if ext in _SUFFIXES:
+        ext = os.path.splitext(root)[1]
+    format = format or _EXTENSIONS.get(ext, "csv")
+    if format == "csv":
+        return CSVSink(path, compression=compression, rotate_bytes=rotate_bytes)
+    if format == "jsonl":
+        return JSONLSink(path, compression=compression, rotate_bytes=rotate_bytes)
+    if format == "sqlite":
+        if compression is not None or rotate_bytes is not None:
+            raise ValueError("sqlite output cannot be compressed or rotated")
+        return SQLiteSink(path)
+    if format == "parquet":
+        return ParquetSink(path, compression=compression, rotate_bytes=rotate_bytes or 64 << 20)
+    raise ValueError(f"format must be one of {', '.join(FORMATS)}")
@@ -1,18 +1,30 @@
 import asyncio
 import datetime
-from asyncio.queues import Queue, QueueFull
-from http.cookiejar import CookieJar
+import os
+from asyncio.queues import Queue
 
-from requests.auth import HTTPBasicAuth
-from tqdm.asyncio import tqdm
-
-from stalkerbot.exc import RateLimitExceededException
-from stalkerbot.search import Search
-from stalkerbot.workers import CSVWriter, StalkerWorker
-from stalkerbot.utils import QueryResponse, State
+from stalkerbot.concurrency import AIMDLimiter
+from stalkerbot.dedup import SeenIndex
+from stalkerbot.density import DensityIndex
+from stalkerbot.journal import Journal
+from stalkerbot.metrics import Metrics, export
+from stalkerbot.profiling import Profiler
+from stalkerbot.ratelimit import RateLimitBudget
+from stalkerbot.retry import Backoff, CircuitBreaker, retryable
+from stalkerbot.exc import HTTPException, ParsingError, RateLimitExceededException
+from stalkerbot.filters import Filters
+from stalkerbot.fingerprints import Recorded, WindowFingerprints
+from stalkerbot.scheduler import FairQueue
+from stalkerbot.search import EPOCH, Search, shard_bounds
+from stalkerbot.sinks import open_sink
+from stalkerbot.transport import Transport
+from stalkerbot.tuning import PageSizeTuner, validate_page_size
+from stalkerbot.workers import OutputWriter, StalkerWorker
+from stalkerbot.utils import GRAPHQL_URL, State
+from stalkerbot.watermark import Watermarks
 from logging import getLogger
-from concurrent.futures import ProcessPoolExecutor
-from random import random
+from typing import Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 logger = getLogger("stalker")
 
@@ -20,7 +32,7 @@ logger = getLogger("stalker")
 class Stalker:
     def __init__(
         self,
-        query: str,
+        query: Union[str, list, dict],
         token: str,
         continue_from: State = None,
         early_stop: int = None,
@@ -28,80 +40,406 @@ class Stalker:
         silent: bool = False,
         state: State = None,
         org_flag: bool = False,
+        shards: int = 1,
+        density_index: str = ".density",
+        batch_size: int = 10,
+        parser: str = "process",
+        seen_index: str = "",
+        flush_rows: int = 100,
+        flush_interval: float = 2,
+        fsync: str = "never",
+        journal: str = "",
+        output_format: str = None,
+        compression: str = None,
+        rotate_bytes: int = None,
+        since: Union[datetime.datetime, dict] = None,
+        watermarks: str = "",
+        endpoint: str = GRAPHQL_URL,
+        metrics_path: str = None,
+        metrics_port: int = None,
+        metrics_interval: float = 10,
+        profile: str = None,
+        profile_mode: str = "sample",
+        stall_threshold: float = 0.1,
+        page_size: int = 100,
+        autotune: bool = True,
+        page_retries: int = 20,
+        min_concurrency: int = 1,
+        max_concurrency: int = 25,
+        queue_size: int = 1000,
+        window_index: str = "",
+        recheck: bool = False,
+        filters: Filters = None,
     ):
-        self.data_queue = Queue()
-        self.search_queue = Queue()
-        self.output_queue = Queue()
+        # One query, a list of them or a dict of query -> weight, all sharing
+        # one worker, budget, output and seen index
+        if isinstance(query, str):
+            query = [query]
+        if not isinstance(query, dict):
+            query = {q: 1.0 for q in query}
+        self.filters = filters or Filters()
+        self.weights = {self.filters.apply(q): w for q, w in query.items()}
+        if isinstance(state, State):
+            state = [state]
+        if state:
+            for s in state:
+                self.weights.setdefault(s.query, 1.0)
+        self.queries = list(self.weights)
+        # Bounded so a slow consumer holds the searches back instead of
+        # letting rows pile up in memory
+        self.data_queue = Queue(maxsize=queue_size)
+        self.search_queue = FairQueue(self.weights)
+        self.output_queue = Queue(maxsize=queue_size)
         self.org_flag = org_flag
         if not silent:
+            from tqdm.asyncio import tqdm
+
             self.progress = tqdm(desc="progress", position=0, unit="pages")
+            self.used = tqdm(desc="used", unit="points", total=5000)
         else:
             self.progress = None
+            self.used = None
 
-        self.worker = StalkerWorker(self.data_queue)
-        self.writer = CSVWriter(
-            self.output_queue,
-            filename=output_path,
-            early_stop=early_stop,
-            silent=silent,
+        self.limiter = AIMDLimiter(floor=min_concurrency, ceiling=max_concurrency)
+        self.transport = Transport(max_concurrent=max_concurrency)
+        self.budget = RateLimitBudget()
+        self.breaker = CircuitBreaker()
+        self.page_retries = page_retries
+        self.metrics = Metrics()
+        self.page_size = validate_page_size(page_size)
+        # With autotuning page_size is the largest size tried
+        self.tuner = PageSizeTuner(page_size, budget=self.budget) if autotune else None
+        self.metrics_path = metrics_path
+        self.metrics_port = metrics_port
+        self.metrics_interval = metrics_interval
+        self.profiler = None
+        if profile:
+            self.profiler = Profiler(
+                profile, mode=profile_mode, threshold=stall_threshold, metrics=self.metrics
+            )
+        if parser == "process":
+            self.parser = ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+        elif parser == "thread":
+            self.parser = ThreadPoolExecutor(max_workers=1)
+        else:
+            self.parser = None
+        self.worker = StalkerWorker(
+            self.data_queue,
+            transport=self.transport,
+            budget=self.budget,
+            token=token,
+            batch_size=batch_size,
+            parser=self.parser,
+            emails_only=True,
+            email_pattern=self.filters.email,
+            endpoint=endpoint,
+            metrics=self.metrics,
+            tuner=self.tuner,
+            breaker=self.breaker,
+            limiter=self.limiter,
+        )
+        # Without an output path users are left in output_queue for the
+        # caller, see stalkerbot.crawl
+        self.sink = None
+        self.journal = None
+        self.writer = None
+        if output_path is None:
+            self.seen = SeenIndex(seen_index) if seen_index else None
+        else:
+            if seen_index == "":
+                seen_index = output_path + ".seen"
+            self.seen = SeenIndex(seen_index) if seen_index else None
+            if journal == "":
+                journal = output_path + ".journal"
+            self.journal = Journal(journal)
+            self.sink = open_sink(
+                output_path,
+                format=output_format,
+                compression=compression,
+                rotate_bytes=rotate_bytes,
+            )
+            if state:
+                self.journal.recover(self.sink, self.seen)
+            else:
+                self.journal.reset()
+            self.writer = OutputWriter(
+                self.output_queue,
+                sink=self.sink,
+                early_stop=early_stop,
+                silent=silent,
+                seen=self.seen,
+                journal=self.journal,
+                max_chunk=flush_rows,
+                max_interval=flush_interval,
+                fsync=fsync,
+                metrics=self.metrics,
+            )
+        self.query = self.queries[0]
+        self.metrics.gauge(
+            "stalkerbot_queue_depth", self.search_queue.qsize, queue="search"
+        )
+        self.metrics.gauge(
+            "stalkerbot_queue_depth", self.output_queue.qsize, queue="output"
         )
-        self.query = query
+        self.metrics.gauge("stalkerbot_queue_depth", self.data_queue.qsize, queue="data")
+        self.metrics.gauge("stalkerbot_requests_in_flight", lambda: self.transport.in_flight)
+        self.metrics.gauge("stalkerbot_points_spent", lambda: self.budget.spent)
+        self.metrics.gauge("stalkerbot_points_remaining", lambda: self.budget.remaining)
+        for query in self.queries:
+            self.metrics.gauge(
+                "stalkerbot_query_searches",
+                lambda query=query: self.search_queue.served.get(query, 0),
+                query=query,
+            )
+        self.metrics.gauge("stalkerbot_concurrency_limit", lambda: self.limiter.current)
+        self.metrics.gauge(
+            "stalkerbot_circuit_open", lambda: int(self.breaker.open)
+        )
+        self.metrics.gauge(
+            "stalkerbot_page_size",
+            lambda: self.tuner.current if self.tuner is not None else self.page_size,
+        )
+        if self.writer is not None:
+            self.metrics.gauge(
+                "stalkerbot_points_per_email",
+                lambda: (
+                    self.budget.spent / self.writer.total if self.writer.total else None
+                ),
+            )
         self.state = continue_from
         self.start_time = datetime.datetime.utcnow()
         self.early_stop = early_stop
-        self.search = Search(
+        self.index = DensityIndex(density_index) if density_index else None
+        if watermarks == "":
+            watermarks = output_path + ".watermarks" if output_path else None
+        self.watermarks = Watermarks(watermarks) if watermarks else None
+        if window_index == "":
+            window_index = output_path + ".windows" if output_path else None
+        self.fingerprints = None
+        if window_index:
+            self.fingerprints = WindowFingerprints(window_index, recheck=recheck)
+            if self.sink is not None and self.sink.empty:
+                # Nothing written yet, so no window can be skipped
+                self.fingerprints.clear()
+            if self.writer is not None:
+                self.writer.fingerprints = self.fingerprints
+        self._marked = 0
+        # Upper bound of this crawl, recorded as the query's mark once done
+        self.until = continue_from or self.start_time
+
+        self.token = token
+        self.silent = silent
+        self.searches = []
+        if state:
+            if self.writer is not None:
+                # Finished shards are carried over into every new checkpoint
+                self.writer.states = {(s.query, s.since): s for s in state}
+            # Resuming: one search per shard that had not finished yet
+            for s in state:
+                if s.continue_from != s.since:
+                    self.searches.append(self._new_search(state=s))
+        else:
+            for query in self.queries:
+                query_since = since.get(query) if isinstance(since, dict) else since
+                if shards > 1 and "created" not in query:
+                    bounds = shard_bounds(
+                        shards, since=query_since or EPOCH, until=continue_from
+                    )
+                else:
+                    bounds = [(query_since, continue_from)]
+                for lower, upper in bounds:
+                    self.searches.append(
+                        self._new_search(query, continue_from=upper, since=lower)
+                    )
+        # Searches per query this run, each query's mark moves once all are
+        # done. Queries without a search this run are left alone.
+        self.unfinished = {}
+        for search in self.searches:
+            self.unfinished[search.query] = self.unfinished.get(search.query, 0) + 1
+        self.search = self.searches[0] if self.searches else None
+
+    def _new_search(self, query: str = None, **kwargs) -> Search:
+        # Only the first search shows its own progress bar
+        return Search(
             query=query,
-            token=token,
-            continue_from=continue_from,
-            state=state,
-            silent=silent,
+            token=self.token,
+            silent=self.silent or bool(self.searches),
             org_flag=self.org_flag,
+            index=self.index,
+            metrics=self.metrics,
+            page_size=self.page_size,
+            tuner=self.tuner,
+            fingerprints=self.fingerprints,
+            sort=self.filters.sort_qualifier,
+            **kwargs,
         )
 
     def start(self):
-        logger.debug("starting...")
-
-        loop = asyncio.get_event_loop()
-
-        worker_task = loop.create_task(self.worker.astart(self.search_queue))
-        writer_task = loop.create_task(self.writer.astart())
-        search_task = loop.create_task(self._search())
+        # Runs the crawl in a new event loop until it is done. Ctrl-C cancels
+        # it, which stops it the way stop() does: requests in flight finish
+        # and the output is flushed before this returns.
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            logger.info("interrupted, requests in flight finished")
 
-        worker_task.add_done_callback(self.writer.stop)
-        if self.early_stop:
-            writer_task.add_done_callback(self.worker.stop)
+    async def run(self):
+        # Crawls until every search is done, the writer reaches early_stop or
+        # stop() is called. Works inside any running loop; if the task running
+        # it is cancelled it still waits for requests in flight and flushes
+        # the output before giving up.
+        logger.debug("starting...")
+        loop = asyncio.get_running_loop()
+        if self.profiler is not None:
+            self.profiler.start(loop)
+        worker_task = loop.create_task(
+            self.worker.astart(self.search_queue), name="worker"
+        )
+        self._search_tasks = [
+            loop.create_task(self._search(s), name=f"search-{i}")
+            for i, s in enumerate(self.searches)
+        ]
+        background = [
+            loop.create_task(self._finish(self._search_tasks), name="finish"),
+            *self._search_tasks,
+        ]
+        if self.metrics_path or self.metrics_port:
+            background.append(
+                loop.create_task(
+                    export(
+                        self.metrics,
+                        path=self.metrics_path,
+                        port=self.metrics_port,
+                        interval=self.metrics_interval,
+                    ),
+                    name="metrics",
+                )
+            )
+        main = [worker_task]
+        if self.writer is not None:
+            writer_task = loop.create_task(self.writer.astart(), name="writer")
+            main.append(writer_task)
+            worker_task.add_done_callback(self.writer.stop)
+            # Early stop, or a failed writer that would leave the searches
+            # waiting on a full output queue for good
+            writer_task.add_done_callback(self.stop)
 
         logger.debug("Tasks started")
-        all_tasks = asyncio.gather(writer_task, worker_task, loop=loop)
-        loop.run_until_complete(all_tasks)
+        try:
+            # wait rather than gather, so being cancelled leaves these running
+            await asyncio.wait(main)
+        finally:
+            self.stop()
+            await asyncio.wait(main)
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+            self._close(main)
+        for task in main:
+            task.result()
         logger.debug("Tasks complete")
 
     def stop(self, cb=None):
-        try:
-            loop = asyncio.get_running_loop()
-            loop.stop()
-        except RuntimeError:
-            # Already stopped
-            pass
+        # Searches stop where they are, the worker finishes what is in
+        # flight and drops what is queued, then the writer flushes
+        for task in getattr(self, "_search_tasks", ()):
+            task.cancel()
+        self.worker.stop()
+        self.search_queue.put_nowait(None)
+
+    def _close(self, tasks: list = ()):
+        # Marks and windows only move once the rows they cover are in the
+        # output, so not after the worker or the writer failed. The writer
+        # commits windows itself as it journals their rows
+        ok = all(not t.cancelled() and t.exception() is None for t in tasks)
+        if self.watermarks is not None and ok:
+            for query, left in self.unfinished.items():
+                if left == 0:
+                    self.watermarks.set(query, self.until)
+        if self.fingerprints is not None:
+            if ok and self.writer is None:
+                self.fingerprints.commit()
+            self.fingerprints.close()
+        if self.writer is None and self.seen is not None:
+            self.seen.close()
+        if self.index is not None:
+            self.index.close()
+        if self.parser is not None:
+            self.parser.shutdown()
+        if self.profiler is not None:
+            self.profiler.stop()
+
+    async def _finish(self, search_tasks: list):
+        results = await asyncio.gather(*search_tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("search failed", exc_info=result)
+        logger.debug("All searches complete")
+        self.worker.stop()
+        await self.search_queue.put(None)
+
+    async def _mark_windows(self):
+        # Windows are recorded once their rows are queued, so the writer
+        # commits them after flushing whatever is ahead of the marker
+        if self.writer is None or self.fingerprints is None:
+            return
+        if self.fingerprints.recorded > self._marked:
+            self._marked = self.fingerprints.recorded
+            await self.output_queue.put(Recorded(self._marked))
 
-    async def _search(self):
-        logger.debug("Search started")
+    async def _search(self, search: Search):
+        logger.debug("Search started from %s", search.continue_from)
         try:
             resp = None
-            gen = self.search.gen()
-            kwargs, state = await gen.asend(None)
+            gen = search.gen()
+            request, state = await gen.asend(None)
+            backoff = Backoff(base=1)
+            failures = 0
             while True:
-                await self.search_queue.put(kwargs)
-                raw = await self.data_queue.get()
-                resp = QueryResponse(raw)
+                try:
+                    resp = await self.worker.request(
+                        self.search_queue, request, key=search.query
+                    )
+                except RateLimitExceededException:
+                    # The budget holds the page back until the window resets
+                    self.metrics.inc("stalkerbot_retries_total", reason="rate_limited")
+                    continue
+                except (HTTPException, ParsingError) as e:
+                    if not retryable(e):
+                        raise
+                    failures += 1
+                    if failures > self.page_retries:
+                        # Left for a resume, the shard is still pending
+                        raise
+                    delay = backoff.delay(failures)
+                    logger.info(
+                        "page failed with %r, re-queueing in %.1fs", e, delay
+                    )
+                    self.metrics.inc("stalkerbot_retries_total", reason="requeue")
+                    await asyncio.sleep(delay)
+                    continue
+                failures = 0
                 if self.progress is not None:
                     self.progress.update()
+                    self.used.total = resp.rateLimit.limit or self.used.total
+                    if resp.rateLimit.remaining is not None:
+                        self.used.n = self.used.total - resp.rateLimit.remaining
+                    self.used.refresh()
                 for user in resp.users:
-                    if user.email is not None and len(user.email) > 0:
+                    if user.email:
                         await self.output_queue.put(user)
                 self.state = state
-                await self.writer.data_queue.put(state)
-                kwargs, state = await gen.asend(resp)
-                await asyncio.sleep(max(0.01, random()))
+                if self.writer is not None:
+                    await self.output_queue.put(state)
+                request, state = await gen.asend(resp)
+                await self._mark_windows()
+        except StopAsyncIteration:
+            self.unfinished[search.query] -= 1
+            await self._mark_windows()
+            if self.writer is not None:
+                # Mark the shard as complete so a resume skips it
+                await self.output_queue.put(
+                    State(search.since, search.query, None, search.since)
+                )
         except RuntimeError:
             pass
@@ -0,0 +1,86 @@
+import asyncio
+from dataclasses import dataclass, field
+from logging import getLogger
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = getLogger("transport")
+
+
+@dataclass
+class Response:
+    status_code: int
+    content: bytes
+    headers: dict = field(default_factory=dict)
+
+
+# One pooled keep-alive session shared by every request in the process. The
+# session is created lazily so it binds to whichever loop is running, and
+# max_concurrent bounds both the pool and the number of requests in flight.
+# The session and semaphore belong to that loop, a later loop (another
+# asyncio.run) gets its own.
+class Transport:
+    def __init__(
+        self,
+        max_concurrent: int = 25,
+        timeout: float = 60,
+        compress: bool = True,
+        keepalive_timeout: float = 75,
+    ):
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.compress = compress
+        self.keepalive_timeout = keepalive_timeout
+        self._session: "aiohttp.ClientSession" = None
+        self._semaphore: asyncio.Semaphore = None
+        self._loop: asyncio.AbstractEventLoop = None
+
+    @property
+    def session(self) -> "aiohttp.ClientSession":
+        if self._session is None or self._session.closed:
+            # Imported here, it takes longer to load than the rest of stalkerbot
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrent,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            headers = {"Accept-Encoding": "gzip" if self.compress else "identity"}
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            logger.debug("opened session, pool size %i", self.max_concurrent)
+        return self._session
+
+    @property
+    def in_flight(self) -> int:
+        if self._semaphore is None:
+            return 0
+        return self.max_concurrent - self._semaphore._value
+
+    async def request(self, method: str, url: str, **kwargs) -> Response:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._session = None
+            self._semaphore = None
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        async with self._semaphore:
+            async with self.session.request(method.upper(), url, **kwargs) as resp:
+                content = await resp.read()
+                return Response(resp.status, content, dict(resp.headers))
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._semaphore = None
+        self._loop = None
+
+
+default_transport = Transport()
@@ -0,0 +1,113 @@
+import random
+from logging import getLogger
+
+from stalkerbot.ratelimit import RateLimitBudget
+from stalkerbot.utils import MAX_PAGE_SIZE
+
+logger = getLogger("tuning")
+
+# Node fields the output needs, createdAt is left out unless asked for
+NODE_FIELDS = ("name", "login", "email")
+
+CANDIDATES = (10, 25, 50, 75, 100)
+
+
+def validate_page_size(page_size: int) -> int:
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f"page size must be between 1 and {MAX_PAGE_SIZE}")
+    return page_size
+
+
+class _Stats:
+    __slots__ = ("pages", "cost", "latency", "emails")
+
+    def __init__(self):
+        self.pages = 0
+        self.cost = 0.0
+        self.latency = 0.0
+        self.emails = 0.0
+
+
+# Chooses the page size searches ask for from what pages of each size have
+# cost, taken and returned so far (moving averages). While the rate limit
+# budget is being paced the size with the most emails per point wins,
+# otherwise the one with the most emails per second of latency. Pages that
+# fail with a 5xx or time out, which GitHub does for heavy searches, knock the
+# size down a step. Now and then a neighbouring size is tried so the choice
+# can follow the data.
+class PageSizeTuner:
+    def __init__(
+        self,
+        max_size: int = MAX_PAGE_SIZE,
+        budget: RateLimitBudget = None,
+        explore: float = 0.05,
+        decay: float = 0.2,
+        min_pages: int = 3,
+        fields: tuple = NODE_FIELDS,
+    ):
+        validate_page_size(max_size)
+        self.sizes = sorted({s for s in CANDIDATES if s < max_size} | {max_size})
+        self.budget = budget
+        self.explore = explore
+        self.decay = decay
+        self.min_pages = min_pages
+        self.fields = fields
+        self.stats = {size: _Stats() for size in self.sizes}
+        self.current = max_size
+        self.random = random.Random()
+
+    @property
+    def budget_bound(self) -> bool:
+        budget = self.budget
+        return (
+            budget is not None
+            and budget.remaining is not None
+            and budget.available < budget.burst
+        )
+
+    def page_size(self) -> int:
+        if self.random.random() < self.explore:
+            i = self.sizes.index(self.current) + self.random.choice((-1, 1))
+            return self.sizes[min(max(i, 0), len(self.sizes) - 1)]
+        return self.current
+
+    def record(self, size: int, latency: float, cost: float, emails: int):
+        stats = self.stats.get(size)
+        if stats is None:
+            return
+        if stats.pages == 0:
+            stats.cost, stats.latency, stats.emails = cost, latency, emails
+        else:
+            a = self.decay
+            stats.cost += a * (cost - stats.cost)
+            stats.latency += a * (latency - stats.latency)
+            stats.emails += a * (emails - stats.emails)
+        stats.pages += 1
+        self._choose()
+
+    def failed(self, size: int):
+        i = self.sizes.index(size) if size in self.sizes else len(self.sizes) - 1
+        smaller = self.sizes[max(i - 1, 0)]
+        if smaller < self.current:
+            logger.info("page size %i failed, dropping to %i", size, smaller)
+            self.current = smaller
+        # Forget the failing size so it is only chosen again once it has
+        # proven itself again
+        self.stats[self.sizes[i]] = _Stats()
+
+    def _score(self, stats: _Stats) -> float:
+        if self.budget_bound:
+            return stats.emails / max(stats.cost, 1e-9)
+        return stats.emails / max(stats.latency, 1e-9)
+
+    def _choose(self):
+        known = [s for s in self.sizes if self.stats[s].pages >= self.min_pages]
+        if not known:
+            return
+        best = max(known, key=lambda s: self._score(self.stats[s]))
+        if best != self.current and (
+            self.current not in known
+            or self._score(self.stats[best]) > self._score(self.stats[self.current])
+        ):
+            logger.debug("page size %i -> %i", self.current, best)
+            self.current = best
@@ -1,18 +1,38 @@
 import asyncio
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 import datetime
 import json
-import requests
+import re
+import time
 from logging import getLogger
+from typing import ClassVar, NamedTuple, Union
+
+from stalkerbot.concurrency import AIMDLimiter
+from stalkerbot.exc import ParsingError
+from stalkerbot.metrics import Metrics, default_metrics
+from stalkerbot.retry import (
+    RETRYABLE,
+    SECONDARY_LIMIT,
+    Backoff,
+    CircuitBreaker,
+    classify,
+    default_breaker,
+    retry_after,
+)
+from stalkerbot.transport import Response, Transport, default_transport
 
 logger = getLogger("utils")
 
+GRAPHQL_URL = "https://api.github.com/graphql"
+
 
 @dataclass(frozen=True)
 class State:
     continue_from: datetime.datetime
     query: str
     cursor: str
+    since: datetime.datetime = None
+    window_start: datetime.datetime = None
 
 
 @dataclass
@@ -22,46 +42,74 @@ class SearchResult:
     items: list[str]
 
 
-@dataclass
-class ParsedData:
+class ParsedData(NamedTuple):
+    # Tuple backed so a page of users is cheap to build and to pickle back
+    # from a parser process. createdAt stays the ISO string GitHub sent.
     name: str
     login: str
     email: str
-    createdAt: datetime.datetime
+    createdAt: str
 
-    def __post_init__(self):
-        if isinstance(self.createdAt, str):
-            self.createdAt = datetime.datetime.fromisoformat(self.createdAt[:-1])
+    @property
+    def created(self) -> datetime.datetime:
+        return datetime.datetime.fromisoformat(self.createdAt[:-1])
 
 
 async def requests_future(
     method: str,
     *args,
-    _backoff: float = 0.1,
+    _backoff: float = 0.5,
     _max_wait: float = 32,
     _max_retries: int = 10,
+    _transport: Transport = None,
+    _metrics: Metrics = None,
+    _breaker: CircuitBreaker = None,
+    _limiter: AIMDLimiter = None,
     **kwargs,
-) -> requests.Response:
-    for i in range(_max_retries):
-
-        async def _request():
-            return getattr(requests, method.lower())(*args, **kwargs)
+) -> Response:
+    # Retries timeouts, 5xx, secondary limits and 200s that only carry
+    # GraphQL errors. Anything else is returned at once, and so is the last
+    # response, or None after a timeout, once retries run out. The caller
+    # decides what a failure means for its request. Every attempt is
+    # reported to `_limiter` so it can adjust concurrency.
+    from aiohttp import ClientError
 
+    transport = _transport or default_transport
+    metrics = _metrics or default_metrics
+    breaker = _breaker or default_breaker
+    backoff = Backoff(_backoff, _max_wait)
+    resp = None
+    for attempt in range(_max_retries):
+        await breaker.wait()
+        start = time.monotonic()
         try:
-            resp: requests.Response = await _request()
+            resp = await transport.request(method, *args, **kwargs)
+        except (asyncio.TimeoutError, ClientError):
+            resp = None
+        outcome = classify(resp)
+        if _limiter is not None:
+            _limiter.record(outcome, time.monotonic() - start)
+        if outcome not in RETRYABLE:
+            breaker.success()
             return resp
-        except requests.exceptions.ReadTimeout:
-            logger.info("read timeout")
-            await asyncio.sleep(_backoff)
-            continue
-        if resp.status_code == 429:
-            logger.info("sleeping backoff")
-            await asyncio.sleep(min(2 ** i + _backoff, _max_wait))
-        elif resp.status_code >= 502:
-            logger.info("sleeping")
-            await asyncio.sleep(_backoff)
+        metrics.inc(
+            "stalkerbot_retries_total",
+            reason=outcome,
+            status=resp.status_code if resp is not None else "timeout",
+        )
+        wait = retry_after(resp)
+        if outcome == SECONDARY_LIMIT:
+            breaker.pause(wait if wait is not None else backoff.delay(attempt))
         else:
-            raise Exception(resp.status_code, resp.content)
+            breaker.failure()
+        if attempt + 1 < _max_retries:
+            delay = backoff.delay(attempt, wait)
+            logger.info(
+                "%s on attempt %i, retrying in %.1fs", outcome, attempt + 1, delay
+            )
+            await asyncio.sleep(delay)
+    logger.warning("giving up after %i attempts", _max_retries)
+    return resp
 
 
 @dataclass
@@ -70,11 +118,15 @@ class RateLimit:
     used: int
     remaining: int
     resetAt: datetime
+    limit: int = None
 
     def __post_init__(self):
         if isinstance(self.resetAt, str):
-            offset = datetime.timedelta(hours=+4)
-            self.resetAt = datetime.datetime.fromisoformat(self.resetAt[:-1]) + offset
+            # Naive UTC, like datetime.utcnow()
+            reset_at = datetime.datetime.fromisoformat(self.resetAt.replace("Z", "+00:00"))
+            if reset_at.tzinfo is not None:
+                reset_at = reset_at.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            self.resetAt = reset_at
 
 
 @dataclass
@@ -82,22 +134,114 @@ class PageInfo:
     hasNextPage: bool
     hasPreviousPage: bool
     endCursor: str
+    startCursor: str = None
 
 
-@dataclass
 class QueryResponse:
-    _raw: str
-    rateLimit: RateLimit = field(init=False)
-    pageInfo: PageInfo = field(init=False)
-    users: list[ParsedData] = field(init=False)
-    userCount: int = field(init=False)
+    __slots__ = ("rateLimit", "pageInfo", "users", "userCount")
+
+    def __init__(self, raw: str = None, emails_only: bool = False, email_pattern: str = None):
+        # The raw body is not kept once parsed
+        if raw is not None:
+            data = json.loads(raw)["data"]
+            self._parse(
+                RateLimit(**data["rateLimit"]), data["search"], emails_only, email_pattern
+            )
+
+    def _parse(
+        self,
+        rate_limit: RateLimit,
+        search: dict,
+        emails_only: bool,
+        email_pattern: str = None,
+    ):
+        self.rateLimit = rate_limit
+        if "pageInfo" in search:
+            self.pageInfo = PageInfo(**search["pageInfo"])
+        else:
+            # Count-only probe
+            self.pageInfo = PageInfo(False, False, None)
+        nodes = search.get("nodes", ())
+        if emails_only:
+            # Nodes whose email does not match are dropped as dicts, before
+            # a user is built for them
+            match = re.compile(email_pattern).search if email_pattern else None
+            self.users = [
+                ParsedData(d.get("name"), d["login"], d["email"], d.get("createdAt"))
+                for d in nodes
+                if d and d.get("email") and (match is None or match(d["email"]))
+            ]
+        else:
+            self.users = [
+                ParsedData(d.get("name"), d["login"], d.get("email"), d.get("createdAt"))
+                for d in nodes
+                if d
+            ]
+        self.userCount = search["userCount"]
+
+    @classmethod
+    def from_search(
+        cls,
+        rate_limit: RateLimit,
+        search: dict,
+        emails_only: bool = False,
+        email_pattern: str = None,
+    ) -> "QueryResponse":
+        response = cls()
+        response._parse(rate_limit, search, emails_only, email_pattern)
+        return response
+
+    def __getstate__(self):
+        return (self.rateLimit, self.pageInfo, self.users, self.userCount)
+
+    def __setstate__(self, state):
+        self.rateLimit, self.pageInfo, self.users, self.userCount = state
+
+
+# GitHub refuses first/last above this
+MAX_PAGE_SIZE = 100
+
+
+@dataclass
+class SearchRequest:
+    alias: ClassVar[str] = "s"
+    q: str
+    cursor: str = None
+    page_size: int = 100
+    user_type: str = "User"
+    count_only: bool = False
+    fields: tuple = ("name", "login", "email", "createdAt")
 
     def __post_init__(self):
-        data = json.loads(self._raw)["data"]
-        self.rateLimit = RateLimit(**data["rateLimit"])
-        self.pageInfo = PageInfo(**data["search"]["pageInfo"])
-        self.users = [ParsedData(**d) for d in data["search"]["nodes"] if d]
-        self.userCount = data["search"]["userCount"]
+        if not self.count_only and not 1 <= self.page_size <= MAX_PAGE_SIZE:
+            raise ValueError(f"page size must be between 1 and {MAX_PAGE_SIZE}")
+
+    def field(self, alias: str = None) -> str:
+        name = f"{alias}: search" if alias else "search"
+        if self.count_only:
+            # No nodes or pagination, just the size of the result set
+            return f"{name}(query: {json.dumps(self.q)}, type: USER) {{userCount}}"
+        cursor_arg = f'before: "{self.cursor}",' if self.cursor is not None else ""
+        search_args = f"query: {json.dumps(self.q)}, {cursor_arg} last: {self.page_size}, type: USER"
+        fields = " ".join(self.fields)
+        return f"{name}({search_args}) {{pageInfo {{hasNextPage hasPreviousPage startCursor endCursor}} userCount nodes {{... on {self.user_type} {{{fields}}}}}}}"
+
+
+# One user looked up by login. Plain object lookups cost no more than the
+# request they ride in, so a batch of them costs a single point.
+@dataclass
+class UserRequest:
+    alias: ClassVar[str] = "u"
+    login: str
+    fields: tuple = ("name", "login", "email")
+
+    def field(self, alias: str = None) -> str:
+        name = f"{alias}: user" if alias else "user"
+        login = json.dumps(self.login)
+        return f"{name}(login: {login}) {{{' '.join(self.fields)}}}"
+
+
+RATE_LIMIT_FIELD = "rateLimit{limit cost used remaining resetAt}"
 
 
 def create_query(
@@ -106,7 +250,52 @@ def create_query(
     page_size: int = 100,
     user_type: str = "User",
 ) -> str:
-    cursor_arg = f'before: "{cursor}",' if cursor is not None else ""
-    search_args = f'query: "{q}", {cursor_arg} last: {page_size}, type: USER'
-    q = f"{{rateLimit{{cost used remaining resetAt}} search({search_args}) {{pageInfo {{hasNextPage hasPreviousPage endCursor}} userCount nodes {{... on {user_type} {{name login email createdAt}}}}}}}}\n"
-    return q
+    search = SearchRequest(q, cursor, page_size, user_type)
+    return f"{{{RATE_LIMIT_FIELD} {search.field()}}}\n"
+
+
+def create_count_query(q: str = "language:python3") -> str:
+    search = SearchRequest(q, count_only=True)
+    return f"{{{RATE_LIMIT_FIELD} {search.field()}}}\n"
+
+
+def create_batch_query(requests: list[Union[SearchRequest, UserRequest]]) -> str:
+    # One aliased field per request, s0 .. sN for searches and u0 .. uN for
+    # user lookups, sharing one rateLimit
+    fields = " ".join(r.field(f"{r.alias}{i}") for i, r in enumerate(requests))
+    return f"{{{RATE_LIMIT_FIELD} {fields}}}\n"
+
+
+def parse_batch(
+    raw: str, size: int, emails_only: bool = False, email_pattern: str = None
+) -> tuple[RateLimit, list[Union[QueryResponse, ParsedData, ParsingError]]]:
+    # Results in request order. A search GraphQL could not resolve comes back
+    # as a ParsingError carrying the errors reported for its alias, a user
+    # lookup as ParsedData or None if there is no such user. Runs in a
+    # parser thread or process, so it only touches its arguments.
+    body = json.loads(raw)
+    data = body.get("data") or {}
+    if data.get("rateLimit") is None:
+        raise ParsingError(body.get("errors"))
+    rate_limit = RateLimit(**data["rateLimit"])
+    results = []
+    for i in range(size):
+        if f"u{i}" in data:
+            node = data[f"u{i}"]
+            results.append(
+                ParsedData(node.get("name"), node["login"], node.get("email"), None)
+                if node
+                else None
+            )
+            continue
+        search = data.get(f"s{i}")
+        if search is None:
+            errors = [
+                e for e in body.get("errors", []) if e.get("path", [None])[0] == f"s{i}"
+            ]
+            results.append(ParsingError(errors or body.get("errors")))
+        else:
+            results.append(
+                QueryResponse.from_search(rate_limit, search, emails_only, email_pattern)
+            )
+    return rate_limit, results
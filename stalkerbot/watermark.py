@@ -0,0 +1,34 @@
+import json
+import os
+from datetime import datetime
+from logging import getLogger
+
+logger = getLogger("watermark")
+
+
+# Per query high-water mark of signup times already crawled into an output.
+# A mark is only moved forward once a crawl up to it has finished, so an
+# incremental run can start there and every user created before it is
+# already in the output.
+class Watermarks:
+    def __init__(self, path: str):
+        self.path = path
+        self.marks = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fp:
+                self.marks = json.load(fp)
+
+    def get(self, query: str) -> datetime:
+        mark = self.marks.get(query)
+        return datetime.fromisoformat(mark) if mark is not None else None
+
+    def set(self, query: str, mark: datetime):
+        current = self.get(query)
+        if current is not None and current >= mark:
+            return
+        logger.info("%s crawled up to %s", query, mark.isoformat())
+        self.marks[query] = mark.isoformat()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fp:
+            json.dump(self.marks, fp, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
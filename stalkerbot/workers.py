@@ -1,26 +1,44 @@
 import asyncio
 import logging
-import os
+import math
+import time
 from asyncio.queues import Queue, QueueEmpty, QueueFull
-from http.cookiejar import CookieJar
-from random import random
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Union
 
-import requests
-from bs4 import BeautifulSoup
-
-from stalkerbot.exc import (
-    HTTPException,
-    MaxRetriesExceededException,
-    ParsingError,
-    RateLimitExceededException,
+from stalkerbot.concurrency import AIMDLimiter
+from stalkerbot.dedup import SeenIndex
+from stalkerbot.exc import HTTPException, RateLimitExceededException
+from stalkerbot.fingerprints import Recorded, WindowFingerprints
+from stalkerbot.journal import Journal
+from stalkerbot.metrics import Metrics, default_metrics
+from stalkerbot.ratelimit import RateLimitBudget
+from stalkerbot.retry import RATE_LIMITED, CircuitBreaker, classify, retry_after
+from stalkerbot.scheduler import FairQueue
+from stalkerbot.sinks import Sink
+from stalkerbot.transport import Transport
+from stalkerbot.tuning import PageSizeTuner
+from stalkerbot.utils import (
+    GRAPHQL_URL,
+    ParsedData,
+    QueryResponse,
+    RateLimit,
+    SearchRequest,
+    UserRequest,
+    create_batch_query,
+    parse_batch,
+    requests_future,
+    State,
 )
-from stalkerbot.utils import ParsedData, SearchResult, requests_future, State
 from functools import partial
-from tqdm.asyncio import tqdm
-import pickle
+
+if TYPE_CHECKING:
+    from tqdm.asyncio import tqdm_asyncio
 
 logger = logging.getLogger("worker")
 
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
 
 class StalkerWorker:
     def __init__(
@@ -30,131 +48,509 @@ class StalkerWorker:
         max_timeout=32,
         max_concurrent=25,
         tqcb: "tqdm_asyncio" = None,
+        transport: Transport = None,
+        budget: RateLimitBudget = None,
+        token: str = None,
+        batch_size: int = 10,
+        parser: Executor = None,
+        emails_only: bool = False,
+        email_pattern: str = None,
+        endpoint: str = GRAPHQL_URL,
+        metrics: Metrics = None,
+        tuner: PageSizeTuner = None,
+        breaker: CircuitBreaker = None,
+        limiter: AIMDLimiter = None,
     ):
         self.output_queue = output_queue
+        self.breaker = breaker or CircuitBreaker()
+        self.endpoint = endpoint
+        self.metrics = metrics or default_metrics
+        self.tuner = tuner
         self.max_retries = max_retries
         self.max_timeout = max_timeout
+        self.max_concurrent = max_concurrent
+        self.limiter = limiter or AIMDLimiter(ceiling=max_concurrent)
+        self.transport = transport or Transport(max_concurrent=self.limiter.ceiling)
+        self.budget = budget
+        self.batch_size = batch_size
+        self.parser = parser
+        self.emails_only = emails_only
+        self.email_pattern = email_pattern
+        self.headers = {"Content-Type": "application/json"}
+        if token:
+            self.headers["Authorization"] = f"Bearer {token}"
         self.stop_flag = False
+        self._reserving: asyncio.Future = None
+
+    async def astart(self, input_queue: FairQueue):
+        # Items are (request, future) pairs. SearchRequests and UserRequests
+        # waiting in the queue together are sent as one aliased query and
+        # every future gets its own result. Plain request kwargs are sent as
+        # they are and their content goes to the future, or to output_queue if
+        # there is none. None wakes the loop up so a stopped worker can exit.
+        # How many requests go out at once is up to the limiter.
+        slots = self.limiter
+        pending = set()
+        try:
+            while not self.stop_flag or input_queue.qsize() > 0:
+                await input_queue.wait()
+                # A slot and the points are waited for before anything is
+                # taken, so the queue picks what goes once they are granted
+                await slots.acquire()
+                cost = await self._reserve(min(input_queue.qsize(), self.batch_size))
+                batch = []
+                for item in input_queue.take(self.batch_size):
+                    if item is None:
+                        continue
+                    if not isinstance(item, tuple):
+                        item = (item, None)
+                    if item[1] is not None and item[1].done():
+                        # Whoever asked has given up, e.g. a cancelled search
+                        pass
+                    elif isinstance(item[0], (SearchRequest, UserRequest)):
+                        batch.append(item)
+                    else:
+                        self._spawn(pending, self._fetch(*item, slots))
+                if cost:
+                    # Points reserved for requests that were not taken
+                    used = math.ceil(self.budget.cost * len(batch)) if batch else 0
+                    if cost > used:
+                        self.budget.release(cost - used)
+                        cost = used
+                if batch:
+                    self._spawn(pending, self._fetch_batch(batch, slots, cost))
+                else:
+                    slots.release()
+            if pending:
+                await asyncio.gather(*pending)
+        finally:
+            await self.transport.close()
+
+    async def _reserve(self, searches: int) -> int:
+        # Given up on when the worker is stopped, whatever is still queued
+        # then is reserved for by its own request
+        if self.budget is None or searches == 0:
+            return 0
+        self._reserving = asyncio.ensure_future(
+            self.budget.reserve(math.ceil(self.budget.cost * searches))
+        )
+        try:
+            with self.metrics.timer("stalkerbot_budget_wait_seconds"):
+                return await self._reserving
+        except asyncio.CancelledError:
+            if not self.stop_flag:
+                raise
+            return 0
+        finally:
+            self._reserving = None
 
-    async def astart(self, input_queue: Queue):
-        while not self.stop_flag or (self.stop_flag and input_queue.qsize() > 0):
-            kwargs = await input_queue.get()
-            resp = await requests_future(
-                "post", "https://api.github.com/graphql", **kwargs
+    def _spawn(self, pending: set, coro):
+        task = asyncio.get_event_loop().create_task(coro, name="fetch")
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    async def _fetch_batch(self, batch: list, slots: AIMDLimiter, cost: int = 0):
+        try:
+            if self.budget is not None and not cost:
+                with self.metrics.timer("stalkerbot_budget_wait_seconds"):
+                    cost = await self.budget.reserve(
+                        math.ceil(self.budget.cost * len(batch))
+                    )
+            self.metrics.observe(
+                "stalkerbot_batch_searches", len(batch), buckets=BATCH_BUCKETS
+            )
+            start = time.perf_counter()
+            with self.metrics.timer("stalkerbot_request_seconds"):
+                resp = await requests_future(
+                    "post",
+                    self.endpoint,
+                    _max_retries=self.max_retries,
+                    _max_wait=self.max_timeout,
+                    _transport=self.transport,
+                    _metrics=self.metrics,
+                    _breaker=self.breaker,
+                    _limiter=self.limiter,
+                    headers=self.headers,
+                    json={"query": create_batch_query([search for search, _ in batch])},
+                )
+            latency = time.perf_counter() - start
+            self.metrics.inc(
+                "stalkerbot_responses_total",
+                status=resp.status_code if resp is not None else 0,
             )
-            if resp.status_code == 200:
+            if classify(resp) == RATE_LIMITED:
+                self._exhausted(resp, cost)
+                cost = 0
+                raise RateLimitExceededException(resp.status_code, resp.content)
+            if resp is None or resp.status_code != 200:
+                status = resp.status_code if resp is not None else 0
+                content = resp.content if resp is not None else b""
+                if self.tuner is not None and (status == 0 or status >= 500):
+                    # Heavy searches time out or fail upstream, go lighter
+                    self._tune_failed(batch)
+                raise HTTPException(status, content)
+            with self.metrics.timer("stalkerbot_parse_seconds"):
+                rate_limit, results = await self._parse(resp.content, len(batch))
+            if cost:
+                self.budget.update(rate_limit, reserved=cost, searches=len(batch))
+                cost = 0
+            if self.tuner is not None:
+                self._tune(batch, results, rate_limit, latency)
+            for (_, reply), result in zip(batch, results):
+                if reply.done():
+                    continue
+                if isinstance(result, Exception):
+                    reply.set_exception(result)
+                else:
+                    reply.set_result(result)
+        except Exception as e:
+            if cost:
+                self.budget.release(cost)
+            for _, reply in batch:
+                if not reply.done():
+                    reply.set_exception(e)
+        finally:
+            slots.release()
+
+    def _exhausted(self, resp, cost: int):
+        if self.budget is not None:
+            # Refused requests are free, so what was reserved is given back
+            self.budget.release(cost)
+            self.budget.exhausted(retry_after(resp))
+
+    def _tune(self, batch: list, results: list, rate_limit: RateLimit, latency: float):
+        # Cost and latency are per request, shared out evenly between the
+        # searches in it
+        share = len(batch)
+        cost = rate_limit.cost
+        for (search, _), result in zip(batch, results):
+            if (
+                not isinstance(search, SearchRequest)
+                or search.count_only
+                or isinstance(result, Exception)
+            ):
+                continue
+            self.tuner.record(
+                search.page_size, latency / share, cost / share, len(result.users)
+            )
+
+    def _tune_failed(self, batch: list):
+        sizes = {
+            search.page_size
+            for search, _ in batch
+            if isinstance(search, SearchRequest) and not search.count_only
+        }
+        if sizes:
+            self.tuner.failed(max(sizes))
+
+    async def _parse(self, raw: bytes, size: int):
+        if self.parser is None:
+            return parse_batch(raw, size, self.emails_only, self.email_pattern)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.parser, parse_batch, raw, size, self.emails_only, self.email_pattern
+        )
+
+    async def _fetch(
+        self, kwargs: dict, reply: asyncio.Future, slots: AIMDLimiter
+    ):
+        cost = 0
+        await slots.acquire()
+        try:
+            if self.budget is not None:
+                with self.metrics.timer("stalkerbot_budget_wait_seconds"):
+                    cost = await self.budget.reserve()
+            kwargs.setdefault("headers", self.headers)
+            with self.metrics.timer("stalkerbot_request_seconds"):
+                resp = await requests_future(
+                    "post",
+                    self.endpoint,
+                    _max_retries=self.max_retries,
+                    _max_wait=self.max_timeout,
+                    _transport=self.transport,
+                    _metrics=self.metrics,
+                    _breaker=self.breaker,
+                    _limiter=self.limiter,
+                    **kwargs,
+                )
+            self.metrics.inc(
+                "stalkerbot_responses_total",
+                status=resp.status_code if resp is not None else 0,
+            )
+            if classify(resp) == RATE_LIMITED:
+                self._exhausted(resp, cost)
+                cost = 0
+                raise RateLimitExceededException(resp.status_code, resp.content)
+            if cost and (resp is None or resp.status_code != 200):
+                self.budget.release(cost)
+                cost = 0
+            if reply is not None:
+                if resp is not None and resp.status_code == 200:
+                    reply.set_result(resp.content)
+                else:
+                    status = resp.status_code if resp is not None else 0
+                    content = resp.content if resp is not None else b""
+                    reply.set_exception(HTTPException(status, content))
+            elif resp is not None and resp.status_code == 200:
                 await self.output_queue.put(resp.content)
+            else:
+                logger.warning(
+                    "request failed with status %s, nothing to hand it back to",
+                    resp.status_code if resp is not None else "timeout",
+                )
+        except Exception as e:
+            if cost:
+                self.budget.release(cost)
+            if reply is None or reply.done():
+                raise
+            reply.set_exception(e)
+        finally:
+            slots.release()
 
     def stop(self, *args, **kwargs):
         self.stop_flag = True
+        if self._reserving is not None:
+            self._reserving.cancel()
+
+    async def request(
+        self,
+        input_queue: FairQueue,
+        request: Union[SearchRequest, dict],
+        key: str = None,
+    ) -> Union[QueryResponse, bytes]:
+        # `key` picks the FairQueue lane the request waits in
+        reply = asyncio.get_event_loop().create_future()
+        if key is None:
+            await input_queue.put((request, reply))
+        else:
+            await input_queue.put((request, reply), key=key)
+        return await reply
 
 
-class CSVWriter:
+# fsync policies: "never" leaves it to the OS, "flush" syncs after every
+# flush and "interval" at most once every `fsync_interval` seconds
+FSYNC_POLICIES = ("never", "flush", "interval")
+
+
+class OutputWriter:
     def __init__(
         self,
         queue: Queue,
-        filename: str,
-        max_interval: int = 2,
+        sink: Sink,
+        max_interval: float = 2,
         max_chunk: int = 100,
         include_headers: bool = False,
         silent: bool = False,
         early_stop: int = None,
+        seen: SeenIndex = None,
+        journal: Journal = None,
+        fingerprints: WindowFingerprints = None,
+        fsync: str = "never",
+        fsync_interval: float = 30,
+        metrics: Metrics = None,
     ):
-        self.filename = filename
-        if not os.path.exists(filename):
-            head, tail = os.path.split(self.filename)
-            if len(head) > 0:
-                os.makedirs(head, exist_ok=True)
-        self._write_headers()
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {', '.join(FSYNC_POLICIES)}")
+        self.sink = sink
+        self.metrics = metrics or default_metrics
+        self.seen = seen
+        self.journal = journal
+        self.fingerprints = fingerprints
+        if sink.empty:
+            if self.seen is not None:
+                # Nothing written yet, so nothing can have been seen
+                self.seen.clear()
+        self.duplicates = 0
 
         self.max_interval = max_interval
         self.max_chunk = max_chunk
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
         self.data_queue = queue
         self.stop_flag = False
         self.early_stop = early_stop
         self.total = 0
         if not silent:
+            from tqdm.asyncio import tqdm
+
             self.progress = tqdm(desc="written", unit="emails")
         else:
             self.progress = None
         self.state = None
+        self.states = {}
+        self._dirty = False
+        self._recorded = 0
+        self._uncommitted = 0
+        self._last_sync = 0.0
+        # One thread keeps writes in order and off the event loop
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+        self.flushes = 0
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.started = None
+
+    @property
+    def rows_per_second(self) -> float:
+        if self.started is None:
+            return 0.0
+        elapsed = time.monotonic() - self.started
+        return self.total / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def mean_flush_time(self) -> float:
+        return self.flush_time / self.flushes if self.flushes else 0.0
 
     async def astart(self):
         loop = asyncio.get_event_loop()
+        self.started = time.monotonic()
+        await loop.run_in_executor(self._io, self.sink.open)
         chunk = []
-
-        timeout = loop.call_at(
-            loop.time() + self.max_interval, callback=partial(self._write, chunk)
-        )
-        logger.debug("set write interval %i", self.max_interval)
-
-        while not self.stop_flag:
-            if timeout.cancelled:
-                timeout = loop.call_at(
-                    loop.time() + self.max_interval,
-                    callback=partial(self._write, chunk),
-                )
-            try:
-                data = self.data_queue.get_nowait()
-                if isinstance(data, State):
-                    self.state = data
-                    self._save(data)
-                    continue
-                chunk.append(f"{data.name},{data.login},{data.email}\n")
-                if len(chunk) >= self.max_chunk:
-                    timeout.cancel()
-                    self._write(chunk)
-                    # await loop.run_in_executor(None, partial(self._write, chunk))
-                    self._write(chunk)
-                    timeout = loop.call_at(
-                        loop.time() + self.max_interval,
-                        callback=partial(self._write, chunk),
-                    )
+        due = None
+        try:
+            while not self.stop_flag:
+                timeout = None if due is None else max(0.0, due - loop.time())
+                try:
+                    data = await asyncio.wait_for(self.data_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    data = None
+                # Take whatever else is already waiting without another wait
+                while data is not None:
+                    self._add(data, chunk)
+                    if len(chunk) >= self.max_chunk:
+                        break
+                    try:
+                        data = self.data_queue.get_nowait()
+                    except QueueEmpty:
+                        data = None
+                if (chunk or self._dirty) and due is None:
+                    due = loop.time() + self.max_interval
+                if len(chunk) >= self.max_chunk or (
+                    due is not None and loop.time() >= due
+                ):
+                    await self._flush(chunk)
                     chunk = []
-            except QueueEmpty:
-                if timeout.cancelled:
-                    timeout = loop.call_at(
-                        loop.time() + self.max_interval,
-                        callback=partial(self._write, chunk),
-                    )
-                await asyncio.sleep(self.max_interval)
+                    due = None
 
-        # Stop flag triggered
+            # Stop flag triggered
+            while True:
+                try:
+                    data = self.data_queue.get_nowait()
+                except QueueEmpty:
+                    break
+                if data is not None:
+                    self._add(data, chunk)
+            await self._flush(chunk, final=True)
+        finally:
+            await loop.run_in_executor(self._io, self._close)
+            self._io.shutdown(wait=False)
+        if self.duplicates:
+            logger.info("skipped %i duplicates", self.duplicates)
+        logger.info(
+            "wrote %i rows in %i flushes, %.0f rows/s, flush latency mean %.1fms max %.1fms",
+            self.total,
+            self.flushes,
+            self.rows_per_second,
+            self.mean_flush_time * 1000,
+            self.max_flush_time * 1000,
+        )
 
-        while self.data_queue.qsize() > 0:
-            try:
-                data = self.data_queue.get_nowait()
-                if isinstance(data, State):
-                    self._save(data)
-                    continue
-                chunk.append(f"{data.name},{data.login},{data.email}\n")
-            except QueueEmpty:
-                pass
+    def _add(self, data: Union[ParsedData, State, Recorded], chunk: list):
+        if isinstance(data, State):
+            self._track(data)
+        elif isinstance(data, Recorded):
+            # Every row of these windows is ahead of it in the queue
+            self._recorded = data.upto
+            self._dirty = True
+        elif not self._duplicate(data):
+            chunk.append((data.name, data.login, data.email))
 
-        self._write(chunk)
+    def _duplicate(self, data: ParsedData) -> bool:
+        if self.seen is None or not self.seen.seen(data.login, data.email):
+            return False
+        self.duplicates += 1
+        self.metrics.inc("stalkerbot_duplicates_total")
+        return True
 
-    def _save(self, state):
-        with open(".state", "wb") as fp:
-            pickle.dump(state, fp)
+    def _track(self, state: State):
+        # One state per shard, keyed by its query and lower bound. Committed
+        # with the next flush so it never gets ahead of the rows on disk
+        self.state = state
+        self.states[(state.query, state.since)] = state
+        self._dirty = True
 
-    def _write(self, chunk):
-        with open(self.filename, "a+") as fp:
-            fp.writelines(chunk)
-            if self.progress is not None:
-                self.progress.update(len(chunk))
+    async def _flush(self, chunk: list, final: bool = False):
+        if not chunk and not self._dirty and not final:
+            return
+        states = list(self.states.values())
+        recorded = self._recorded
+        self._dirty = False
+        start = time.monotonic()
+        committed = await asyncio.get_event_loop().run_in_executor(
+            self._io, partial(self._write, chunk, states, final)
+        )
+        if committed and self.fingerprints is not None:
+            # Windows are only kept once their rows are journaled, rows
+            # dropped on an early stop leave theirs to be crawled again
+            self.fingerprints.commit(recorded)
+        elapsed = time.monotonic() - start
+        self.flushes += 1
+        self.flush_time += elapsed
+        self.max_flush_time = max(self.max_flush_time, elapsed)
+        self.metrics.observe("stalkerbot_write_seconds", elapsed)
+        self.metrics.inc("stalkerbot_rows_written_total", len(chunk))
         self.total += len(chunk)
+        if self.progress is not None:
+            self.progress.update(len(chunk))
+            self.progress.set_postfix(
+                rows_s=f"{self.rows_per_second:.0f}",
+                flush_ms=f"{elapsed * 1000:.1f}",
+                refresh=False,
+            )
+        logger.debug("flushed %i rows in %.1fms", len(chunk), elapsed * 1000)
         if (
             self.early_stop is not None
             and self.early_stop > 0
             and self.total > self.early_stop
         ):
             self.stop_flag = True
-        chunk.clear()
-        self._save(self.state)
 
-    def _write_headers(self):
-        with open(self.filename, "w") as fp:
-            fp.write("name,username,email\n")
+    def _close(self):
+        self.sink.close()
+        if self.seen is not None:
+            self.seen.close()
+        if self.journal is not None:
+            self.journal.close()
+
+    def _write(self, chunk: list, states: list, final: bool = False) -> bool:
+        # Runs on the writer thread. Rows reach the sink before the
+        # checkpoint that covers them reaches the journal. True once every
+        # row so far is committed.
+        self.sink.write(chunk)
+        now = time.monotonic()
+        synced = (
+            self.fsync == "flush"
+            or (self.fsync == "interval" and now - self._last_sync >= self.fsync_interval)
+            or (self.fsync != "never" and final)
+        )
+        position = self.sink.flush(sync=synced, final=final)
+        if synced:
+            self._last_sync = now
+        if self.seen is not None:
+            self.seen.flush()
+        self._uncommitted += len(chunk)
+        if self.sink.pending:
+            return False
+        if self.journal is not None:
+            self.journal.commit(
+                position, self._uncommitted, states, sync=synced, clean=final
+            )
+        self._uncommitted = 0
+        return True
 
     def stop(self, *args, **kwargs):
         self.stop_flag = True
+        try:
+            # Wake the writer if it is waiting on an empty queue
+            self.data_queue.put_nowait(None)
+        except QueueFull:
+            pass
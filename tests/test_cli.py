@@ -0,0 +1,18 @@
+from datetime import datetime
+
+from stalkerbot.cli import start
+
+
+def params(*args) -> dict:
+    return start.make_context("start", list(args), resilient_parsing=True).params
+
+
+def test_short_output_flag_is_not_taken_by_org():
+    assert params("-o", "data/users.csv.gz")["output"] == "data/users.csv.gz"
+    assert params("-o", "data/users.csv.gz")["org"] is False
+    assert params("--org", "-o", "data/users.db")["org"] is True
+
+
+def test_continue_from_is_a_datetime():
+    assert params("-c", "2020-01-31")["continue_from"] == datetime(2020, 1, 31)
+    assert params()["continue_from"] is None
@@ -0,0 +1,36 @@
+from stalkerbot.compaction import compact
+from stalkerbot.sinks import open_sink
+
+
+def write(path: str, rows: list):
+    sink = open_sink(path)
+    sink.open()
+    sink.write(rows)
+    sink.flush(final=True)
+    sink.close()
+
+
+def test_latest_row_of_every_login_is_kept(tmp_path):
+    crawl = str(tmp_path / "users.csv")
+    refresh = str(tmp_path / "users.refresh.csv")
+    write(
+        crawl,
+        [
+            ("Bob", "bob", "bob@old.example.com"),
+            ("Ada", "ada", "ada@example.com"),
+            ("Bob", "bob", "bob@example.com"),
+            ("Carl", "carl", "carl@example.com"),
+        ],
+    )
+    # Logins are case-insensitive, like in the seen index
+    write(refresh, [("Carl", "Carl", "carl@new.example.com")])
+
+    output = str(tmp_path / "users.compact.jsonl")
+    # A chunk of two rows sorts into several runs that are then merged
+    stats = compact([crawl, refresh], output=output, workers=2, chunk_rows=2)
+    assert (stats.read, stats.written, stats.duplicates, stats.runs) == (5, 3, 2, 3)
+    assert list(open_sink(output).rows()) == [
+        ("Ada", "ada", "ada@example.com"),
+        ("Bob", "bob", "bob@example.com"),
+        ("Carl", "Carl", "carl@new.example.com"),
+    ]
@@ -0,0 +1,30 @@
+import threading
+
+from stalkerbot.dedup import SeenIndex
+
+
+def test_flush_from_another_thread_while_growing(tmp_path):
+    index = SeenIndex(str(tmp_path / "seen"), capacity=64)
+    done = threading.Event()
+    errors = []
+
+    def flush():
+        while not done.is_set():
+            try:
+                index.flush()
+            except Exception as e:
+                errors.append(e)
+                return
+
+    flusher = threading.Thread(target=flush)
+    flusher.start()
+    try:
+        for i in range(50_000):
+            assert not index.seen(f"user{i}", f"user{i}@example.com")
+    finally:
+        done.set()
+        flusher.join()
+    assert errors == []
+    assert index.seen("user123", "user123@example.com")
+    assert len(index) == 100_000
+    index.close()
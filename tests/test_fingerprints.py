@@ -0,0 +1,123 @@
+import asyncio
+import json
+from datetime import datetime
+
+from stalkerbot.fingerprints import Recorded, WindowFingerprints, window_fingerprint
+from stalkerbot.journal import Journal
+from stalkerbot.search import Search
+from stalkerbot.sinks import CSVSink
+from stalkerbot.utils import ParsedData, QueryResponse
+from stalkerbot.workers import OutputWriter
+
+JAN = datetime(2020, 1, 1)
+FEB = datetime(2020, 2, 1)
+MAR = datetime(2020, 3, 1)
+
+
+def page(logins: list, more: bool = False) -> QueryResponse:
+    nodes = [{"login": login, "email": f"{login}@example.com"} for login in logins]
+    search = {
+        "pageInfo": {
+            "hasNextPage": False,
+            "hasPreviousPage": more,
+            "startCursor": "c",
+            "endCursor": "c",
+        },
+        "userCount": len(logins),
+        "nodes": nodes,
+    }
+    rate_limit = {"cost": 1, "used": 1, "remaining": 4999, "resetAt": "2100-01-01T00:00:00Z"}
+    return QueryResponse(json.dumps({"data": {"rateLimit": rate_limit, "search": search}}))
+
+
+def test_overlapping_window_replaces_the_recorded_one(tmp_path):
+    fingerprints = WindowFingerprints(str(tmp_path / "windows"))
+    fingerprints.record("q", JAN, FEB, window_fingerprint(page(["a"]), 10))
+    fingerprints.record("q", FEB, MAR, window_fingerprint(page(["b"]), 10))
+    assert fingerprints.get("q", JAN, FEB) is None
+    fingerprints.commit()
+    assert fingerprints.within("q", JAN, MAR) == [(JAN, FEB), (FEB, MAR)]
+
+    fingerprints.record("q", datetime(2020, 1, 15), MAR, window_fingerprint(page(["c"]), 10))
+    fingerprints.commit()
+    assert fingerprints.within("q", JAN, MAR) == [(datetime(2020, 1, 15), MAR)]
+    assert fingerprints.get("q", JAN, FEB) is None
+    fingerprints.close()
+
+
+def test_only_the_windows_up_to_a_marker_are_committed(tmp_path):
+    fingerprints = WindowFingerprints(str(tmp_path / "windows"))
+    fingerprints.record("q", JAN, FEB, window_fingerprint(page(["a"]), 10))
+    fingerprints.record("q", FEB, MAR, window_fingerprint(page(["b"]), 10))
+    fingerprints.commit(1)
+    assert fingerprints.within("q", JAN, MAR) == [(JAN, FEB)]
+    fingerprints.commit(1)
+    assert len(fingerprints.pending) == 1
+    fingerprints.commit(2)
+    assert fingerprints.within("q", JAN, MAR) == [(JAN, FEB), (FEB, MAR)]
+    fingerprints.close()
+
+
+async def crawl(search: Search, pages: list) -> list:
+    requests = []
+    gen = search.gen()
+    try:
+        request, _ = await gen.asend(None)
+        for response in pages:
+            requests.append(request)
+            request, _ = await gen.asend(response)
+    except StopAsyncIteration:
+        pass
+    return requests
+
+
+def test_unchanged_window_is_skipped_and_a_changed_one_crawled(tmp_path):
+    fingerprints = WindowFingerprints(str(tmp_path / "windows"))
+    fingerprints.record("q", JAN, FEB, window_fingerprint(page(["a", "b"]), 2))
+    fingerprints.commit()
+    search = Search("token", "q", page_size=100, since=JAN, continue_from=FEB)
+    search.fingerprints = fingerprints
+
+    # Checked with a page of the size it was recorded with, then skipped
+    requests = asyncio.run(crawl(search, [page(["a", "b"], more=True)]))
+    assert [r.page_size for r in requests] == [2]
+    assert fingerprints.pending == []
+
+    # A new signup changes the first page, so the window is paged through
+    # again and recorded afresh
+    search = Search("token", "q", page_size=100, since=JAN, continue_from=FEB)
+    search.fingerprints = fingerprints
+    responses = [page(["b", "c"], more=True), page(["a"])]
+    requests = asyncio.run(crawl(search, responses))
+    assert len(requests) == 2
+    assert [window[:3] for window in fingerprints.pending] == [("q", JAN, FEB)]
+    fingerprints.close()
+
+
+def test_windows_of_rows_dropped_on_early_stop_are_not_committed(tmp_path):
+    fingerprints = WindowFingerprints(str(tmp_path / "windows"))
+
+    async def run():
+        queue = asyncio.Queue()
+        writer = OutputWriter(
+            queue,
+            sink=CSVSink(str(tmp_path / "users.csv")),
+            silent=True,
+            early_stop=1,
+            journal=Journal(str(tmp_path / "users.csv.journal")),
+            fingerprints=fingerprints,
+            max_interval=0.01,
+        )
+        for login in ("a", "b"):
+            queue.put_nowait(ParsedData(login, login, f"{login}@example.com", None))
+        fingerprints.record("q", JAN, FEB, window_fingerprint(page(["a", "b"]), 10))
+        queue.put_nowait(Recorded(fingerprints.recorded))
+        await asyncio.wait_for(writer.astart(), timeout=5)
+        # Queued after the writer stopped, so never written
+        queue.put_nowait(ParsedData("c", "c", "c@example.com", None))
+        fingerprints.record("q", FEB, MAR, window_fingerprint(page(["c"]), 10))
+        queue.put_nowait(Recorded(fingerprints.recorded))
+
+    asyncio.run(run())
+    assert fingerprints.within("q", JAN, MAR) == [(JAN, FEB)]
+    fingerprints.close()
@@ -0,0 +1,58 @@
+from datetime import datetime
+
+from stalkerbot.dedup import SeenIndex
+from stalkerbot.journal import Journal
+from stalkerbot.sinks import CSVSink
+from stalkerbot.utils import State
+
+STATE = State(datetime(2020, 6, 1), "type:user", "cursor", datetime(2020, 1, 1))
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = Journal(path)
+    journal.commit([0, 10], 1, [STATE])
+    journal.commit([0, 20], 2, [STATE])
+    journal.close()
+    with open(path, "a", encoding="utf-8") as fp:
+        fp.write('{"position": [0, 30], "rows"')
+
+    last = Journal.replay(path)
+    assert last.position == [0, 20]
+    assert last.rows == 3
+    assert last.states == [STATE]
+
+    # Reopening drops the torn tail, so new records start on a fresh line
+    journal = Journal(path)
+    journal.commit([0, 40], 1, [STATE], clean=True)
+    journal.close()
+    last = Journal.replay(path)
+    assert last.position == [0, 40]
+    assert last.rows == 4
+    assert last.clean
+
+
+def test_recover_cuts_the_output_back_to_the_last_commit(tmp_path):
+    path = str(tmp_path / "users.csv")
+    seen = SeenIndex(str(tmp_path / "seen"))
+    journal = Journal(path + ".journal")
+    sink = CSVSink(path)
+    sink.open()
+    sink.write([("A", "a", "a@example.com")])
+    journal.commit(sink.flush(), 1, [STATE])
+    # Written but never committed, as after a crash between the two
+    sink.write([("B", "b", "b@example.com")])
+    sink.flush()
+    assert not seen.seen("a", "a@example.com")
+    assert not seen.seen("b", "b@example.com")
+    sink.close()
+    journal.close()
+
+    sink = CSVSink(path)
+    last = Journal(path + ".journal").recover(sink, seen)
+    assert last.states == [STATE]
+    assert list(sink.rows()) == [("A", "a", "a@example.com")]
+    # b is fetched again, so it is forgotten
+    assert seen.seen("a", "a@example.com")
+    assert not seen.seen("b", "b@example.com")
+    seen.close()
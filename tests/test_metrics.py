@@ -0,0 +1,10 @@
+from stalkerbot.metrics import Metrics
+
+
+def test_label_values_are_escaped():
+    metrics = Metrics()
+    metrics.inc("stalkerbot_query_searches", query='location:"San\\Francisco"\ntype:user')
+    assert (
+        'stalkerbot_query_searches{query="location:\\"San\\\\Francisco\\"\\ntype:user"} 1'
+        in metrics.prometheus()
+    )
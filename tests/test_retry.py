@@ -0,0 +1,86 @@
+import asyncio
+
+from stalkerbot.metrics import Metrics
+from stalkerbot.retry import (
+    GRAPHQL_ERROR,
+    OK,
+    RATE_LIMITED,
+    CircuitBreaker,
+    classify,
+)
+from stalkerbot.transport import Response
+from stalkerbot.utils import requests_future
+
+
+class FakeTransport:
+    def __init__(self, responses: list):
+        self.responses = list(responses)
+        self.sent = 0
+
+    async def request(self, method: str, url: str, **kwargs) -> Response:
+        self.sent += 1
+        return self.responses.pop(0)
+
+
+def test_probe_hitting_secondary_limit_does_not_hang():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.1)
+    metrics = Metrics()
+    transport = FakeTransport(
+        [
+            Response(502, b""),
+            Response(502, b""),
+            Response(429, b"", {"Retry-After": "0.2"}),
+            Response(200, b'{"data": {}}'),
+        ]
+    )
+
+    async def run():
+        return await asyncio.wait_for(
+            requests_future(
+                "post",
+                "http://fake",
+                _backoff=0.01,
+                _transport=transport,
+                _breaker=breaker,
+                _metrics=metrics,
+            ),
+            timeout=5,
+        )
+
+    resp = asyncio.run(run())
+    assert resp.status_code == 200
+    assert transport.sent == 4
+    assert not breaker.half_open
+    retries = {
+        dict(labels)["status"]: value
+        for (name, labels), value in metrics.counters.items()
+        if name == "stalkerbot_retries_total"
+    }
+    assert retries == {502: 2, 429: 1}
+
+
+def test_waiters_are_released_when_probe_is_paused():
+    breaker = CircuitBreaker(threshold=1, cooldown=0)
+
+    async def run():
+        breaker.failure()
+        await breaker.wait()  # this one probes
+        waiter = asyncio.ensure_future(breaker.wait())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        breaker.pause(0.05)
+        await asyncio.wait_for(waiter, timeout=1)
+
+    asyncio.run(run())
+
+
+def test_classify_error_bodies():
+    def body(raw: bytes) -> str:
+        return classify(Response(200, raw))
+
+    assert body(b'{"data":null,"errors":[{"type":"RATE_LIMITED"}]}') == RATE_LIMITED
+    assert body(b'{ "errors": [{"type": "RATE_LIMITED"}]}') == RATE_LIMITED
+    assert body(b'{"data":null,"errors":[{"message":"timedout"}]}') == GRAPHQL_ERROR
+    assert body(b'{"data":{},"errors":[{"message":"timedout"}]}') == GRAPHQL_ERROR
+    assert body(b'{"data":{"s0":{"userCount":1}},"errors":[{"path":["s1"]}]}') == OK
+    assert body(b'{"data":{"s0":{"userCount":1}}}') == OK
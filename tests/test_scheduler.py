@@ -0,0 +1,121 @@
+import asyncio
+import json
+import re
+from datetime import datetime, timedelta
+
+from stalkerbot.concurrency import AIMDLimiter
+from stalkerbot.ratelimit import RateLimitBudget
+from stalkerbot.retry import CircuitBreaker
+from stalkerbot.scheduler import FairQueue
+from stalkerbot.transport import Response
+from stalkerbot.utils import SearchRequest
+from stalkerbot.workers import StalkerWorker
+
+
+def test_lanes_are_served_in_proportion_to_weight():
+    queue = FairQueue({"a": 3, "b": 1})
+    for i in range(8):
+        queue.put_nowait(("a", i), key="a")
+        queue.put_nowait(("b", i), key="b")
+    served = [queue.get_nowait()[0] for _ in range(8)]
+    assert served.count("a") == 6
+    assert served.count("b") == 2
+    # Each lane keeps its own order
+    assert [i for key, i in (queue.get_nowait() for _ in range(8)) if key == "a"] == [6, 7]
+
+
+def test_batches_cover_one_round_of_virtual_time():
+    queue = FairQueue({"a": 3, "b": 1})
+    for i in range(10):
+        queue.put_nowait("a", key="a")
+        queue.put_nowait("b", key="b")
+    batch = queue.take(4)
+    assert batch.count("a") == 3
+    assert batch.count("b") == 1
+    # A lane alone fills the whole batch
+    single = FairQueue()
+    for i in range(10):
+        single.put_nowait(i)
+    assert single.take(4) == [0, 1, 2, 3]
+
+
+# Answers every search with an endless page and charges a point per search
+# from a budget of `limit` points every `window` seconds
+class BudgetTransport:
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = timedelta(seconds=window)
+        self.reset_at = datetime.utcnow() + self.window
+        self.used = 0
+        self.served = {}
+
+    async def request(self, method: str, url: str, **kwargs) -> Response:
+        await asyncio.sleep(0.001)
+        now = datetime.utcnow()
+        if now >= self.reset_at:
+            self.reset_at = now + self.window
+            self.used = 0
+        queries = re.findall(r'search\(query: "([^"]*)"', kwargs["json"]["query"])
+        self.used += len(queries)
+        for q in queries:
+            self.served[q] = self.served.get(q, 0) + 1
+        data = {
+            "rateLimit": {
+                "limit": self.limit,
+                "cost": len(queries),
+                "used": self.used,
+                "remaining": max(0, self.limit - self.used),
+                "resetAt": self.reset_at.isoformat() + "Z",
+            }
+        }
+        for i in range(len(queries)):
+            data[f"s{i}"] = {
+                "pageInfo": {
+                    "hasNextPage": False,
+                    "hasPreviousPage": True,
+                    "startCursor": "c",
+                    "endCursor": "c",
+                },
+                "userCount": 1000,
+                "nodes": [],
+            }
+        return Response(200, json.dumps({"data": data}).encode())
+
+    async def close(self):
+        pass
+
+
+def test_queries_share_a_tight_budget_by_weight():
+    weights = {"python": 3, "go": 1}
+
+    async def run():
+        transport = BudgetTransport(limit=20, window=0.4)
+        queue = FairQueue(weights)
+        worker = StalkerWorker(
+            asyncio.Queue(),
+            transport=transport,
+            budget=RateLimitBudget(margin=0),
+            breaker=CircuitBreaker(),
+            limiter=AIMDLimiter(ceiling=4),
+        )
+        worker_task = asyncio.ensure_future(worker.astart(queue))
+
+        async def search(query: str):
+            # One page in flight at a time, like a search paging through
+            while True:
+                await worker.request(queue, SearchRequest(query), key=query)
+
+        searches = [asyncio.ensure_future(search(q)) for q in weights]
+        await asyncio.sleep(2.5)
+        for task in searches:
+            task.cancel()
+        worker.stop()
+        queue.put_nowait(None)
+        await asyncio.gather(*searches, return_exceptions=True)
+        await asyncio.wait_for(worker_task, timeout=5)
+        return transport.served
+
+    served = asyncio.run(run())
+    # The first window bursts and is shared evenly, later ones are paced
+    assert sum(served.values()) <= 20 * 8
+    assert served["python"] >= 2 * served["go"]
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from stalkerbot.sinks import CSVSink, open_sink
+
+ROWS = [("Ada Lovelace", "ada", "ada@example.com"), (None, "bob", "bob@example.com")]
+MORE = [("Carl, Jr.", "carl", "carl@example.com")]
+
+
+@pytest.mark.parametrize("name", ["users.csv", "users.jsonl", "users.db", "users.csv.gz"])
+def test_rows_round_trip_and_restore(tmp_path, name):
+    path = str(tmp_path / name)
+    sink = open_sink(path)
+    assert sink.empty
+    sink.open()
+    sink.write(ROWS)
+    position = sink.flush()
+    sink.write(MORE)
+    sink.flush()
+    sink.close()
+
+    sink = open_sink(path)
+    assert not sink.empty
+    rows = [tuple(v or None for v in row) for row in sink.rows()]
+    assert rows == ROWS + MORE
+    assert sink.restore(position)
+    rows = [tuple(v or None for v in row) for row in sink.rows()]
+    assert rows == ROWS
+    assert not sink.restore(position)
+
+
+def test_rotation_writes_numbered_parts(tmp_path):
+    path = str(tmp_path / "users.csv")
+    sink = CSVSink(path, rotate_bytes=1)
+    sink.open()
+    positions = []
+    for row in ROWS + MORE:
+        sink.write([row])
+        positions.append(sink.flush())
+    sink.close()
+    assert sorted(os.listdir(tmp_path)) == [
+        "users.00000.csv",
+        "users.00001.csv",
+        "users.00002.csv",
+        "users.00003.csv",
+    ]
+    # The last flush rotated into an empty part, which is where writing resumes
+    assert positions[-1] == [3, 0]
+
+    sink = CSVSink(path, rotate_bytes=1)
+    assert sink.part == 3
+    assert list(sink.rows()) == [tuple(v or "" for v in row) for row in ROWS + MORE]
+    # Restoring into an earlier part drops every part after it
+    assert sink.restore(positions[0])
+    assert sorted(os.listdir(tmp_path)) == ["users.00000.csv", "users.00001.csv"]
+    assert list(sink.rows()) == [ROWS[0]]
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import re
+from datetime import datetime
+from itertools import count
+
+import pytest
+
+from stalkerbot.filters import Filters
+from stalkerbot.search import EPOCH
+from stalkerbot.sinks import CSVSink
+from stalkerbot.stalker import Stalker
+from stalkerbot.transport import Response
+from stalkerbot.utils import State
+from stalkerbot.watermark import Watermarks
+
+
+# Answers every search with a page of new users with an email, endless
+# unless `pages` is set
+class PageTransport:
+    def __init__(self, users: int = 10, pages: int = None):
+        self.users = users
+        self.pages = pages
+        self.logins = count()
+        self.sent = 0
+
+    async def request(self, method: str, url: str, **kwargs) -> Response:
+        await asyncio.sleep(0)
+        self.sent += 1
+        searches = re.findall(r"search\(.*?\) \{(\w+)", kwargs["json"]["query"])
+        more = self.pages is None or self.sent < self.pages
+        data = {
+            "rateLimit": {
+                "limit": 5000,
+                "cost": 1,
+                "used": self.sent,
+                "remaining": 5000 - self.sent,
+                "resetAt": "2100-01-01T00:00:00Z",
+            }
+        }
+        for i, selection in enumerate(searches):
+            if selection == "userCount":
+                # A count-only probe
+                data[f"s{i}"] = {"userCount": 500}
+                continue
+            nodes = []
+            for _ in range(self.users):
+                k = next(self.logins)
+                nodes.append(
+                    {
+                        "name": f"User {k}",
+                        "login": f"user{k}",
+                        "email": f"user{k}@example.com",
+                        "createdAt": "2020-01-01T00:00:00Z",
+                    }
+                )
+            data[f"s{i}"] = {
+                "pageInfo": {
+                    "hasNextPage": False,
+                    "hasPreviousPage": more,
+                    "startCursor": "c",
+                    "endCursor": "c",
+                },
+                "userCount": 500,
+                "nodes": nodes,
+            }
+        return Response(200, json.dumps({"data": data}).encode())
+
+    async def close(self):
+        pass
+
+
+def stalker(tmp_path, transport: PageTransport, **options) -> Stalker:
+    crawler = Stalker(
+        "type:user",
+        token="token",
+        output_path=str(tmp_path / "users.csv"),
+        silent=True,
+        density_index="",
+        parser="inline",
+        autotune=False,
+        **options,
+    )
+    crawler.worker.transport = transport
+    return crawler
+
+
+def fail_write(monkeypatch, call: int):
+    encode = CSVSink._encode
+    calls = count()
+
+    def failing(self, rows):
+        if next(calls) == call:
+            raise OSError("disk full")
+        return encode(self, rows)
+
+    monkeypatch.setattr(CSVSink, "_encode", failing)
+
+
+def test_failed_writer_stops_the_crawl(tmp_path, monkeypatch):
+    fail_write(monkeypatch, 1)
+    crawler = stalker(tmp_path, PageTransport(users=50), queue_size=50, flush_rows=1)
+    with pytest.raises(OSError, match="disk full"):
+        asyncio.run(asyncio.wait_for(crawler.run(), timeout=10))
+
+
+def test_start_runs_in_a_fresh_loop(tmp_path):
+    # An earlier asyncio.run leaves no current event loop behind
+    asyncio.run(asyncio.sleep(0))
+    crawler = stalker(tmp_path, PageTransport(pages=3))
+    crawler.start()
+    assert crawler.writer.total == 20
+
+
+def test_no_watermark_when_the_writer_failed(tmp_path, monkeypatch):
+    fail_write(monkeypatch, 0)
+    crawler = stalker(tmp_path, PageTransport(pages=2), flush_rows=1)
+    with pytest.raises(OSError):
+        asyncio.run(asyncio.wait_for(crawler.run(), timeout=10))
+    assert crawler.unfinished == {"type:user": 0}
+    assert Watermarks(str(tmp_path / "users.csv.watermarks")).marks == {}
+
+
+def test_only_queries_searched_get_a_watermark(tmp_path):
+    # Resumed with filters that change the query, which is not searched
+    state = State(datetime(2020, 1, 1), "type:user", None, EPOCH)
+    crawler = stalker(
+        tmp_path, PageTransport(pages=2), state=[state], filters=Filters(followers=">5")
+    )
+    crawler.start()
+    marks = Watermarks(str(tmp_path / "users.csv.watermarks")).marks
+    assert list(marks) == ["type:user"]
@@ -0,0 +1,36 @@
+import asyncio
+
+from aiohttp import web
+
+from stalkerbot.transport import Transport
+
+
+def test_transport_is_reused_across_event_loops():
+    transport = Transport(max_concurrent=1)
+
+    async def handle(request):
+        await asyncio.sleep(0.01)
+        return web.Response(text="ok")
+
+    async def run(close: bool):
+        app = web.Application()
+        app.router.add_get("/", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            # More requests than max_concurrent, so some wait on the semaphore
+            responses = await asyncio.gather(
+                *(transport.request("get", f"http://127.0.0.1:{port}/") for _ in range(3))
+            )
+        finally:
+            if close:
+                await transport.close()
+            await runner.cleanup()
+        return [r.content for r in responses]
+
+    # The first loop leaves its session open, the second gets its own
+    assert asyncio.run(run(close=False)) == [b"ok"] * 3
+    assert asyncio.run(run(close=True)) == [b"ok"] * 3